@@ -0,0 +1,440 @@
+import asyncio
+import logging
+import queue
+import ssl
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+from downloader import (CONNECT_TIMEOUT, IMG_BUF_SIZE, READ_TIMEOUT, RETRYABLE_ERRORS, DownloadResult,
+                        PartialContentError, PartialImage, RetryPolicy, discard_stale_image, get_conditional_headers,
+                        get_error_class, get_failed_result, get_host, get_not_modified_result, get_retry_after,
+                        is_retryable_error)
+
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+RUN_DONE = object()  # the end of the results of a run
+ASYNC_RETRYABLE_ERRORS = RETRYABLE_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+
+class HttpError(Exception):
+    def __init__(self, code, headers: dict = None):
+        super().__init__(f"HTTP Error {code}")
+        self.code = code
+        self.headers = headers if headers is not None else {}
+
+
+class HttpResponse:
+    def __init__(self, status, headers: dict, will_close):
+        self.status = status
+        self.headers = headers
+        self.will_close = will_close
+
+
+class HttpConnection:
+    """
+    A HTTP/1.1 connection to one host, which is kept alive between requests.
+    Every read or write waiting longer than `read_timeout` raises `asyncio.TimeoutError`.
+    """
+
+    def __init__(self, scheme, host, port, read_timeout=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.request_amount = 0
+
+    async def connect(self, ssl_context, connect_timeout=None):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context if self.scheme == "https" else None),
+            connect_timeout)
+
+    async def _wait(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.read_timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def request(self, netloc, target, headers: dict = None):
+        self.request_amount += 1
+        lines = [f"GET {target} HTTP/1.1",
+                 f"Host: {netloc}",
+                 "User-Agent: ",
+                 "Accept-Encoding: identity",
+                 "Connection: keep-alive"]
+        for k, v in (headers or {}).items():
+            lines.append(f"{k}: {v}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self._wait(self.writer.drain())
+
+        while True:
+            status_line = await self._wait(self.reader.readline())
+            if not status_line:
+                raise ConnectionResetError("connection closed by the server")
+
+            version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+            status = int(status)
+
+            headers = {}
+            while True:
+                line = await self._wait(self.reader.readline())
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+
+            if status >= 200 or status == 101:
+                break
+            # skip informational responses such as `100 Continue`
+
+        will_close = version != "HTTP/1.1" or headers.get("connection", "").lower() == "close"
+        return HttpResponse(status, headers, will_close)
+
+    async def iter_body(self, response: HttpResponse):
+        """
+        Yield the body of the response in chunks.
+        The connection can be reused afterwards unless `response.will_close` is set.
+        """
+        if response.status in (204, 304):
+            return
+
+        if "chunked" in response.headers.get("transfer-encoding", "").lower():
+            while True:
+                size_line = await self._wait(self.reader.readline())
+                size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+                if size == 0:
+                    # skip trailers
+                    while (await self._wait(self.reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+
+                while size > 0:
+                    buf = await self._wait(self.reader.read(min(size, IMG_BUF_SIZE)))
+                    if not buf:
+                        raise asyncio.IncompleteReadError(buf, size)
+                    size -= len(buf)
+                    yield buf
+                await self._wait(self.reader.readexactly(2))  # CRLF after each chunk
+
+        elif "content-length" in response.headers:
+            remaining = int(response.headers["content-length"])
+            while remaining > 0:
+                buf = await self._wait(self.reader.read(min(remaining, IMG_BUF_SIZE)))
+                if not buf:
+                    raise asyncio.IncompleteReadError(buf, remaining)
+                remaining -= len(buf)
+                yield buf
+
+        else:
+            # the body is delimited by closing the connection
+            response.will_close = True
+            while True:
+                buf = await self._wait(self.reader.read(IMG_BUF_SIZE))
+                if not buf:
+                    return
+                yield buf
+
+
+class HostConnectionPool:
+    """
+    Keep-alive connections to one host.
+    At most `limit` connections are open, i.e. at most `limit` requests run at the same time.
+    A connection also takes a slot of `shared_semaphore` if it is given, e.g. shared by the pools of all hosts,
+    only once the host has a free slot, so a request waiting for a busy host never holds a slot other hosts could use.
+    """
+
+    def __init__(self, scheme, host, port, limit, ssl_context, connect_timeout=None, read_timeout=None,
+                 shared_semaphore: asyncio.Semaphore = None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self._shared_semaphore = shared_semaphore
+        self._idle = []
+        self.connect_amount = 0
+
+    async def connect(self):
+        """
+        Open a new connection, which does not count towards the limit.
+        """
+        conn = HttpConnection(self.scheme, self.host, self.port, self.read_timeout)
+        await conn.connect(self.ssl_context, self.connect_timeout)
+        self.connect_amount += 1
+        return conn
+
+    async def acquire(self):
+        await self._semaphore.acquire()
+        try:
+            if self._shared_semaphore is not None:
+                await self._shared_semaphore.acquire()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        if self._idle:
+            return self._idle.pop()
+
+        try:
+            return await self.connect()
+        except BaseException:
+            self._release_slots()
+            raise
+
+    def release(self, conn: HttpConnection, reusable):
+        if reusable:
+            self._idle.append(conn)
+        else:
+            conn.close()
+        self._release_slots()
+
+    def _release_slots(self):
+        if self._shared_semaphore is not None:
+            self._shared_semaphore.release()
+        self._semaphore.release()
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+
+
+def close_loop(loop: asyncio.AbstractEventLoop):
+    """
+    Close `loop` like `asyncio.run` does, after cancelling and awaiting the tasks left in it,
+    such as downloads of a run which is cancelled.
+    """
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+
+
+class AsyncDownloadEngine:
+    """
+    Download engine running all downloads on one asyncio event loop.
+
+    Connections are HTTP/1.1 keep-alive connections pooled per host,
+    so images from the same host reuse a few connections instead of a new TCP+TLS handshake per image.
+    At most `max_concurrency` downloads run at the same time,
+    and at most `host_limits[host]` (or `max_concurrency`) of them target the same host.
+    A retry waits without taking any of them.
+    Connections belong to the event loop of a run, so they are closed at its end.
+    """
+
+    def __init__(self, max_concurrency, host_limits: dict = None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retry_policy: RetryPolicy = None):
+        self.max_concurrency = max_concurrency
+        self.host_limits = host_limits if host_limits is not None else {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._pools = {}
+        self._ssl_context = None
+        self._semaphore: asyncio.Semaphore = None
+
+    def get_host_limit(self, host):
+        return max(1, self.host_limits.get(host, self.max_concurrency))
+
+    def _get_pool(self, url) -> HostConnectionPool:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError(f"unsupported URL scheme `{scheme}`")
+
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            self._pools[key] = pool = HostConnectionPool(scheme, parts.hostname, port,
+                                                         self.get_host_limit(get_host(url)), self._ssl_context,
+                                                         self.connect_timeout, self.read_timeout, self._semaphore)
+        return pool
+
+    def run(self, tasks):
+        """
+        Download every task and yield `(task, result)` in completion order, as soon as each download completes,
+        so the caller, e.g. `download_images` with a journal, handles it while the others are still downloading.
+        The result is a `DownloadResult`, or the exception raised.
+
+        The event loop runs on its own thread and hands the results over a queue.
+        If the caller stops early, e.g. on Ctrl+C, the downloads still running are cancelled.
+        """
+        results = queue.SimpleQueue()
+        loop = asyncio.new_event_loop()
+        run_task = loop.create_task(self._run(tasks, results.put))
+
+        def run_loop():
+            try:
+                loop.run_until_complete(run_task)
+            except BaseException as e:
+                results.put(e)
+            finally:
+                try:
+                    close_loop(loop)
+                finally:
+                    results.put(RUN_DONE)
+
+        thread = threading.Thread(target=run_loop, name="AsyncDownloadEngine", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is RUN_DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            if thread.is_alive():
+                try:
+                    loop.call_soon_threadsafe(run_task.cancel)
+                except RuntimeError:
+                    pass  # the loop has just been closed
+            thread.join()
+
+    async def _run(self, tasks, on_result):
+        self._pools = {}
+        if self._ssl_context is None:
+            # loading the CA certificates is slow, so the context is kept for the next runs
+            self._ssl_context = ssl.create_default_context()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_task(task):
+            try:
+                result = await self.download_image(task.img_url, task.img_path, task.cached)
+            except Exception as e:
+                result = e
+            on_result((task, result))
+
+        try:
+            await asyncio.gather(*(run_task(task) for task in tasks))
+        finally:
+            for pool in self._pools.values():
+                pool.close()
+
+    async def _fetch(self, url, img_path, cached: DownloadResult = None, pool: HostConnectionPool = None,
+                     conn: HttpConnection = None) -> DownloadResult:
+        """
+        Download `url`, following redirects, on `conn` acquired from `pool` if it is given.
+        Every connection acquired is released at the end.
+        """
+        status = None
+        reusable = False
+        try:
+            partial_image = PartialImage(url, img_path)
+            range_headers = partial_image.get_range_headers()
+            # a resumable part file means the image is modified, so the image is not re-fetched conditionally
+            conditional_headers = get_conditional_headers(img_path, cached) if not range_headers else {}
+            headers = dict(conditional_headers, **range_headers)
+            for _ in range(MAX_REDIRECTS + 1):
+                if conn is None:
+                    pool = self._get_pool(url)
+                    conn = await pool.acquire()
+                reusable = False
+                parts = urlsplit(url)
+                target = parts.path or "/"
+                if parts.query:
+                    target = f"{target}?{parts.query}"
+
+                try:
+                    response = await conn.request(parts.netloc, target, headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if conn.request_amount <= 1:
+                        raise
+                    # the server closed the idle keep-alive connection, so retry on a new one
+                    conn.close()
+                    conn = await pool.connect()
+                    response = await conn.request(parts.netloc, target, headers)
+
+                status = response.status
+                if status in REDIRECT_STATUSES and "location" in response.headers:
+                    async for _ in conn.iter_body(response):
+                        pass
+                    pool.release(conn, not response.will_close)
+                    conn = None
+                    url = urljoin(url, response.headers["location"])
+                    continue
+
+                if status == 304 and conditional_headers:
+                    reusable = not response.will_close
+                    logging.debug("Not Modified: `%s`", url)
+                    return get_not_modified_result(cached,
+                                                   response.headers.get("etag"),
+                                                   response.headers.get("last-modified"))
+
+                if not 200 <= status < 300:
+                    async for _ in conn.iter_body(response):
+                        pass
+                    reusable = not response.will_close
+                    if status == 416 and range_headers:
+                        partial_image.discard()
+                        raise PartialContentError(f"Range Not Satisfiable `{range_headers['Range']}`")
+                    raise HttpError(status, response.headers)
+
+                try:
+                    with partial_image.open(status, response.headers) as img:
+                        async for buf in conn.iter_body(response):
+                            img.write(buf)
+                except Exception:
+                    partial_image.abort()
+                    raise
+                reusable = not response.will_close
+
+                local_size = partial_image.commit()
+                return DownloadResult(True, status,
+                                      response.headers.get("etag"),
+                                      response.headers.get("last-modified"),
+                                      partial_image.content_length,
+                                      local_size)
+
+            # too many redirects
+            raise HttpError(status)
+
+        finally:
+            if conn is not None:
+                pool.release(conn, reusable)
+
+    async def download_image(self, img_url, img_path, cached: DownloadResult = None) -> DownloadResult:
+        attempts = 0
+        while True:
+            attempts += 1
+            started_at = None
+            try:
+                # the slot of the host is taken before the global one, see `HostConnectionPool`
+                pool = self._get_pool(img_url)
+                conn = await pool.acquire()
+                started_at = time.monotonic()
+                result = await self._fetch(img_url, img_path, cached, pool, conn)
+
+            except Exception as e:
+                if attempts <= self.retry_policy.max_retries and is_retryable_error(e, ASYNC_RETRYABLE_ERRORS):
+                    delay = self.retry_policy.get_delay(attempts, get_retry_after(e))
+                    logging.info("Retry %d/%d in %.1fs after %s: `%s`",
+                                 attempts, self.retry_policy.max_retries, delay, get_error_class(e), img_url)
+                    await asyncio.sleep(delay)
+                    continue
+
+                if isinstance(e, HttpError):
+                    logging.info("HTTP Error: %s  `%s`", e.code, img_url)
+                elif isinstance(e, ASYNC_RETRYABLE_ERRORS + (OSError, ValueError)):
+                    logging.info("We failed to reach a server: `%s`\n    Reason: %r", img_url, e)
+                else:
+                    logging.error("\nException download image: `%s`\n", img_url, exc_info=e)
+                discard_stale_image(img_path, cached)
+                result = get_failed_result(e, attempts)
+                result.elapsed = time.monotonic() - started_at if started_at is not None else None
+                return result
+
+            result.attempts = attempts
+            result.elapsed = time.monotonic() - started_at
+            return result
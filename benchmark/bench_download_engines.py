@@ -0,0 +1,61 @@
+"""
+Compare the throughput of the download engines against a local image server.
+
+The server adds a fixed latency to every new connection (a stand-in for the TCP+TLS handshake)
+and to every request, so the benchmark shows the effect of reusing keep-alive connections
+and of running many downloads at the same time.
+
+usage::
+
+    python -m benchmark.bench_download_engines
+    python -m benchmark.bench_download_engines --images 2000 --workers 5 50 200 --size 20000
+"""
+import argparse
+import logging
+import tempfile
+import timeit
+
+from async_downloader import AsyncDownloadEngine
+from benchmark.image_server import ImageServer
+from downloader import DownloadTask, ThreadDownloadEngine
+
+
+def bench(engine, server: ImageServer, image_amount):
+    base_url = server.base_url
+    server.connection_amount = 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tasks = [DownloadTask(f"{i % 100}.md", f"{base_url}/{i}.png", f"{tmp_dir}/{i}.png")
+                 for i in range(image_amount)]
+
+        start = timeit.default_timer()
+        ok_amount = sum(1 for _, result in engine.run(tasks) if result.ok)
+        elapsed = timeit.default_timer() - start
+
+    return ok_amount, elapsed, server.connection_amount
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare the throughput of the download engines")
+    ap.add_argument("--images", type=int, default=500, help="number of downloaded images")
+    ap.add_argument("--size", type=int, default=50_000, help="image size in bytes")
+    ap.add_argument("--workers", type=int, nargs="+", default=[5, 50, 200],
+                    help="values of --download-workers to compare")
+    ap.add_argument("--connect-latency", type=float, default=0.02, help="seconds added to every new connection")
+    ap.add_argument("--request-latency", type=float, default=0.01, help="seconds added to every request")
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'engine':>8} {'workers':>8} {'ok':>6} {'time (s)':>9} {'images/s':>9} {'connections':>12}")
+    with ImageServer(args.size, args.connect_latency, args.request_latency) as server:
+        for workers in args.workers:
+            for name, engine in (("thread", ThreadDownloadEngine(workers)),
+                                 ("asyncio", AsyncDownloadEngine(workers))):
+                ok_amount, elapsed, connection_amount = bench(engine, server, args.images)
+                print(f"{name:>8} {workers:>8} {ok_amount:>6} {elapsed:>9.2f} {ok_amount / elapsed:>9.1f}"
+                      f" {connection_amount:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark the memory held by image index readers against image indexes of growing size.
+
+`rows` holds the `csv.DictReader` dicts as a reference, `records` is `ImgIndexReader`,
+which holds one `ImgIndexRecord` with `__slots__` per image and shares the markdown file names,
+and `columnar` is `ColumnarImgIndexReader`, which holds columns and builds records on read.
+Memory is the size of Python allocations traced by `tracemalloc` while the reader is open,
+and at the peak of loading, and `list` is the time to read all records.
+
+usage::
+
+    python -m benchmark.bench_index_memory
+    python -m benchmark.bench_index_memory --sizes 100000 1000000 --images-per-md 20
+"""
+import argparse
+import csv
+import gc
+import logging
+import os
+import tempfile
+import timeit
+import tracemalloc
+
+from columnar_index import ColumnarImgIndexReader
+from sync_index import ImgIndexReader, ImgIndexRecord, ImgIndexWriter
+
+
+class RowsImgIndexReader:
+    """
+    Reference reader holding every row as its `csv.DictReader` dict.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._rows = []
+
+    def __enter__(self):
+        with open(self.filepath, newline="", encoding="utf-8") as f:
+            self._rows = list(csv.DictReader(f, quoting=csv.QUOTE_ALL))
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        pass
+
+    def list_record(self):
+        return iter(self._rows)
+
+
+READERS = {"rows": RowsImgIndexReader, "records": ImgIndexReader, "columnar": ColumnarImgIndexReader}
+
+
+def write_img_index(img_index_path, size, images_per_md):
+    with ImgIndexWriter(img_index_path) as img_index:
+        for i in range(size):
+            md_filename = f"notes/note-{i // images_per_md:08d}.md"
+            is_downloaded = i % 10 != 0
+            img_index.create(ImgIndexRecord(md_filename, is_downloaded, f"https://i.imgur.com/{i:08d}.png",
+                                            f"{i % 100 + 1}-{i:08d}.png",
+                                            f"\"{i:016x}\"" if is_downloaded else None,
+                                            "Mon, 01 Jan 2018 01:01:01 GMT" if is_downloaded else None,
+                                            20_000 + i % 1000 if is_downloaded else None,
+                                            20_000 + i % 1000 if is_downloaded else None))
+
+
+def bench(reader_class, img_index_path):
+    start = timeit.default_timer()
+    with reader_class(img_index_path) as img_index:
+        load_time = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        for _ in img_index.list_record():
+            pass
+        list_time = timeit.default_timer() - start
+
+    # memory is traced in another load, as tracing slows it down
+    gc.collect()
+    tracemalloc.start()
+    with reader_class(img_index_path):
+        held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return load_time, list_time, held, peak
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the memory held by image index readers")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 300_000],
+                    help="numbers of records in the generated image indexes")
+    ap.add_argument("--images-per-md", type=int, default=10, help="images per markdown file")
+    ap.add_argument("--readers", nargs="+", choices=list(READERS), default=list(READERS))
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'records':>10} {'reader':>10} {'load (s)':>9} {'list (s)':>9} {'held (MiB)':>11} {'peak (MiB)':>11} "
+          f"{'bytes/record':>13}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            img_index_path = f"{tmp_dir}/index-image-{size}.csv"
+            write_img_index(img_index_path, size, args.images_per_md)
+            for reader in args.readers:
+                load_time, list_time, held, peak = bench(READERS[reader], img_index_path)
+                print(f"{size:>10} {reader:>10} {load_time:>9.3f} {list_time:>9.3f} {held / 2 ** 20:>11.2f} "
+                      f"{peak / 2 ** 20:>11.2f} {held / size:>13.0f}")
+            os.remove(img_index_path)
+
+
+if __name__ == '__main__':
+    main()
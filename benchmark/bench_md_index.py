@@ -0,0 +1,71 @@
+"""
+Benchmark lookups in `MdIndexReader` against markdown indexes of growing size.
+
+Lookup time per file should stay flat as the index grows,
+because the index is parsed once into a dict keyed by file name.
+
+usage::
+
+    python -m benchmark.bench_md_index
+    python -m benchmark.bench_md_index --sizes 1000 10000 100000 --lookups 5000
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import tempfile
+import timeit
+
+from sync_index import MdIndexIsSynced, MdIndexReader, MdIndexRecord, MdIndexWriter
+
+
+def write_md_index(md_index_path, size):
+    modified_date = datetime.datetime.now().astimezone()
+    filenames = []
+    with MdIndexWriter(md_index_path) as md_index:
+        for i in range(size):
+            filename = f"note-{i:08d}.md"
+            md_index.create(MdIndexRecord(filename, f"https://hackmd.io/{i}", MdIndexIsSynced.Y, modified_date))
+            filenames.append(filename)
+
+    return filenames
+
+
+def bench(size, lookups, tmp_dir):
+    md_index_path = f"{tmp_dir}/index-markdown-{size}.csv"
+    filenames = write_md_index(md_index_path, size)
+    samples = random.choices(filenames, k=lookups)
+
+    load_start = timeit.default_timer()
+    with MdIndexReader(md_index_path) as md_index:
+        load_time = timeit.default_timer() - load_start
+
+        lookup_start = timeit.default_timer()
+        for filename in samples:
+            if md_index.has_filename(filename):
+                md_index.get_record_by_filename(filename)
+        lookup_time = timeit.default_timer() - lookup_start
+
+    os.remove(md_index_path)
+    return load_time, lookup_time / lookups
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark MdIndexReader lookups")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 40_000, 100_000],
+                    help="numbers of records in the generated markdown indexes")
+    ap.add_argument("--lookups", type=int, default=10_000, help="lookups per index")
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'records':>10} {'load (s)':>10} {'lookup (us)':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            load_time, lookup_time = bench(size, args.lookups, tmp_dir)
+            print(f"{size:>10} {load_time:>10.3f} {lookup_time * 1_000_000:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark parsing and rewriting image links in one large markdown file.
+
+The mmap scanner jumps from one `![` to the next in the mapped bytes and decodes only the links,
+keeping only the distinct image URLs of the file,
+and the rewrite scans the mapped file again and writes unchanged byte ranges straight from it in one pass,
+compared with the reference, which reads the file line by line in text mode.
+Peak memory is the peak of Python allocations traced by `tracemalloc`, which excludes the mapped pages,
+so it grows with the distinct image URLs of the file, not with its size.
+
+usage::
+
+    python -m benchmark.bench_md_scan
+    python -m benchmark.bench_md_scan --sizes 10 100 --link-ratio 0.01
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import tempfile
+import timeit
+import tracemalloc
+
+from sync_index import ImgIndexRecord
+from sync_md import parse_img_urls_in_md, replace_img_urls_in_md
+
+TEXT_LINE_PATTERN = re.compile(r"\!\[(\"([^\n\r\"]*)\"|[^\n\r\]]*)\]\((https*:\/\/([^\)\"]+))(?:[ ]+\"[^\n\r\"]*\")?\)")
+
+
+def generate_md(md_path, size_mb, link_ratio):
+    size = size_mb * 1024 * 1024
+    written = 0
+    n = 0
+    with open(md_path, mode="w", encoding="utf-8") as md:
+        while written < size:
+            if random.random() < link_ratio:
+                line = f"![圖 {n}](https://i.imgur.com/{n}.png \"title\")\n"
+            else:
+                line = f"Lorem ipsum dolor sit amet ![not a link] {n} 多位元組文字 " * 3 + "\n"
+            n += 1
+            written += md.write(line)
+
+
+def reference_parse(md_path):
+    with open(md_path, newline="", encoding="utf-8") as md:
+        return [result.group(3) for line in md for result in TEXT_LINE_PATTERN.finditer(line)]
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = timeit.default_timer()
+    result = func(*args)
+    elapsed = timeit.default_timer() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench(size_mb, link_ratio):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        md_path = os.path.join(tmp_dir, "large.md")
+        generate_md(md_path, size_mb, link_ratio)
+
+        expected, reference_time, reference_peak = measure(reference_parse, md_path)
+        img_urls, parse_time, parse_peak = measure(parse_img_urls_in_md, md_path)
+        if img_urls != list(dict.fromkeys(expected)):
+            raise AssertionError(f"mmap scanner differs from the reference with a {size_mb} MiB file")
+
+        images = {img_url: ImgIndexRecord("large.md", True, img_url, f"{i}.png") for i, img_url in enumerate(img_urls)}
+        _, replace_time, replace_peak = measure(replace_img_urls_in_md, md_path, "./large", images)
+
+    return len(img_urls), reference_time, reference_peak, parse_time, parse_peak, replace_time, replace_peak
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark parsing and rewriting image links in a large markdown file")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[8, 64], help="sizes of the generated files in MiB")
+    ap.add_argument("--link-ratio", type=float, default=0.05, help="ratio of lines which are image links")
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(0)
+
+    print(f"{'MiB':>5} {'urls':>8} {'reference (s)':>14} {'peak (MiB)':>11} {'scan (s)':>9} {'peak (MiB)':>11} "
+          f"{'rewrite (s)':>12} {'peak (MiB)':>11}")
+    for size_mb in args.sizes:
+        urls, reference_time, reference_peak, parse_time, parse_peak, replace_time, replace_peak = \
+            bench(size_mb, args.link_ratio)
+        print(f"{size_mb:>5} {urls:>8} {reference_time:>14.3f} {reference_peak / 2 ** 20:>11.2f} "
+              f"{parse_time:>9.3f} {parse_peak / 2 ** 20:>11.2f} {replace_time:>12.3f} {replace_peak / 2 ** 20:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+Benchmark `sync_md` end to end on a synthetic vault, served by a local image server.
+
+The first run syncs the whole vault in create mode.
+Then a share of the notes are changed, and the second run syncs them in update mode
+with the indexes of the first run.
+Each stage of `sync_md` is timed by wrapping its function, and the results are written to a JSON file,
+which can be given as `--baseline` of a later benchmark to compare the versions.
+
+usage::
+
+    python -m benchmark.bench_sync_md
+    python -m benchmark.bench_sync_md --notes 2000 --images-per-note 5 --duplicate-ratio 0.3 --changed-ratio 0.1
+    python -m benchmark.bench_sync_md --request-latency 0.05 --error-rate 0.05 --bandwidth 1000000 \\
+        --download-engine asyncio --download-workers 50 --baseline bench_sync_md.json --output bench_sync_md-new.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import timeit
+
+import sync_md
+from benchmark.image_server import ImageServer
+from benchmark.vault import generate_vault, modify_vault
+from sync_index import ImgIndexReader, MdIndexIsSynced, MdIndexReader
+
+STAGES = ["generate_md_index", "copy_md_files", "copy_modified_md_files", "remove_deleted_md_files",
+          "generate_img_index", "remove_deleted_images", "download_images", "mark_is_downloaded_in_img_index",
+          "replace_img_url_with_downloaded_img_in_md", "mark_is_synced_in_md_index", "collect_image_store_garbage",
+          "make_a_summary"]
+
+
+class StageTimer:
+    """
+    Replace the stage functions of `sync_md` with wrappers adding up their wall time, until it exits.
+    """
+
+    def __init__(self):
+        self.stage_times = {}
+        self._functions = {}
+
+    def _wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stage_times[stage] = self.stage_times.get(stage, 0.0) + timeit.default_timer() - start
+
+        return timed
+
+    def __enter__(self):
+        for stage in STAGES:
+            self._functions[stage] = function = getattr(sync_md, stage)
+            setattr(sync_md, stage, self._wrap(stage, function))
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        for stage, function in self._functions.items():
+            setattr(sync_md, stage, function)
+
+
+def count_output(output_dir):
+    with MdIndexReader(f"{output_dir}/index-markdown.csv") as md_index:
+        md_records = list(md_index.list_record())
+    with ImgIndexReader(f"{output_dir}/index-image.csv") as img_index:
+        img_records = list(img_index.list_record())
+
+    return {"markdown_files": len(md_records),
+            "synced_markdown_files": sum(1 for r in md_records if r.is_synced == MdIndexIsSynced.Y),
+            "images": len(img_records),
+            "downloaded_images": sum(1 for r in img_records if r.is_downloaded),
+            "downloaded_bytes": sum(r.local_size or 0 for r in img_records if r.is_downloaded)}
+
+
+def run_sync_md(mode, md_dir_path, old_md_index_path, old_img_index_path, img_url_filter_path, args):
+    with StageTimer() as stage_timer:
+        start = timeit.default_timer()
+        sync_md.sync_md(md_dir_path, None, old_md_index_path, old_img_index_path, img_url_filter_path,
+                        args.index_backend, args.download_workers, None, args.download_engine, False,
+                        max_retries=args.max_retries, parse_workers=args.parse_workers)
+        total_time = timeit.default_timer() - start
+
+    return dict({"mode": mode, "total_time": total_time, "stage_times": stage_timer.stage_times},
+                **count_output(f"{os.getcwd()}/output"))
+
+
+def bench(args):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ImageServer(args.image_size, args.connect_latency, args.request_latency, args.error_rate,
+                        args.bandwidth) as server:
+        md_dir_path = f"{tmp_dir}/vault"
+        img_url_filter_path = f"{tmp_dir}/imageUrlFilter.txt"
+        with open(img_url_filter_path, mode="w", encoding="utf-8") as img_url_filter:
+            img_url_filter.write(f"{server.base_url}/\n")
+
+        md_filenames = generate_vault(md_dir_path, server.base_url, args.notes, args.images_per_note,
+                                      args.duplicate_ratio)
+
+        run_dir_path = f"{tmp_dir}/run"
+        os.mkdir(run_dir_path)
+        os.chdir(run_dir_path)
+        try:
+            runs = [run_sync_md("create", md_dir_path, None, None, img_url_filter_path, args)]
+
+            backup_dir_path = f"{tmp_dir}/backup"
+            os.mkdir(backup_dir_path)
+            for filename in ("index-markdown.csv", "index-image.csv"):
+                shutil.copy2(f"{run_dir_path}/output/{filename}", f"{backup_dir_path}/{filename}")
+
+            modify_vault(md_dir_path, server.base_url, md_filenames, args.changed_ratio)
+            runs.append(run_sync_md("update", md_dir_path, f"{backup_dir_path}/index-markdown.csv",
+                                    f"{backup_dir_path}/index-image.csv", img_url_filter_path, args))
+        finally:
+            os.chdir(cwd)
+
+        server_stats = {"connections": server.connection_amount, "requests": server.request_amount,
+                        "errors": server.error_amount}
+
+    return runs, server_stats
+
+
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(sync_md.__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_change(time, baseline_time):
+    if baseline_time is None or baseline_time <= 0:
+        return ""
+    return f"{(time - baseline_time) / baseline_time:>+9.1%}"
+
+
+def print_runs(runs, baseline_runs):
+    baseline_runs = {run["mode"]: run for run in baseline_runs}
+    for run in runs:
+        baseline = baseline_runs.get(run["mode"], {})
+        baseline_stage_times = baseline.get("stage_times", {})
+        print(f"\n{run['mode']}: {run['markdown_files']} markdown files, "
+              f"{run['downloaded_images']}/{run['images']} images downloaded, {run['downloaded_bytes']} bytes")
+        print(f"{'stage':>42} {'time (s)':>9} {'baseline':>9}")
+        for stage in STAGES:
+            if stage in run["stage_times"]:
+                stage_time = run["stage_times"][stage]
+                change = format_change(stage_time, baseline_stage_times.get(stage))
+                print(f"{stage:>42} {stage_time:>9.3f} {change}".rstrip())
+        change = format_change(run["total_time"], baseline.get("total_time"))
+        print(f"{'total':>42} {run['total_time']:>9.3f} {change}".rstrip())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark sync_md end to end")
+    ap.add_argument("--notes", type=int, default=500, help="number of generated markdown files")
+    ap.add_argument("--images-per-note", type=int, default=4, help="image links per markdown file")
+    ap.add_argument("--duplicate-ratio", type=float, default=0.2, help="share of links to images shared by notes")
+    ap.add_argument("--changed-ratio", type=float, default=0.1, help="share of notes changed before update mode")
+    ap.add_argument("--image-size", type=int, default=20_000, help="image size in bytes")
+    ap.add_argument("--connect-latency", type=float, default=0.0, help="seconds added to every new connection")
+    ap.add_argument("--request-latency", type=float, default=0.005, help="seconds added to every request")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of requests failed with 503")
+    ap.add_argument("--bandwidth", type=float, default=None, help="bytes per second per connection")
+    ap.add_argument("--index-backend", choices=sync_md.INDEX_BACKENDS, default="csv")
+    ap.add_argument("--download-engine", choices=sync_md.DOWNLOAD_ENGINES, default="thread")
+    ap.add_argument("--download-workers", type=int, default=sync_md.THREAD_POOL_MAX_WORKERS)
+    ap.add_argument("--parse-workers", type=int, default=sync_md.PARSE_WORKERS)
+    ap.add_argument("--max-retries", type=int, default=0,
+                    help="retries of a failed image, default: 0, so --error-rate is not hidden by backoff")
+    ap.add_argument("--output", default="bench_sync_md.json", help="path of the JSON results")
+    ap.add_argument("--baseline", default=None, help="path of JSON results of an earlier version to compare with")
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    runs, server_stats = bench(args)
+
+    baseline_runs = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            baseline_runs = json.load(baseline)["runs"]
+    print_runs(runs, baseline_runs)
+
+    results = {"version": get_version(),
+               "date": datetime.datetime.now().astimezone().isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "params": vars(args),
+               "server": server_stats,
+               "runs": runs}
+    with open(args.output, mode="w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2)
+    print(f"\nresults are written to `{args.output}`")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark `ImageUrlFilter.is_ok` against rule sets of growing size.
+
+The compiled filter walks each URL once through a prefix trie of the literal rules
+and matches one combined regex of the `r=` rules,
+compared with the reference scan, which matches every rule in reverse for every URL.
+Repeated URLs are served by the LRU cache of the filter.
+
+usage::
+
+    python -m benchmark.bench_url_filter
+    python -m benchmark.bench_url_filter --sizes 10 100 1000 --urls 20000 --distinct-urls 5000
+"""
+import argparse
+import logging
+import random
+import re
+import timeit
+
+from url_filter import ImageUrlFilter
+
+
+def generate_rules(size):
+    rules = []
+    for i in range(size):
+        host = f"https://host{i % 50}.example.com/"
+        kind = random.random()
+        if kind < 0.6:
+            rule = f"{host}{i}/"
+        elif kind < 0.8:
+            rule = "r=" + re.escape(host) + rf"{i}-\w+\.png"
+        else:
+            rule = f"{host}{i}"
+        if random.random() < 0.4:
+            rule = "!" + rule
+        rules.append(rule)
+
+    return rules
+
+
+def generate_urls(rule_size, distinct_urls, urls):
+    distinct = [f"https://host{random.randrange(50)}.example.com/{random.randrange(max(rule_size, 1))}"
+                f"{random.choice(['/', '-', ''])}{n}.png"
+                for n in range(distinct_urls)]
+    return random.choices(distinct, k=urls)
+
+
+def reference_is_ok(url_filter: ImageUrlFilter, url):
+    if not url_filter.rules:
+        return True
+
+    for rule in url_filter.rules[::-1]:
+        if ImageUrlFilter.match(url, rule.pattern, rule.is_regexp):
+            return rule.is_positive
+
+    return not any(rule.is_positive for rule in url_filter.rules)
+
+
+def bench(size, distinct_urls, urls):
+    rules = generate_rules(size)
+    samples = generate_urls(size, distinct_urls, urls)
+
+    compile_start = timeit.default_timer()
+    url_filter = ImageUrlFilter(rules)
+    compile_time = timeit.default_timer() - compile_start
+
+    reference_start = timeit.default_timer()
+    expected = [reference_is_ok(url_filter, url) for url in samples]
+    reference_time = timeit.default_timer() - reference_start
+
+    compiled_start = timeit.default_timer()
+    actual = [url_filter.is_ok(url) for url in samples]
+    compiled_time = timeit.default_timer() - compiled_start
+
+    if actual != expected:
+        raise AssertionError(f"compiled filter differs from the reference scan with {size} rules")
+
+    return compile_time, reference_time / urls, compiled_time / urls
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark ImageUrlFilter.is_ok")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 2_000],
+                    help="numbers of rules in the generated filters")
+    ap.add_argument("--urls", type=int, default=20_000, help="URLs checked per filter")
+    ap.add_argument("--distinct-urls", type=int, default=5_000, help="distinct URLs among the checked URLs")
+    args = ap.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(0)
+
+    print(f"{'rules':>8} {'compile (ms)':>13} {'reference (us)':>15} {'compiled (us)':>14} {'speedup':>8}")
+    for size in args.sizes:
+        compile_time, reference_time, compiled_time = bench(size, args.distinct_urls, args.urls)
+        print(f"{size:>8} {compile_time * 1_000:>13.2f} {reference_time * 1_000_000:>15.2f} "
+              f"{compiled_time * 1_000_000:>14.2f} {reference_time / compiled_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+A local image server for benchmarks, with tunable latency, error rate and bandwidth.
+
+Every path is an image of `body_size` bytes, whose first bytes depend on the path,
+so images of different URLs have different contents.
+"""
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+IMAGE_CHUNK_SIZE = 16 * 1024
+
+
+class ImageServer(ThreadingHTTPServer):
+    """
+    `connect_latency` seconds are added to every new connection (a stand-in for the TCP+TLS handshake)
+    and `request_latency` seconds to every request.
+    A share `error_rate` of the requests fail with `503 Service Unavailable`,
+    and bodies are sent at most at `bandwidth` bytes per second per connection if it is given.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, body_size, connect_latency=0.0, request_latency=0.0, error_rate=0.0, bandwidth=None,
+                 seed=0):
+        self.body_size = body_size
+        self.connect_latency = connect_latency
+        self.request_latency = request_latency
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.connection_amount = 0
+        self.request_amount = 0
+        self.error_amount = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def get_body(self, path):
+        digest = hashlib.blake2b(path.encode("utf-8")).digest()
+        return (digest + b"\0" * self.body_size)[:self.body_size]
+
+    def is_error(self):
+        with self._lock:
+            self.request_amount += 1
+            is_error = self._random.random() < self.error_rate
+            self.error_amount += int(is_error)
+            return is_error
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, e_type, e_value, traceback):
+        self.stop()
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one segment, otherwise Nagle's algorithm stalls keep-alive responses
+    wbufsize = 64 * 1024
+    server: ImageServer
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connection_amount += 1
+        time.sleep(self.server.connect_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.request_latency)
+        if self.server.is_error():
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = self.server.get_body(self.path)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.bandwidth is None:
+            self.wfile.write(body)
+            return
+
+        for i in range(0, len(body), IMAGE_CHUNK_SIZE):
+            chunk = body[i:i + IMAGE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(len(chunk) / self.server.bandwidth)
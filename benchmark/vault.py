@@ -0,0 +1,55 @@
+"""
+Generate synthetic vaults, i.e. markdown directories, for benchmarks.
+"""
+import os
+import random
+
+NOTE_TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore.\n"
+
+
+def generate_vault(md_dir_path, base_url, notes, images_per_note, duplicate_ratio=0.0, seed=0):
+    """
+    Write `notes` markdown files, each linking `images_per_note` images of `base_url`, into `md_dir_path`.
+    A share `duplicate_ratio` of the links use URLs shared by many notes, and the others use URLs of their own.
+    Return the names of the notes.
+    """
+    rng = random.Random(seed)
+    shared_img_urls = [f"{base_url}/shared/{i}.png" for i in range(max(1, images_per_note))]
+
+    os.makedirs(md_dir_path, exist_ok=True)
+    md_filenames = []
+    for i in range(notes):
+        md_filename = f"note-{i:06d}.md"
+        with open(f"{md_dir_path}/{md_filename}", mode="w", encoding="utf-8") as md:
+            md.write(f"# Note {i}\n\n")
+            for j in range(images_per_note):
+                if rng.random() < duplicate_ratio:
+                    img_url = rng.choice(shared_img_urls)
+                else:
+                    img_url = f"{base_url}/img/{i}-{j}.png"
+                md.write(NOTE_TEXT * rng.randint(1, 5))
+                md.write(f"![image {j}]({img_url} \"title {j}\")\n\n")
+
+        md_filenames.append(md_filename)
+
+    return md_filenames
+
+
+def modify_vault(md_dir_path, base_url, md_filenames, changed_ratio, seed=1):
+    """
+    Append a paragraph with a new image link to a share `changed_ratio` of `md_filenames`,
+    and move their mtime forward, as if they were edited after the last sync.
+    Return the names of the changed notes.
+    """
+    rng = random.Random(seed)
+    changed_md_filenames = sorted(rng.sample(md_filenames, round(len(md_filenames) * changed_ratio)))
+    for md_filename in changed_md_filenames:
+        md_path = f"{md_dir_path}/{md_filename}"
+        with open(md_path, mode="a", encoding="utf-8") as md:
+            md.write(NOTE_TEXT)
+            md.write(f"![changed]({base_url}/changed/{os.path.splitext(md_filename)[0]}.png)\n")
+
+        md_stat = os.stat(md_path)
+        os.utime(md_path, ns=(md_stat.st_atime_ns, md_stat.st_mtime_ns + 1_000_000_000))
+
+    return changed_md_filenames
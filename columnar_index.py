@@ -0,0 +1,141 @@
+import csv
+import logging
+from array import array
+
+from sync_index import CsvIndexBackend, ImgIndexReader, ImgIndexRecord, img_index_record_to_img_index_raw_record
+
+NONE_SIZE = -1
+
+
+class StringTable:
+    """
+    Strings stored once each and referenced by int ids, for a column with few distinct values.
+    The id of `None` is 0.
+    """
+
+    def __init__(self):
+        self.strings = [None]
+        self._ids = {None: 0}
+
+    def get_id(self, string):
+        string_id = self._ids.get(string)
+        if string_id is None:
+            self._ids[string] = string_id = len(self.strings)
+            self.strings.append(string)
+
+        return string_id
+
+    def find_id(self, string):
+        return self._ids.get(string)
+
+
+class StringColumn:
+    """
+    Strings packed as UTF-8 into one buffer with their end offsets, instead of one `str` object each,
+    for a column with mostly distinct values. `None` is read as an empty string, as in a csv file.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._ends = array("Q")
+
+    def __len__(self):
+        return len(self._ends)
+
+    def append(self, string):
+        if string:
+            self._data += string.encode("utf-8")
+        self._ends.append(len(self._data))
+
+    def __getitem__(self, i):
+        start = self._ends[i - 1] if i > 0 else 0
+        end = self._ends[i]
+        return self._data[start:end].decode("utf-8") if end > start else ""
+
+
+def _optional_size(value):
+    return int(value) if value else NONE_SIZE
+
+
+class ColumnarImgIndexReader(ImgIndexReader):
+    """
+    `ImgIndexReader` keeping the image index as columns instead of one `ImgIndexRecord` per image.
+
+    Markdown file names and `LastModified` are ids into string tables, `IsDownloaded` is a byte per image,
+    sizes are arrays of 64-bit ints, where -1 is `None`, and the other strings are packed in string columns.
+    Records are built only when they are read, so every call returns new records,
+    which callers may modify without changing the index, and which are the same as read by `ImgIndexReader`,
+    e.g. an empty `ImageName` is an empty string while an empty `ETag` is `None`.
+    """
+
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self._md_filenames = StringTable()
+        self._rows_by_md_filename_id = {}
+        self._is_downloaded = bytearray()
+        self._img_urls = StringColumn()
+        self._img_names = StringColumn()
+        self._etags = StringColumn()
+        self._last_modifieds = StringTable()
+        self._last_modified_ids = array("I")
+        self._content_lengths = array("q")
+        self._local_sizes = array("q")
+
+    def __enter__(self):
+        logging.debug(f"open: {self.filepath}")
+        self._file = open(self.filepath, newline="", encoding="utf-8")
+        self._reader = csv.DictReader(self._file, quoting=csv.QUOTE_ALL)
+        self._load_columns()
+        return self
+
+    def _load_columns(self):
+        for row in self._reader:
+            md_filename_id = self._md_filenames.get_id(row["MdFileName"])
+            rows = self._rows_by_md_filename_id.get(md_filename_id)
+            if rows is None:
+                self._rows_by_md_filename_id[md_filename_id] = rows = array("I")
+
+            rows.append(len(self._img_urls))
+            self._is_downloaded.append(int(row["IsDownloaded"]))
+            self._img_urls.append(row["ImageUrl"])
+            self._img_names.append(row["ImageName"])
+            self._etags.append(row.get("ETag"))
+            self._last_modified_ids.append(self._last_modifieds.get_id(row.get("LastModified") or None))
+            self._content_lengths.append(_optional_size(row.get("ContentLength")))
+            self._local_sizes.append(_optional_size(row.get("LocalSize")))
+
+    def _get_record(self, md_filename, row):
+        content_length = self._content_lengths[row]
+        local_size = self._local_sizes[row]
+        return ImgIndexRecord(md_filename, bool(self._is_downloaded[row]), self._img_urls[row], self._img_names[row],
+                              self._etags[row] or None, self._last_modifieds.strings[self._last_modified_ids[row]],
+                              content_length if content_length != NONE_SIZE else None,
+                              local_size if local_size != NONE_SIZE else None)
+
+    def get_raw_records_by_md_filename(self, md_filename):
+        return [img_index_record_to_img_index_raw_record(r) for r in self.get_records_by_md_filename(md_filename)]
+
+    def get_records_by_md_filename(self, md_filename):
+        md_filename_id = self._md_filenames.find_id(md_filename)
+        rows = self._rows_by_md_filename_id.get(md_filename_id, ())
+        md_filename = self._md_filenames.strings[md_filename_id] if rows else md_filename
+        return [self._get_record(md_filename, row) for row in rows]
+
+    def list_md_filename(self):
+        return [self._md_filenames.strings[i] for i in self._rows_by_md_filename_id]
+
+    def list_record(self):
+        for md_filename_id, rows in self._rows_by_md_filename_id.items():
+            md_filename = self._md_filenames.strings[md_filename_id]
+            for row in rows:
+                yield self._get_record(md_filename, row)
+
+
+class ColumnarIndexBackend(CsvIndexBackend):
+    """
+    `CsvIndexBackend` reading image indexes with `ColumnarImgIndexReader`,
+    for image indexes of millions of images, at the cost of building records on every read.
+    """
+
+    def img_index_reader(self, img_index_path) -> ColumnarImgIndexReader:
+        return ColumnarImgIndexReader(img_index_path)
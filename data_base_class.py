@@ -1,5 +1,22 @@
 class DataPrintable:
+    # subclasses may declare `__slots__` to drop the per-instance `__dict__` of many small records
+    __slots__ = ()
+
     def __str__(self):
         return f"<{self.__class__.__name__}\n" \
-               f"    {str(self.__dict__)}\n" \
+               f"    {str(get_fields(self))}\n" \
                f">"
+
+
+def get_fields(obj):
+    """
+    Return the attributes of an object as a dict, from its `__slots__` and its `__dict__` if it has one.
+    """
+    fields = {}
+    for cls in reversed(type(obj).__mro__):
+        for name in cls.__dict__.get("__slots__", ()):
+            if name not in ("__dict__", "__weakref__") and hasattr(obj, name):
+                fields[name] = getattr(obj, name)
+
+    fields.update(getattr(obj, "__dict__", {}))
+    return fields
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import time
+
+from downloader import DownloadResult
+
+JOURNAL_BATCH_SIZE = 64  # completions written between fsyncs
+JOURNAL_SYNC_INTERVAL = 1.0  # unit: second
+
+
+def read_download_journal(journal_path):
+    """
+    Return the completions of a journal, mapping each image URL to its image path and `DownloadResult`.
+    A torn last line, written when the process was killed, is skipped.
+    """
+    completed = {}
+    if not os.path.isfile(journal_path):
+        return completed
+
+    with open(journal_path, mode="r", newline="\n", encoding="utf-8") as journal:
+        for line_number, line in enumerate(journal, 1):
+            try:
+                entry = json.loads(line)
+                completed[entry["img_url"]] = (entry["img_path"], DownloadResult(**entry["result"]))
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f"skip line {line_number} of the download journal `{journal_path}`: {e!r}")
+
+    return completed
+
+
+class DownloadJournal:
+    """
+    Append-only journal of the images downloaded in a sync, one JSON line per image URL,
+    which is written at once and fsynced every `batch_size` completions or `sync_interval` seconds,
+    and when it is closed.
+
+    The journal of an interrupted sync is read into `completed` with `resume=True` and appended to,
+    so the sync can skip the images it already downloaded.
+    Image paths are relative to the directory of the synced markdown files.
+    """
+
+    def __init__(self, journal_path, resume=False, batch_size=JOURNAL_BATCH_SIZE,
+                 sync_interval=JOURNAL_SYNC_INTERVAL):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self.is_resumed = resume
+        self.completed = read_download_journal(journal_path) if resume else {}
+        self._journal = open(journal_path, mode="a" if resume else "w", newline="\n", encoding="utf-8")
+        self._pending_amount = 0
+        self._synced_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        self.close()
+
+    def append(self, img_url, img_path, result: DownloadResult):
+        entry = {"img_url": img_url, "img_path": img_path, "result": vars(result)}
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        # a killed process loses nothing flushed to the OS, only a crash of the OS loses what is not fsynced
+        self._journal.flush()
+        self._pending_amount += 1
+        if self._pending_amount >= self.batch_size or time.monotonic() - self._synced_at >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._pending_amount > 0:
+            os.fsync(self._journal.fileno())
+            self._pending_amount = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        if not self._journal.closed:
+            self.sync()
+            self._journal.close()
+
+    def remove(self):
+        """
+        Close and remove the journal once the sync is complete and its results are in the indexes.
+        """
+        self.close()
+        os.remove(self.journal_path)
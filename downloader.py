@@ -0,0 +1,547 @@
+import json
+import logging
+import os
+import re
+import random
+import shutil
+import socket
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.client import HTTPConnection, HTTPResponse, HTTPSConnection, IncompleteRead
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import HTTPHandler, HTTPSHandler, OpenerDirector, Request, build_opener
+
+from data_base_class import DataPrintable
+
+IMG_BUF_SIZE = 64 * 1024  # unit: byte
+
+CONNECT_TIMEOUT = 10  # unit: second
+READ_TIMEOUT = 30  # unit: second
+MAX_RETRIES = 3
+
+# responses worth retrying, i.e. Request Timeout, Too Early, Too Many Requests and temporary server errors
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+PART_SUFFIX = ".part"
+PART_META_SUFFIX = ".part.meta"
+CONTENT_RANGE_PATTERN = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)", re.IGNORECASE)
+
+
+class PartialContentError(Exception):
+    """
+    A part file cannot be resumed by the response, so it is discarded and the download restarts from byte zero.
+    """
+    pass
+
+
+# errors of timeouts, dropped connections and part files which cannot be resumed
+RETRYABLE_ERRORS = (socket.timeout, TimeoutError, ConnectionError, IncompleteRead, PartialContentError)
+
+
+class DownloadResult(DataPrintable):
+    """
+    Result of downloading an image, with the HTTP validators and sizes to re-fetch it conditionally next time.
+    `status` is 304 if the local image is still valid and nothing is written.
+    `attempts` counts the requests including retries, and `error` is the class name of the last error if it failed.
+    `elapsed` is the seconds taken by the last request, from sending it to receiving the whole body.
+    """
+
+    def __init__(self, ok, status=None, etag=None, last_modified=None, content_length: int = None,
+                 local_size: int = None, attempts=1, error=None, elapsed: float = None):
+        self.ok = ok
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_length = content_length
+        self.local_size = local_size
+        self.attempts = attempts
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def is_not_modified(self):
+        return self.status == 304
+
+
+class DownloadTask(DataPrintable):
+    def __init__(self, md_filename, img_url, img_path, cached: DownloadResult = None):
+        self.md_filename = md_filename
+        self.img_url = img_url
+        self.img_path = img_path
+        # the result of a previous download of `img_url` whose image is at `img_path`
+        self.cached = cached
+
+
+class RetryPolicy(DataPrintable):
+    """
+    Retry a download failed by a transient error at most `max_retries` times.
+
+    Before the n-th retry, wait for a random time in [0, min(backoff_max, backoff_base * 2 ** (n - 1))),
+    i.e. the exponential backoff with full jitter,
+    or for the `Retry-After` of the response if any, up to `backoff_max`.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff_base=0.5, backoff_max=60.0):  # unit: second
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def get_delay(self, retry, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retry - 1)))
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait by a `Retry-After` header, which is either seconds or an HTTP date,
+    or None if it is missing or invalid.
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_after(e: Exception):
+    headers = getattr(e, "headers", None)
+    if not headers:
+        return None
+
+    return parse_retry_after(headers.get("Retry-After") or headers.get("retry-after"))
+
+
+def is_retryable_error(e: Exception, retryable_errors=RETRYABLE_ERRORS):
+    """
+    Whether a download failed by a transient error,
+    i.e. a timeout, a dropped connection or a response with `RETRY_STATUSES`.
+    """
+    code = getattr(e, "code", None)
+    if code is not None:
+        return code in RETRY_STATUSES
+
+    if isinstance(e, URLError):
+        e = e.reason
+
+    return isinstance(e, retryable_errors)
+
+
+def get_error_class(e: Exception):
+    if isinstance(e, URLError) and not isinstance(e, HTTPError) and isinstance(e.reason, BaseException):
+        e = e.reason
+
+    return e.__class__.__name__
+
+
+def get_failed_result(e: Exception, attempts):
+    return DownloadResult(False, getattr(e, "code", None), attempts=attempts, error=get_error_class(e))
+
+
+def get_host(url):
+    return urlsplit(url).netloc.lower()
+
+
+def get_conditional_headers(img_path, cached: DownloadResult = None):
+    """
+    Return `If-None-Match` / `If-Modified-Since` headers
+    if the image previously downloaded is still at `img_path` with its original size.
+    """
+    headers = {}
+    if cached is None or not os.path.isfile(img_path):
+        return headers
+    if cached.local_size is not None and os.path.getsize(img_path) != cached.local_size:
+        return headers
+
+    if cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    return headers
+
+
+def discard_stale_image(img_path, cached: DownloadResult = None):
+    """
+    Remove the image previously downloaded to `img_path` once re-fetching it has failed, as it may be stale.
+    The image can be a hardlink to the image of another markdown file, which is kept.
+    """
+    if cached is not None and os.path.lexists(img_path):
+        logging.info("Remove the stale image `%s`", img_path)
+        os.remove(img_path)
+
+
+def get_not_modified_result(cached: DownloadResult, etag=None, last_modified=None):
+    return DownloadResult(True, 304,
+                          etag or cached.etag,
+                          last_modified or cached.last_modified,
+                          cached.content_length,
+                          cached.local_size)
+
+
+class PartialImage:
+    """
+    An image downloaded to `<img_path>.part`, which is renamed to `img_path` once complete,
+    so `img_path` is never a truncated image.
+
+    If the server advertises `Accept-Ranges: bytes` with a strong ETag or a Last-Modified,
+    the part file is kept on failure along with the validator in `<img_path>.part.meta`,
+    and the next download, in this run or a later one, resumes it with `Range` and `If-Range`.
+    """
+
+    def __init__(self, img_url, img_path):
+        self.img_url = img_url
+        self.img_path = img_path
+        self.part_path = f"{img_path}{PART_SUFFIX}"
+        self.meta_path = f"{img_path}{PART_META_SUFFIX}"
+        self.resume_from = 0
+        self.content_length = None
+
+    def _read_validator(self):
+        try:
+            with open(self.meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(meta, dict) or meta.get("url") != self.img_url:
+            return None
+
+        return meta.get("validator")
+
+    def get_range_headers(self):
+        """
+        Return `Range` / `If-Range` headers to resume the part file if it is resumable.
+        """
+        self.resume_from = 0
+        validator = self._read_validator()
+        if not validator or not os.path.isfile(self.part_path):
+            return {}
+
+        self.resume_from = os.path.getsize(self.part_path)
+        if self.resume_from == 0:
+            return {}
+
+        logging.debug("Resume `%s` from byte %d", self.img_url, self.resume_from)
+        return {"Range": f"bytes={self.resume_from}-", "If-Range": validator}
+
+    def open(self, status, headers):
+        """
+        Open the part file to write the body of a response,
+        appending to it for a `206 Partial Content` response.
+
+        Header names are looked up in lowercase,
+        which works for both `http.client.HTTPMessage` and dicts of lowercase names.
+        """
+        if status == 206:
+            match = CONTENT_RANGE_PATTERN.fullmatch((headers.get("content-range") or "").strip())
+            if match is None or int(match.group(1)) != self.resume_from:
+                self.discard()
+                raise PartialContentError(f"unexpected Content-Range `{headers.get('content-range')}`")
+
+            total = match.group(3)
+            self.content_length = int(total) if total.isdigit() else None
+            return open(self.part_path, "ab")
+
+        content_length = headers.get("content-length")
+        self.content_length = int(content_length) if content_length and content_length.isdigit() else None
+
+        etag = headers.get("etag")
+        validator = etag if etag and not etag.startswith("W/") else headers.get("last-modified")
+        if validator and "bytes" in (headers.get("accept-ranges") or "").lower():
+            with open(self.meta_path, "w", encoding="utf-8") as meta_file:
+                json.dump({"url": self.img_url, "validator": validator}, meta_file)
+        elif os.path.lexists(self.meta_path):
+            os.remove(self.meta_path)
+
+        self.resume_from = 0
+        return open(self.part_path, "wb")
+
+    def commit(self):
+        """
+        Rename the complete part file to the image.
+        The image can be a hardlink to another image, so it is replaced instead of overwritten.
+        Return the size of the image.
+
+        Raise `IncompleteRead` if the part file is shorter than the content length,
+        as `HTTPResponse.read` returns the truncated body of a dropped connection without an error.
+        """
+        size = os.path.getsize(self.part_path)
+        if self.content_length is not None and size != self.content_length:
+            self.abort()
+            raise IncompleteRead(b"", self.content_length - size)
+
+        os.replace(self.part_path, self.img_path)
+        if os.path.lexists(self.meta_path):
+            os.remove(self.meta_path)
+
+        return size
+
+    def abort(self):
+        """
+        Keep the part file of a failed download if it is resumable, otherwise remove it.
+        """
+        if not os.path.isfile(self.meta_path):
+            self.discard()
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.lexists(path):
+                os.remove(path)
+
+
+def link_or_copy_image(src_path, dst_path):
+    """
+    Materialize a downloaded image at another path,
+    as a hardlink if the file system supports it, otherwise as a copy.
+    """
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copyfile(src_path, dst_path)
+
+
+class ReadTimeoutConnectionMixin:
+    """
+    Connection whose socket timeout is `timeout` while connecting and `read_timeout` once connected,
+    as `urlopen` has one timeout for both.
+    """
+
+    def __init__(self, *args, read_timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        if self.read_timeout is not None:
+            self.sock.settimeout(self.read_timeout)
+
+
+class ReadTimeoutHTTPConnection(ReadTimeoutConnectionMixin, HTTPConnection):
+    pass
+
+
+class ReadTimeoutHTTPSConnection(ReadTimeoutConnectionMixin, HTTPSConnection):
+    pass
+
+
+class ReadTimeoutHTTPHandler(HTTPHandler):
+    def __init__(self, read_timeout):
+        super().__init__()
+        self.read_timeout = read_timeout
+
+    def http_open(self, req):
+        return self.do_open(ReadTimeoutHTTPConnection, req, read_timeout=self.read_timeout)
+
+
+class ReadTimeoutHTTPSHandler(HTTPSHandler):
+    def __init__(self, read_timeout):
+        super().__init__()
+        self.read_timeout = read_timeout
+
+    def https_open(self, req):
+        return self.do_open(ReadTimeoutHTTPSConnection, req, context=self._context, read_timeout=self.read_timeout)
+
+
+def build_image_opener(read_timeout=READ_TIMEOUT) -> OpenerDirector:
+    return build_opener(ReadTimeoutHTTPHandler(read_timeout), ReadTimeoutHTTPSHandler(read_timeout))
+
+
+def fetch_image(opener: OpenerDirector, img_url, img_path, cached: DownloadResult = None,
+                connect_timeout=CONNECT_TIMEOUT):
+    """
+    Download an image once, and raise the error if it fails.
+    """
+    partial_image = PartialImage(img_url, img_path)
+    range_headers = partial_image.get_range_headers()
+    # a resumable part file means the image is modified, so the image is not re-fetched conditionally
+    conditional_headers = get_conditional_headers(img_path, cached) if not range_headers else {}
+    headers = {"User-Agent": ""}
+    headers.update(conditional_headers)
+    headers.update(range_headers)
+    req = Request(img_url, None, headers)
+
+    try:
+        response: HTTPResponse = opener.open(req, timeout=connect_timeout)
+    except HTTPError as e:
+        if e.code == 304 and conditional_headers:
+            e.close()
+            logging.debug("Not Modified: `%s`", img_url)
+            return get_not_modified_result(cached, e.headers.get("ETag"), e.headers.get("Last-Modified"))
+        if e.code == 416 and range_headers:
+            e.close()
+            partial_image.discard()
+            raise PartialContentError(f"Range Not Satisfiable `{range_headers['Range']}`")
+        raise
+
+    with response:
+        try:
+            with partial_image.open(response.status, response.headers) as img:
+                while True:
+                    buf = response.read(IMG_BUF_SIZE)
+                    if len(buf) == 0:
+                        break
+                    img.write(buf)
+        except Exception:
+            partial_image.abort()
+            raise
+
+    local_size = partial_image.commit()
+    return DownloadResult(True, response.status,
+                          response.headers.get("ETag"),
+                          response.headers.get("Last-Modified"),
+                          partial_image.content_length,
+                          local_size)
+
+
+def download_image(img_url, img_path, cached: DownloadResult = None, retry_policy: RetryPolicy = None,
+                   opener: OpenerDirector = None, connect_timeout=CONNECT_TIMEOUT):
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    opener = opener if opener is not None else build_image_opener()
+
+    attempts = 0
+    while True:
+        attempts += 1
+        started_at = time.monotonic()
+        try:
+            result = fetch_image(opener, img_url, img_path, cached, connect_timeout)
+
+        except Exception as e:
+            if attempts <= retry_policy.max_retries and is_retryable_error(e):
+                delay = retry_policy.get_delay(attempts, get_retry_after(e))
+                logging.info("Retry %d/%d in %.1fs after %s: `%s`",
+                             attempts, retry_policy.max_retries, delay, get_error_class(e), img_url)
+                time.sleep(delay)
+                continue
+
+            if isinstance(e, HTTPError):
+                logging.info("HTTP Error: %s  `%s`", e.code, img_url)
+            elif isinstance(e, URLError):
+                logging.info("We failed to reach a server: `%s`\n    Reason: %s", img_url, e.reason)
+            elif isinstance(e, RETRYABLE_ERRORS):
+                logging.info("We failed to reach a server: `%s`\n    Reason: %r", img_url, e)
+            else:
+                logging.error("\nException download image: `%s`\n", img_url, exc_info=e)
+            discard_stale_image(img_path, cached)
+            result = get_failed_result(e, attempts)
+            result.elapsed = time.monotonic() - started_at
+            return result
+
+        result.attempts = attempts
+        result.elapsed = time.monotonic() - started_at
+        return result
+
+
+class HostLimitedScheduler:
+    """
+    Run download tasks of single images on a thread pool.
+
+    Tasks are queued per host and dispatched round-robin across hosts,
+    so at most `max_workers` tasks run at a time
+    and at most `host_limits[host]` (or `default_host_limit`) of them target the same host.
+    Tasks run on `executor` if it is given, which is kept open between runs, or on a new thread pool per run.
+    """
+
+    def __init__(self, max_workers, host_limits: dict = None, default_host_limit=None,
+                 executor: ThreadPoolExecutor = None):
+        self.max_workers = max_workers
+        self.host_limits = host_limits if host_limits is not None else {}
+        self.default_host_limit = default_host_limit if default_host_limit is not None else max_workers
+        self.executor = executor
+
+    def get_host_limit(self, host):
+        return max(1, self.host_limits.get(host, self.default_host_limit))
+
+    def run(self, tasks, fn):
+        """
+        Call `fn(task)` for every task and yield `(task, result)` in completion order.
+        A task whose `fn` raises yields the exception as its result.
+        """
+        pending_by_host = {}
+        for task in tasks:
+            host = get_host(task.img_url)
+            pending = pending_by_host.get(host)
+            if pending is None:
+                pending_by_host[host] = pending = deque()
+            pending.append(task)
+
+        running_by_host = dict.fromkeys(pending_by_host, 0)
+        hosts = deque(pending_by_host)
+
+        with nullcontext(self.executor) if self.executor is not None \
+                else ThreadPoolExecutor(self.max_workers) as executor:
+            futures = {}
+
+            while hosts or futures:
+                # round-robin over hosts with pending tasks until every worker is busy
+                skipped = 0
+                while hosts and len(futures) < self.max_workers and skipped < len(hosts):
+                    host = hosts[0]
+                    hosts.rotate(-1)
+                    if running_by_host[host] >= self.get_host_limit(host):
+                        skipped += 1
+                        continue
+
+                    skipped = 0
+                    task = pending_by_host[host].popleft()
+                    if not pending_by_host[host]:
+                        hosts.remove(host)
+
+                    running_by_host[host] += 1
+                    futures[executor.submit(fn, task)] = (host, task)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, task = futures.pop(future)
+                    running_by_host[host] -= 1
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+                    yield task, result
+
+
+class ThreadDownloadEngine:
+    """
+    Download engine running `download_image` on a `HostLimitedScheduler`,
+    one blocking `urlopen` per image.
+    A retry waits on its worker, which keeps backing off the same host.
+    The workers are threads of `executor` if it is given, which stay alive between runs.
+    """
+
+    def __init__(self, max_workers, host_limits: dict = None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retry_policy: RetryPolicy = None, executor: ThreadPoolExecutor = None):
+        self.scheduler = HostLimitedScheduler(max_workers, host_limits, executor=executor)
+        self.connect_timeout = connect_timeout
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.opener = build_image_opener(read_timeout)
+
+    def run(self, tasks):
+        """
+        Download every task and yield `(task, result)` in completion order.
+        The result is a `DownloadResult`, or the exception raised.
+        """
+        yield from self.scheduler.run(tasks, lambda t: download_image(t.img_url, t.img_path, t.cached,
+                                                                     self.retry_policy, self.opener,
+                                                                     self.connect_timeout))
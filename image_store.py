@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import os
+
+from downloader import IMG_BUF_SIZE
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(IMG_BUF_SIZE)
+            if len(buf) == 0:
+                break
+            h.update(buf)
+
+    return h.hexdigest()
+
+
+class ImageStore:
+    """
+    Content-addressed store of downloaded images.
+
+    Every image is stored once as `<store_dir>/<hash[:2]>/<hash>`,
+    and each image path of a markdown file is a hardlink to it,
+    so identical images cost one file on disk no matter how many URLs or markdown files use them.
+    """
+
+    def __init__(self, store_dir_path):
+        self.store_dir_path = store_dir_path
+        os.makedirs(store_dir_path, exist_ok=True)
+
+    def get_blob_path(self, digest):
+        return f"{self.store_dir_path}/{digest[:2]}/{digest}"
+
+    def add(self, img_path):
+        """
+        Move a downloaded image into the store and replace it with a hardlink to the stored blob.
+        If the same content is already stored, the image is replaced with a hardlink to the existing blob.
+        Return the blob path.
+        """
+        blob_path = self.get_blob_path(hash_file(img_path))
+
+        if os.path.exists(blob_path):
+            if not os.path.samefile(img_path, blob_path):
+                tmp_path = f"{img_path}.link"
+                os.link(blob_path, tmp_path)
+                os.replace(tmp_path, img_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.link(img_path, blob_path)
+
+        return blob_path
+
+    def list_blob_path(self):
+        with os.scandir(self.store_dir_path) as sub_dirs:
+            for sub_dir in sub_dirs:
+                if not sub_dir.is_dir():
+                    continue
+                with os.scandir(sub_dir.path) as blobs:
+                    for blob in blobs:
+                        if blob.is_file():
+                            yield blob
+
+    def collect_garbage(self, referenced_img_paths):
+        """
+        Remove blobs which none of `referenced_img_paths` is a hardlink to.
+        Return the removed blob paths.
+        """
+        referenced_files = set()
+        for img_path in referenced_img_paths:
+            try:
+                st = os.stat(img_path)
+            except OSError:
+                continue
+            referenced_files.add((st.st_dev, st.st_ino))
+
+        removed_blob_paths = []
+        for blob in self.list_blob_path():
+            st = blob.stat()
+            if (st.st_dev, st.st_ino) not in referenced_files:
+                os.remove(blob.path)
+                removed_blob_paths.append(blob.path)
+
+        logging.debug(f"collect_garbage removed {len(removed_blob_paths)} blobs in `{self.store_dir_path}`")
+        return removed_blob_paths
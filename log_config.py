@@ -0,0 +1,109 @@
+import atexit
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import sys
+
+LOG_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/log"
+LOGGING_FORMAT = "%(asctime)s [%(processName)s] [%(threadName)s] [%(levelname)s] %(message)s"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_listener = None
+_queue_handler = None
+_worker_listener = None
+
+
+def setup_logging(log_name, level=logging.DEBUG, force=False):
+    """
+    Log to stdout and to `log/<log_name>.log`, which is truncated, at `level`.
+
+    Log records are put on a queue by the logging thread, and a `QueueListener` thread writes them,
+    so threads downloading images never wait for the terminal or the disk.
+    Like `logging.basicConfig`, logging is only set up once unless `force` is true,
+    and never in worker processes, which would truncate the log of the main process.
+    Modules never call it when they are imported, so it is up to the program, e.g. `sync_md.main`.
+    """
+    global _listener, _queue_handler
+    if multiprocessing.current_process().name != "MainProcess":
+        return
+    if _listener is not None and not force:
+        return
+
+    stop_logging()
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatter = logging.Formatter(LOGGING_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout), logging.FileHandler(f"{LOG_DIR}/{log_name}.log", "w", "utf-8")]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+
+
+def get_worker_log_queue():
+    """
+    Return the `multiprocessing` queue of log records from worker processes, or `None` if logging is not set up.
+
+    Worker processes inherit the `QueueHandler` of the main process, whose queue no thread reads in the worker,
+    so they log through `setup_worker_logging` to this queue instead,
+    and another `QueueListener` thread writes their records with the same handlers.
+    """
+    global _worker_listener
+    if _listener is None:
+        return None
+
+    if _worker_listener is None:
+        _worker_listener = logging.handlers.QueueListener(multiprocessing.Queue(), *_listener.handlers)
+        _worker_listener.start()
+
+    return _worker_listener.queue
+
+
+def setup_worker_logging(log_queue, level):
+    """
+    In a worker process, replace the handlers inherited from the main process
+    with a `QueueHandler` on `log_queue` returned by `get_worker_log_queue`.
+    """
+    if log_queue is None:
+        return
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+
+def stop_logging():
+    """
+    Remove the handler set up by `setup_logging` from the root logger,
+    write the queued log records, then stop the listeners and close their handlers.
+    """
+    global _listener, _queue_handler, _worker_listener
+    if _listener is None:
+        return
+
+    logging.getLogger().removeHandler(_queue_handler)
+    _queue_handler = None
+    if _worker_listener is not None:
+        _worker_listener.stop()
+        _worker_listener.queue.close()
+        _worker_listener = None
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+atexit.register(stop_logging)
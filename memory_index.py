@@ -0,0 +1,250 @@
+import copy
+import logging
+import os
+
+from sync_index import ImgIndexReader, ImgIndexRecord, ImgIndexWriter, MdIndexIsSynced, MdIndexReader, \
+    MdIndexRecord, MdIndexWriter, img_index_raw_record_to_img_index_record, md_index_raw_record_to_md_index_record, \
+    update_img_index_record_by_download_result
+
+
+class MemoryIndexBackend:
+    """
+    Index backend keeping all indexes in memory, for a long-running process such as `--watch`.
+
+    Each index is identified by its csv path, e.g. `output/index-markdown.csv`.
+    An index which is read but not in memory, such as the input `index-markdown.csv` in update mode,
+    is loaded from its csv file once.
+    Indexes written through this backend are exported to their csv files by `flush()`,
+    which only writes the indexes changed since the last flush, and by `close()`.
+
+    Records in memory are never modified in place; writers and status updates replace whole indexes,
+    so readers opened before keep a consistent view.
+    """
+
+    def __init__(self):
+        self._md_indexes = {}
+        self._img_indexes = {}
+        self._changed_paths = set()
+
+    def _get_md_index(self, path) -> dict:
+        path = os.path.abspath(path)
+        records = self._md_indexes.get(path)
+        if records is None:
+            logging.debug(f"load: {path}")
+            with MdIndexReader(path) as md_index:
+                records = {record.filename: record for record in md_index.list_record()}
+            self._md_indexes[path] = records
+
+        return records
+
+    def _get_img_index(self, path) -> dict:
+        path = os.path.abspath(path)
+        records_by_md_filename = self._img_indexes.get(path)
+        if records_by_md_filename is None:
+            logging.debug(f"load: {path}")
+            with ImgIndexReader(path) as img_index:
+                records_by_md_filename = {md_filename: img_index.get_records_by_md_filename(md_filename)
+                                          for md_filename in img_index.list_md_filename()}
+            self._img_indexes[path] = records_by_md_filename
+
+        return records_by_md_filename
+
+    def _set_md_index(self, path, records: dict):
+        path = os.path.abspath(path)
+        self._md_indexes[path] = records
+        self._changed_paths.add(path)
+
+    def _set_img_index(self, path, records_by_md_filename: dict):
+        path = os.path.abspath(path)
+        self._img_indexes[path] = records_by_md_filename
+        self._changed_paths.add(path)
+
+    def md_index_reader(self, md_index_path):
+        return MemoryMdIndexReader(self, md_index_path)
+
+    def md_index_writer(self, md_index_path):
+        return MemoryMdIndexWriter(self, md_index_path)
+
+    def img_index_reader(self, img_index_path):
+        return MemoryImgIndexReader(self, img_index_path)
+
+    def img_index_writer(self, img_index_path):
+        return MemoryImgIndexWriter(self, img_index_path)
+
+    def mark_is_downloaded(self, img_index_path, download_ok: dict, download_results: dict = None):
+        EMPTY_SET = set()
+        records_by_md_filename = {}
+        for md_filename, records in self._get_img_index(img_index_path).items():
+            img_urls = download_ok.get(md_filename, EMPTY_SET)
+            new_records = []
+            for record in records:
+                if record.img_url in img_urls:
+                    record = copy.copy(record)
+                    record.is_downloaded = True
+                    update_img_index_record_by_download_result(record, (download_results or {}).get(record.img_url))
+                new_records.append(record)
+            records_by_md_filename[md_filename] = new_records
+
+        self._set_img_index(img_index_path, records_by_md_filename)
+
+    def mark_is_synced(self, md_index_path, img_index: ImgIndexReader, md_filenames=None):
+        records = {}
+        for filename, record in self._get_md_index(md_index_path).items():
+            if record.is_synced != MdIndexIsSynced.Y \
+                    and (md_filenames is None or filename in md_filenames) \
+                    and all(r.is_downloaded for r in img_index.get_records_by_md_filename(filename)):
+                record = copy.copy(record)
+                record.is_synced = MdIndexIsSynced.Y
+            records[filename] = record
+
+        self._set_md_index(md_index_path, records)
+
+    def has_index(self, path):
+        """
+        Return whether an index is in memory, which may not be exported to its csv file yet.
+        """
+        path = os.path.abspath(path)
+        return path in self._md_indexes or path in self._img_indexes
+
+    def move_index(self, src_path, dst_path):
+        """
+        Move an index in memory to another path, like `os.replace` of its csv file.
+        """
+        src_path = os.path.abspath(src_path)
+        dst_path = os.path.abspath(dst_path)
+        for indexes in (self._md_indexes, self._img_indexes):
+            if src_path in indexes:
+                indexes[dst_path] = indexes.pop(src_path)
+                self._changed_paths.discard(src_path)
+                self._changed_paths.add(dst_path)
+
+    def retain(self, paths):
+        """
+        Drop the indexes other than `paths` from memory, unless they are not flushed yet.
+        A dropped index is loaded from its csv file again when it is read.
+        """
+        paths = {os.path.abspath(path) for path in paths}
+        for indexes in (self._md_indexes, self._img_indexes):
+            for path in list(indexes):
+                if path not in paths and path not in self._changed_paths:
+                    del indexes[path]
+
+    def flush(self):
+        """
+        Export the indexes changed since the last flush to their csv files.
+        """
+        for path in sorted(self._changed_paths):
+            logging.debug(f"export: {path}")
+            new_path = f"{path}.new"
+            if path in self._md_indexes:
+                with MdIndexWriter(new_path) as md_index:
+                    for record in self._md_indexes[path].values():
+                        md_index.create(record)
+            else:
+                with ImgIndexWriter(new_path) as img_index:
+                    for records in self._img_indexes[path].values():
+                        for record in records:
+                            img_index.create(record)
+            os.replace(new_path, path)
+
+        self._changed_paths.clear()
+
+    def close(self):
+        self.flush()
+
+
+class MemoryMdIndexWriter:
+
+    def __init__(self, backend: MemoryIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+        self._records = {}
+
+    def __enter__(self):
+        self._records = {}
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            self._backend._set_md_index(self.filepath, self._records)
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def create(self, record: MdIndexRecord):
+        self._records[record.filename] = copy.copy(record)
+
+    def create_by_raw_record(self, record):
+        self.create(md_index_raw_record_to_md_index_record(record))
+
+
+class MemoryMdIndexReader(MdIndexReader):
+    """
+    `MdIndexReader` over an index in memory, which returns copies of the records as well.
+    """
+
+    def __init__(self, backend: MemoryIndexBackend, filepath):
+        super().__init__(filepath)
+        self._backend = backend
+
+    def __enter__(self):
+        self._records = self._backend._get_md_index(self.filepath)
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if e_type:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+
+class MemoryImgIndexWriter:
+
+    def __init__(self, backend: MemoryIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+        self._records_by_md_filename = {}
+
+    def __enter__(self):
+        self._records_by_md_filename = {}
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            self._backend._set_img_index(self.filepath, self._records_by_md_filename)
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def create(self, record: ImgIndexRecord):
+        records = self._records_by_md_filename.get(record.md_filename)
+        if records is None:
+            self._records_by_md_filename[record.md_filename] = records = []
+
+        records.append(copy.copy(record))
+
+    def create_by_raw_records(self, raw_records):
+        for r in raw_records:
+            self.create(img_index_raw_record_to_img_index_record(r))
+
+
+class MemoryImgIndexReader(ImgIndexReader):
+    """
+    `ImgIndexReader` over an index in memory, whose records are shared read-only as well.
+    """
+
+    def __init__(self, backend: MemoryIndexBackend, filepath):
+        super().__init__(filepath)
+        self._backend = backend
+
+    def __enter__(self):
+        self._records_by_md_filename = self._backend._get_img_index(self.filepath)
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if e_type:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
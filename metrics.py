@@ -0,0 +1,161 @@
+import json
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+
+from downloader import get_host
+from profiler import StageProfiler
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+HOST_COUNTS = ("requests", "retries", "downloaded_images", "not_modified_images", "failed_images", "downloaded_bytes")
+
+
+def get_percentile(sorted_values, quantile):
+    """
+    Return the nearest-rank percentile of sorted values, or None if there are no values.
+    """
+    if not sorted_values:
+        return None
+
+    rank = max(math.ceil(quantile * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failed_images = 0
+        self.not_modified_images = 0
+        self.downloaded_images = 0
+        self.downloaded_bytes = 0
+        self.latencies = []
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+        elapsed = sum(latencies)
+        return {"requests": self.requests,
+                "retries": self.retries,
+                "downloaded_images": self.downloaded_images,
+                "not_modified_images": self.not_modified_images,
+                "failed_images": self.failed_images,
+                "downloaded_bytes": self.downloaded_bytes,
+                "bytes_per_second": self.downloaded_bytes / elapsed if elapsed > 0 else None,
+                "latency_seconds": {str(q): get_percentile(latencies, q) for q in LATENCY_QUANTILES}}
+
+
+class SyncMetrics:
+    """
+    Wall time of each stage of a sync, counters and per-host download statistics,
+    exported as `metrics.json`, and optionally in the Prometheus text format for the textfile collector.
+
+    Latencies are the seconds of the last request of each image, and their percentiles are nearest-rank.
+    Each stage is profiled by `profiler` as well if it is given.
+    """
+
+    def __init__(self, profiler: StageProfiler = None):
+        self.profiler = profiler
+        self.started_at = time.time()
+        self._started_perf_counter = time.perf_counter()
+        self.stage_times = {}
+        self.counts = {}
+        self.hosts = {}
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.stage(name):
+                    yield
+        finally:
+            self.stage_times[name] = self.stage_times.get(name, 0.0) + time.perf_counter() - started_at
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def add_download_results(self, download_results: dict):
+        """
+        Add up `download_results`, mapping each image URL to its `DownloadResult`, per host and in total.
+        """
+        for img_url, result in download_results.items():
+            host_metrics = self.hosts.get(get_host(img_url))
+            if host_metrics is None:
+                self.hosts[get_host(img_url)] = host_metrics = HostMetrics()
+
+            host_metrics.requests += result.attempts
+            host_metrics.retries += result.attempts - 1
+            if result.elapsed is not None:
+                host_metrics.latencies.append(result.elapsed)
+
+            if not result.ok:
+                host_metrics.failed_images += 1
+            elif result.is_not_modified:
+                host_metrics.not_modified_images += 1
+            else:
+                host_metrics.downloaded_images += 1
+                host_metrics.downloaded_bytes += result.local_size or 0
+
+        for name in HOST_COUNTS:
+            self.counts[name] = sum(getattr(host_metrics, name) for host_metrics in self.hosts.values())
+
+    def to_dict(self):
+        return {"started_at": self.started_at,
+                "total_seconds": time.perf_counter() - self._started_perf_counter,
+                "stage_seconds": dict(self.stage_times),
+                "counts": dict(self.counts),
+                "hosts": {host: host_metrics.to_dict() for host, host_metrics in sorted(self.hosts.items())}}
+
+    def write_json(self, metrics_path):
+        with open(metrics_path, mode="w", newline="", encoding="utf-8") as metrics:
+            json.dump(self.to_dict(), metrics, indent=2)
+        logging.debug(f"write metrics: {metrics_path}")
+
+    def write_prometheus(self, textfile_path):
+        """
+        Write the metrics in the Prometheus text format through a temporary file,
+        so the textfile collector never reads a partial file.
+        """
+        lines = ["# HELP sync_md_last_run_timestamp_seconds Start time of the last sync.",
+                 "# TYPE sync_md_last_run_timestamp_seconds gauge",
+                 f"sync_md_last_run_timestamp_seconds {self.started_at}",
+                 "# HELP sync_md_stage_seconds Wall time of each stage of the last sync.",
+                 "# TYPE sync_md_stage_seconds gauge"]
+        for stage, seconds in self.stage_times.items():
+            lines.append(f"sync_md_stage_seconds{{stage=\"{escape_label_value(stage)}\"}} {seconds}")
+
+        for name, amount in self.counts.items():
+            lines.append(f"# TYPE sync_md_{name} gauge")
+            lines.append(f"sync_md_{name} {amount}")
+
+        for name in HOST_COUNTS:
+            lines.append(f"# TYPE sync_md_host_{name} gauge")
+            for host, host_metrics in sorted(self.hosts.items()):
+                lines.append(f"sync_md_host_{name}{{host=\"{escape_label_value(host)}\"}} "
+                             f"{getattr(host_metrics, name)}")
+
+        lines.append("# HELP sync_md_host_latency_seconds Seconds of the last request of each image per host.")
+        lines.append("# TYPE sync_md_host_latency_seconds summary")
+        for host, host_metrics in sorted(self.hosts.items()):
+            label = f"host=\"{escape_label_value(host)}\""
+            latencies = sorted(host_metrics.latencies)
+            for q in LATENCY_QUANTILES:
+                percentile = get_percentile(latencies, q)
+                lines.append(f"sync_md_host_latency_seconds{{{label},quantile=\"{q}\"}} "
+                             f"{percentile if percentile is not None else 'NaN'}")
+            lines.append(f"sync_md_host_latency_seconds_sum{{{label}}} {sum(latencies)}")
+            lines.append(f"sync_md_host_latency_seconds_count{{{label}}} {len(latencies)}")
+
+        new_textfile_path = f"{textfile_path}.new"
+        with open(new_textfile_path, mode="w", newline="\n", encoding="utf-8") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(new_textfile_path, textfile_path)
+        logging.debug(f"write metrics: {textfile_path}")
+
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,78 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_TOP = 25
+
+
+class StageProfiler:
+    """
+    Profile each stage of a sync with cProfile, and optionally trace its memory with tracemalloc,
+    writing `<stage>.prof`, which can be loaded by `pstats` or snakeviz, and a top-N report `<stage>.txt`
+    into `profile_dir_path`.
+
+    cProfile only sees the thread running the stages, so the time of worker threads and processes
+    shows as the time waiting for them, e.g. in `concurrent.futures` or `asyncio` calls.
+    A stage run more than once, e.g. in every sync of `--watch`, adds up in its `.prof` file,
+    and its memory report is of the last run.
+    """
+
+    def __init__(self, profile_dir_path, trace_memory=False, top=PROFILE_TOP):
+        self.profile_dir_path = profile_dir_path
+        self.trace_memory = trace_memory
+        self.top = top
+        self._profiles = {}
+        os.makedirs(profile_dir_path, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        profile = self._profiles.get(name)
+        if profile is None:
+            self._profiles[name] = profile = cProfile.Profile()
+
+        # tracemalloc is already tracing if the whole process runs with `python -X tracemalloc`
+        is_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if is_tracing:
+            tracemalloc.start()
+        memory_snapshot = None
+        memory_peak = None
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                if is_tracing:
+                    memory_snapshot = tracemalloc.take_snapshot()
+                    memory_peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            if is_tracing:
+                tracemalloc.stop()
+            self.write_report(name, profile, memory_snapshot, memory_peak)
+
+    def write_report(self, name, profile: cProfile.Profile, memory_snapshot: tracemalloc.Snapshot = None,
+                     memory_peak: int = None):
+        prof_path = f"{self.profile_dir_path}/{name}.prof"
+        profile.dump_stats(prof_path)
+
+        report = io.StringIO()
+        report.write(f"=== {name}: top {self.top} functions by cumulative time ===\n")
+        pstats.Stats(profile, stream=report).strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        report.write(f"=== {name}: top {self.top} functions by own time ===\n")
+        pstats.Stats(profile, stream=report).strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+
+        if memory_snapshot is not None:
+            report.write(f"=== {name}: memory ===\n")
+            report.write(f"peak traced memory: {memory_peak / 1024:.1f} KiB\n")
+            report.write(f"top {self.top} lines by memory allocated in the stage and still held at its end:\n")
+            for stat in memory_snapshot.statistics("lineno")[:self.top]:
+                report.write(f"{stat}\n")
+
+        report_path = f"{self.profile_dir_path}/{name}.txt"
+        with open(report_path, mode="w", newline="", encoding="utf-8") as f:
+            f.write(report.getvalue())
+        logging.debug(f"write profile: {prof_path}, {report_path}")
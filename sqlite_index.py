@@ -0,0 +1,422 @@
+import logging
+import os
+import sqlite3
+import threading
+
+from sync_index import IMG_INDEX_FIELD_NAMES, ImgIndexReader, ImgIndexRecord, ImgIndexWriter, MdIndexIsSynced, \
+    MdIndexReader, MdIndexRecord, MdIndexWriter, img_index_raw_record_to_img_index_record, \
+    md_index_raw_record_to_md_index_record, md_index_record_to_md_index_raw_record, \
+    update_img_index_record_by_download_result
+
+SQLITE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS index_file (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS md_index (
+    index_id INTEGER NOT NULL REFERENCES index_file (id),
+    FileName TEXT NOT NULL,
+    MdUrl TEXT,
+    ModifiedDate TEXT NOT NULL,
+    IsSynced INTEGER NOT NULL,
+    ContentHash TEXT
+);
+CREATE INDEX IF NOT EXISTS md_index_file_name ON md_index (index_id, FileName);
+
+CREATE TABLE IF NOT EXISTS img_index (
+    index_id INTEGER NOT NULL REFERENCES index_file (id),
+    MdFileName TEXT NOT NULL,
+    IsDownloaded INTEGER NOT NULL,
+    ImageUrl TEXT NOT NULL,
+    ImageName TEXT NOT NULL,
+    ETag TEXT,
+    LastModified TEXT,
+    ContentLength INTEGER,
+    LocalSize INTEGER
+);
+CREATE INDEX IF NOT EXISTS img_index_md_file_name ON img_index (index_id, MdFileName, ImageUrl);
+"""
+
+# columns appended to the tables after their first version, added to older databases on open
+SQLITE_INDEX_FILE_OPTIONAL_COLUMNS = {"mtime_ns": "INTEGER"}
+SQLITE_MD_INDEX_OPTIONAL_COLUMNS = {"ContentHash": "TEXT"}
+SQLITE_IMG_INDEX_OPTIONAL_COLUMNS = {"ETag": "TEXT", "LastModified": "TEXT",
+                                     "ContentLength": "INTEGER", "LocalSize": "INTEGER"}
+SQLITE_INSERT_MD_INDEX = "INSERT INTO md_index" \
+                         " (index_id, FileName, MdUrl, ModifiedDate, IsSynced, ContentHash)" \
+                         " VALUES (?, ?, ?, ?, ?, ?)"
+SQLITE_INSERT_IMG_INDEX = "INSERT INTO img_index" \
+                          " (index_id, MdFileName, IsDownloaded, ImageUrl, ImageName," \
+                          " ETag, LastModified, ContentLength, LocalSize)" \
+                          " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+class SqliteIndexBackend:
+    """
+    Index backend storing all indexes in a single SQLite database.
+
+    Each index is still identified by its csv path, e.g. `output/index-markdown.csv`.
+    An index which is read but not in the database, such as the input `index-markdown.csv` in update mode,
+    is imported from its csv file.
+    Every index changed through this backend is exported to its csv file by `close()`,
+    so the output files keep working as input of update mode.
+    The database is kept between runs, and an index is imported again only if its csv file is modified
+    after it was imported or exported last, e.g. by a run with another index backend.
+
+    Status updates are transactional and only touch changed rows.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._written_paths = {}
+
+        logging.debug(f"open: {self.db_path}")
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SQLITE_INDEX_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        for table, optional_columns in (("index_file", SQLITE_INDEX_FILE_OPTIONAL_COLUMNS),
+                                        ("md_index", SQLITE_MD_INDEX_OPTIONAL_COLUMNS),
+                                        ("img_index", SQLITE_IMG_INDEX_OPTIONAL_COLUMNS)):
+            columns = {row["name"] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in optional_columns.items():
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        self._conn.commit()
+
+    def _get_index_id(self, path, create=False):
+        path = os.path.abspath(path)
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM index_file WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                return row["id"]
+            if not create:
+                return None
+
+            cursor = self._conn.execute("INSERT INTO index_file (path) VALUES (?)", (path,))
+            return cursor.lastrowid
+
+    def _import_csv(self, path, index_table):
+        index_id = self._get_index_id(path, create=True)
+        logging.debug(f"import: {path}")
+
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {index_table} WHERE index_id = ?", (index_id,))
+            if index_table == "md_index":
+                with MdIndexReader(path) as md_index:
+                    self._conn.executemany(
+                        SQLITE_INSERT_MD_INDEX,
+                        (_md_index_raw_record_to_sqlite_row(index_id, r)
+                         for r in map(md_index_record_to_md_index_raw_record, md_index.list_record())))
+            else:
+                with ImgIndexReader(path) as img_index:
+                    self._conn.executemany(
+                        SQLITE_INSERT_IMG_INDEX,
+                        (_img_index_record_to_sqlite_row(index_id, r) for r in img_index.list_record()))
+            self._set_mtime_ns(index_id, path)
+
+        return index_id
+
+    def _set_mtime_ns(self, index_id, path):
+        self._conn.execute("UPDATE index_file SET mtime_ns = ? WHERE id = ?", (_get_mtime_ns(path), index_id))
+
+    def _open_index(self, path, index_table):
+        with self._lock:
+            row = self._conn.execute("SELECT id, mtime_ns FROM index_file WHERE path = ?",
+                                     (os.path.abspath(path),)).fetchone()
+            if row is not None:
+                mtime_ns = _get_mtime_ns(path)
+                # the rows are newer than a missing csv file, or one not exported by an interrupted run
+                if mtime_ns is None or mtime_ns == row["mtime_ns"]:
+                    return row["id"]
+
+            return self._import_csv(path, index_table)
+
+    def move_index(self, src_path, dst_path):
+        """
+        Move an index in the database to another path, like `os.replace` of its csv file.
+        """
+        src_path = os.path.abspath(src_path)
+        dst_path = os.path.abspath(dst_path)
+        with self._lock, self._conn:
+            dst_index_id = self._get_index_id(dst_path)
+            if dst_index_id is not None:
+                for table in ("md_index", "img_index"):
+                    self._conn.execute(f"DELETE FROM {table} WHERE index_id = ?", (dst_index_id,))
+                self._conn.execute("DELETE FROM index_file WHERE id = ?", (dst_index_id,))
+            self._conn.execute("UPDATE index_file SET path = ? WHERE path = ?", (dst_path, src_path))
+
+        self._written_paths.pop(dst_path, None)
+        if src_path in self._written_paths:
+            self._written_paths[dst_path] = self._written_paths.pop(src_path)
+
+    def execute(self, sql, parameters=()):
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    def md_index_reader(self, md_index_path):
+        return SqliteMdIndexReader(self, md_index_path)
+
+    def md_index_writer(self, md_index_path):
+        return SqliteMdIndexWriter(self, md_index_path)
+
+    def img_index_reader(self, img_index_path):
+        return SqliteImgIndexReader(self, img_index_path)
+
+    def img_index_writer(self, img_index_path):
+        return SqliteImgIndexWriter(self, img_index_path)
+
+    def mark_is_downloaded(self, img_index_path, download_ok: dict, download_results: dict = None):
+        index_id = self._open_index(img_index_path, "img_index")
+        download_results = download_results or {}
+
+        def parameters():
+            for md_filename, img_urls in download_ok.items():
+                for img_url in img_urls:
+                    record = ImgIndexRecord(md_filename, True, img_url, None)
+                    update_img_index_record_by_download_result(record, download_results.get(img_url))
+                    yield (record.etag, record.last_modified, record.content_length, record.local_size,
+                           index_id, md_filename, img_url)
+
+        with self._lock, self._conn:
+            cursor = self._conn.executemany(
+                "UPDATE img_index SET IsDownloaded = 1,"
+                " ETag = ?, LastModified = ?, ContentLength = ?, LocalSize = ?"
+                " WHERE index_id = ? AND MdFileName = ? AND ImageUrl = ? AND IsDownloaded = 0",
+                parameters())
+            # an index without any changed row is not exported again
+            if cursor.rowcount > 0:
+                self._written_paths[os.path.abspath(img_index_path)] = "img_index"
+
+    def mark_is_synced(self, md_index_path, img_index, md_filenames=None):
+        index_id = self._open_index(md_index_path, "md_index")
+
+        with self._lock, self._conn:
+            filename_condition = ""
+            if md_filenames is not None:
+                # the marked file names are joined in a temporary table instead of a long `IN (...)` list
+                self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS marked_md_filename (FileName TEXT PRIMARY KEY)")
+                self._conn.execute("DELETE FROM marked_md_filename")
+                self._conn.executemany("INSERT OR IGNORE INTO marked_md_filename VALUES (?)",
+                                       ((filename,) for filename in md_filenames))
+                filename_condition = " AND FileName IN (SELECT FileName FROM marked_md_filename)"
+
+            cursor = self._conn.execute(
+                "UPDATE md_index SET IsSynced = ?"
+                " WHERE index_id = ? AND IsSynced != ?"
+                " AND NOT EXISTS (SELECT 1 FROM img_index"
+                "                 WHERE img_index.index_id = ? AND img_index.MdFileName = md_index.FileName"
+                "                 AND img_index.IsDownloaded = 0)" + filename_condition,
+                (MdIndexIsSynced.Y.value, index_id, MdIndexIsSynced.Y.value, img_index.index_id))
+            if cursor.rowcount > 0:
+                self._written_paths[os.path.abspath(md_index_path)] = "md_index"
+
+    def export_csv(self, path, index_table):
+        index_id = self._get_index_id(path)
+        logging.debug(f"export: {path}")
+
+        if index_table == "md_index":
+            with MdIndexWriter(path) as md_index:
+                rows = self.execute("SELECT * FROM md_index WHERE index_id = ? ORDER BY rowid", (index_id,))
+                for row in rows:
+                    md_index.create_by_raw_record(_sqlite_row_to_md_index_raw_record(row))
+        else:
+            with ImgIndexWriter(path) as img_index:
+                rows = self.execute("SELECT * FROM img_index WHERE index_id = ? ORDER BY rowid", (index_id,))
+                img_index.create_by_raw_records(map(_sqlite_row_to_img_index_raw_record, rows))
+
+        with self._lock, self._conn:
+            self._set_mtime_ns(index_id, path)
+
+    def close(self):
+        for path, index_table in self._written_paths.items():
+            self.export_csv(path, index_table)
+
+        logging.debug(f"close: {self.db_path}")
+        self._conn.close()
+
+
+class SqliteMdIndexWriter:
+
+    def __init__(self, backend: SqliteIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+
+    def __enter__(self):
+        self.index_id = self._backend._get_index_id(self.filepath, create=True)
+        self._backend._written_paths[os.path.abspath(self.filepath)] = "md_index"
+        self._backend.execute("DELETE FROM md_index WHERE index_id = ?", (self.index_id,))
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        with self._backend._lock:
+            if not e_type:
+                self._backend._conn.commit()
+            else:
+                self._backend._conn.rollback()
+                logging.error(f"\nException type: {e_type}"
+                              f"\nException value: {e_value}"
+                              f"\nTraceback: {traceback}\n")
+
+    def create(self, record: MdIndexRecord):
+        self.create_by_raw_record(md_index_record_to_md_index_raw_record(record))
+
+    def create_by_raw_record(self, record):
+        self._backend.execute(SQLITE_INSERT_MD_INDEX, _md_index_raw_record_to_sqlite_row(self.index_id, record))
+
+
+class SqliteMdIndexReader:
+
+    def __init__(self, backend: SqliteIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+
+    def __enter__(self):
+        self.index_id = self._backend._open_index(self.filepath, "md_index")
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if e_type:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def list_filename(self):
+        rows = self._backend.execute("SELECT FileName FROM md_index WHERE index_id = ? ORDER BY rowid",
+                                     (self.index_id,))
+        return [row["FileName"] for row in rows]
+
+    def has_filename(self, filename):
+        rows = self._backend.execute("SELECT 1 FROM md_index WHERE index_id = ? AND FileName = ? LIMIT 1",
+                                     (self.index_id, filename))
+        return len(rows) > 0
+
+    def get_raw_record_by_filename(self, filename):
+        rows = self._backend.execute("SELECT * FROM md_index WHERE index_id = ? AND FileName = ? "
+                                     "ORDER BY rowid LIMIT 1", (self.index_id, filename))
+        if not rows:
+            return None
+
+        return _sqlite_row_to_md_index_raw_record(rows[0])
+
+    def get_record_by_filename(self, filename):
+        record = self.get_raw_record_by_filename(filename)
+        if record is None:
+            return None
+
+        return md_index_raw_record_to_md_index_record(record)
+
+    def list_record(self):
+        rows = self._backend.execute("SELECT * FROM md_index WHERE index_id = ? ORDER BY rowid", (self.index_id,))
+        for row in rows:
+            yield md_index_raw_record_to_md_index_record(_sqlite_row_to_md_index_raw_record(row))
+
+
+class SqliteImgIndexWriter:
+
+    def __init__(self, backend: SqliteIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+
+    def __enter__(self):
+        self.index_id = self._backend._get_index_id(self.filepath, create=True)
+        self._backend._written_paths[os.path.abspath(self.filepath)] = "img_index"
+        self._backend.execute("DELETE FROM img_index WHERE index_id = ?", (self.index_id,))
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        with self._backend._lock:
+            if not e_type:
+                self._backend._conn.commit()
+            else:
+                self._backend._conn.rollback()
+                logging.error(f"\nException type: {e_type}"
+                              f"\nException value: {e_value}"
+                              f"\nTraceback: {traceback}\n")
+
+    def create(self, record: ImgIndexRecord):
+        with self._backend._lock:
+            self._backend._conn.execute(SQLITE_INSERT_IMG_INDEX, _img_index_record_to_sqlite_row(self.index_id, record))
+
+    def create_by_raw_records(self, raw_records):
+        with self._backend._lock:
+            self._backend._conn.executemany(
+                SQLITE_INSERT_IMG_INDEX,
+                (_img_index_record_to_sqlite_row(self.index_id, img_index_raw_record_to_img_index_record(r))
+                 for r in raw_records))
+
+
+class SqliteImgIndexReader:
+
+    def __init__(self, backend: SqliteIndexBackend, filepath):
+        self._backend = backend
+        self.filepath = filepath
+
+    def __enter__(self):
+        self.index_id = self._backend._open_index(self.filepath, "img_index")
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if e_type:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def get_raw_records_by_md_filename(self, md_filename):
+        rows = self._backend.execute(
+            "SELECT * FROM img_index WHERE index_id = ? AND MdFileName = ? ORDER BY rowid",
+            (self.index_id, md_filename))
+        return [_sqlite_row_to_img_index_raw_record(row) for row in rows]
+
+    def get_records_by_md_filename(self, md_filename):
+        return [img_index_raw_record_to_img_index_record(r) for r in self.get_raw_records_by_md_filename(md_filename)]
+
+    def list_md_filename(self):
+        rows = self._backend.execute(
+            "SELECT MdFileName FROM img_index WHERE index_id = ? GROUP BY MdFileName ORDER BY MIN(rowid)",
+            (self.index_id,))
+        return [row["MdFileName"] for row in rows]
+
+    def list_record(self):
+        rows = self._backend.execute("SELECT * FROM img_index WHERE index_id = ? ORDER BY rowid", (self.index_id,))
+        for row in rows:
+            yield img_index_raw_record_to_img_index_record(_sqlite_row_to_img_index_raw_record(row))
+
+
+def _get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _md_index_raw_record_to_sqlite_row(index_id, record):
+    return (index_id, record["FileName"], record["MdUrl"], record["ModifiedDate"], int(record["IsSynced"]),
+            record.get("ContentHash") or None)
+
+
+def _sqlite_row_to_md_index_raw_record(row):
+    return {"FileName": row["FileName"],
+            "MdUrl": row["MdUrl"],
+            "ModifiedDate": row["ModifiedDate"],
+            "IsSynced": str(row["IsSynced"]),
+            "ContentHash": row["ContentHash"] or ""}
+
+
+def _img_index_record_to_sqlite_row(index_id, record: ImgIndexRecord):
+    return (index_id, record.md_filename, int(record.is_downloaded), record.img_url, record.img_name,
+            record.etag, record.last_modified, record.content_length, record.local_size)
+
+
+def _sqlite_row_to_img_index_raw_record(row):
+    raw = {}
+    for field_name in IMG_INDEX_FIELD_NAMES:
+        value = row[field_name]
+        raw[field_name] = "" if value is None else str(value)
+
+    return raw
@@ -0,0 +1,381 @@
+import copy
+import csv
+import datetime
+import logging
+import os
+import sys
+from enum import IntEnum, unique
+
+from data_base_class import DataPrintable
+
+# `ContentHash` was appended later, so it is optional when reading a markdown index.
+MD_INDEX_FIELD_NAMES = ["FileName", "MdUrl", "ModifiedDate", "IsSynced", "ContentHash"]
+# `ETag`, `LastModified`, `ContentLength` and `LocalSize` were appended later,
+# so they are optional when reading an image index.
+IMG_INDEX_FIELD_NAMES = ["MdFileName", "IsDownloaded", "ImageUrl", "ImageName",
+                         "ETag", "LastModified", "ContentLength", "LocalSize"]
+FIELD_MODIFIED_DATE_FORMAT = "%Y/%m/%d %H:%M:%S.%f %z"
+
+
+@unique
+class MdIndexIsSynced(IntEnum):
+    N_FIRST = -1
+    N = 0
+    Y = 1
+
+
+class MdIndexRecord(DataPrintable):
+    __slots__ = ("filename", "md_url", "is_synced", "modified_date", "content_hash")
+
+    def __init__(self, filename, md_url, is_synced: MdIndexIsSynced, modified_date: datetime.datetime,
+                 content_hash=None):
+        self.filename = filename
+        self.md_url = md_url
+        self.is_synced = is_synced
+        self.modified_date = modified_date
+        # hash of the markdown file content, to tell a touched file from a modified one
+        self.content_hash = content_hash
+
+
+def _optional_str(value):
+    return value if value else None
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, "") else None
+
+
+def _optional_field(value):
+    return "" if value is None else str(value)
+
+
+def md_index_raw_record_to_md_index_record(raw) -> MdIndexRecord:
+    record = MdIndexRecord(raw["FileName"],
+                           raw["MdUrl"],
+                           MdIndexIsSynced(int(raw["IsSynced"])),
+                           datetime.datetime.strptime(raw["ModifiedDate"], FIELD_MODIFIED_DATE_FORMAT),
+                           _optional_str(raw.get("ContentHash")))
+    return record
+
+
+def md_index_record_to_md_index_raw_record(record: MdIndexRecord):
+    raw = {"FileName": record.filename,
+           "MdUrl": record.md_url,
+           "ModifiedDate": record.modified_date.strftime(FIELD_MODIFIED_DATE_FORMAT),
+           "IsSynced": str(record.is_synced.value),
+           "ContentHash": _optional_field(record.content_hash)}
+    return raw
+
+
+class ImgIndexRecord(DataPrintable):
+    # an image index can hold millions of records, so they have no `__dict__`
+    __slots__ = ("md_filename", "is_downloaded", "img_url", "img_name", "etag", "last_modified", "content_length",
+                 "local_size")
+
+    def __init__(self, md_filename, is_downloaded: bool, img_url, img_name,
+                 etag=None, last_modified=None, content_length: int = None, local_size: int = None):
+        self.md_filename = md_filename
+        self.is_downloaded = is_downloaded
+        self.img_url = img_url
+        self.img_name = img_name
+        # HTTP validators and sizes of the downloaded image, used to re-fetch it conditionally
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_length = content_length
+        self.local_size = local_size
+
+
+def img_index_raw_record_to_img_index_record(raw) -> ImgIndexRecord:
+    # every image of a markdown file shares one string of its file name
+    record = ImgIndexRecord(sys.intern(raw["MdFileName"]),
+                            bool(int(raw["IsDownloaded"])),
+                            raw["ImageUrl"],
+                            raw["ImageName"],
+                            _optional_str(raw.get("ETag")),
+                            _optional_str(raw.get("LastModified")),
+                            _optional_int(raw.get("ContentLength")),
+                            _optional_int(raw.get("LocalSize")))
+    return record
+
+
+def img_index_record_to_img_index_raw_record(record: ImgIndexRecord):
+    raw = {"MdFileName": record.md_filename,
+           "IsDownloaded": str(int(record.is_downloaded)),
+           "ImageUrl": record.img_url,
+           "ImageName": record.img_name,
+           "ETag": _optional_field(record.etag),
+           "LastModified": _optional_field(record.last_modified),
+           "ContentLength": _optional_field(record.content_length),
+           "LocalSize": _optional_field(record.local_size)}
+    return raw
+
+
+def update_img_index_record_by_download_result(record: ImgIndexRecord, download_result):
+    """
+    Copy the HTTP validators and sizes of a download result,
+    i.e. an object with `etag`, `last_modified`, `content_length` and `local_size`, to the record.
+    """
+    if download_result is None:
+        return
+
+    record.etag = download_result.etag
+    record.last_modified = download_result.last_modified
+    record.content_length = download_result.content_length
+    record.local_size = download_result.local_size
+
+
+class MdIndexWriter:
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def __enter__(self):
+        logging.debug(f"open: {self.filepath}")
+        self._file = open(self.filepath, mode="w", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=MD_INDEX_FIELD_NAMES, quoting=csv.QUOTE_ALL)
+        self._writer.writeheader()
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            logging.debug(f"close: {self.filepath}")
+            self._file.close()
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def create(self, record: MdIndexRecord):
+        self._writer.writerow(md_index_record_to_md_index_raw_record(record))
+
+    def create_by_raw_record(self, record):
+        filename = record["FileName"]
+        md_url = record["MdUrl"]
+        modified_date = record["ModifiedDate"]
+        is_synced = record["IsSynced"]
+        content_hash = record.get("ContentHash") or ""
+
+        self._writer.writerow(
+            {"FileName": filename, "MdUrl": md_url, "ModifiedDate": modified_date, "IsSynced": is_synced,
+             "ContentHash": content_hash})
+
+
+class MdIndexReader:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._records = {}
+
+    def __enter__(self):
+        logging.debug(f"open: {self.filepath}")
+        self._file = open(self.filepath, newline="", encoding="utf-8")
+        self._reader = csv.DictReader(self._file, quoting=csv.QUOTE_ALL)
+        self._records = self._index_records_by_filename()
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            logging.debug(f"close: {self.filepath}")
+            self._file.close()
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def _index_records_by_filename(self):
+        # The whole index is parsed once, and all lookups are served from memory.
+        records = {}
+        for row in self._reader:
+            record = md_index_raw_record_to_md_index_record(row)
+            if record.filename in records:
+                # the first record of a duplicate file name is kept, as before the index was held in memory
+                logging.warning(f"skip line {self._reader.line_num} of the markdown index `{self.filepath}`: "
+                                f"duplicate file name `{record.filename}`")
+                continue
+            records[record.filename] = record
+
+        return records
+
+    def list_filename(self):
+        return list(self._records.keys())
+
+    def has_filename(self, filename):
+        return filename in self._records
+
+    def get_raw_record_by_filename(self, filename):
+        record = self._records.get(filename)
+        if record is None:
+            return None
+
+        return md_index_record_to_md_index_raw_record(record)
+
+    def get_record_by_filename(self, filename):
+        record = self._records.get(filename)
+        if record is None:
+            return None
+
+        # callers modify the returned record, so the indexed one is kept intact
+        return copy.copy(record)
+
+    def list_record(self):
+        for record in self._records.values():
+            yield copy.copy(record)
+
+
+class ImgIndexWriter:
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def __enter__(self):
+        logging.debug(f"open: {self.filepath}")
+        self._file = open(self.filepath, mode="w", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=IMG_INDEX_FIELD_NAMES, quoting=csv.QUOTE_ALL)
+        self._writer.writeheader()
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            logging.debug(f"close: {self.filepath}")
+            self._file.close()
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def create(self, record: ImgIndexRecord):
+        self._writer.writerow(img_index_record_to_img_index_raw_record(record))
+
+    def create_by_raw_records(self, raw_records):
+        for r in raw_records:
+            record = {}
+            for field_name in IMG_INDEX_FIELD_NAMES:
+                record[field_name] = r.get(field_name)
+
+            self._writer.writerow(record)
+
+
+class ImgIndexReader:
+    """
+    The whole image index is parsed once on open and grouped by markdown file name.
+
+    The grouped records are shared by all callers, including worker threads,
+    so they must be treated as read-only.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._records_by_md_filename = {}
+
+    def __enter__(self):
+        logging.debug(f"open: {self.filepath}")
+        self._file = open(self.filepath, newline="", encoding="utf-8")
+        self._reader = csv.DictReader(self._file, quoting=csv.QUOTE_ALL)
+        self._records_by_md_filename = self._group_records_by_md_filename()
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        if not e_type:
+            logging.debug(f"close: {self.filepath}")
+            self._file.close()
+        else:
+            logging.error(f"\nException type: {e_type}"
+                          f"\nException value: {e_value}"
+                          f"\nTraceback: {traceback}\n")
+
+    def _group_records_by_md_filename(self):
+        records_by_md_filename = {}
+        for row in self._reader:
+            record = img_index_raw_record_to_img_index_record(row)
+            records = records_by_md_filename.get(record.md_filename)
+            if records is None:
+                records_by_md_filename[record.md_filename] = records = []
+
+            records.append(record)
+
+        return records_by_md_filename
+
+    def get_raw_records_by_md_filename(self, md_filename):
+        records = self._records_by_md_filename.get(md_filename, ())
+        return [img_index_record_to_img_index_raw_record(r) for r in records]
+
+    def get_records_by_md_filename(self, md_filename):
+        return list(self._records_by_md_filename.get(md_filename, ()))
+
+    def list_md_filename(self):
+        md_filenames = list(self._records_by_md_filename.keys())
+        return md_filenames
+
+    def list_record(self):
+        for records in self._records_by_md_filename.values():
+            yield from records
+
+
+class CsvIndexBackend:
+    """
+    Index backend storing each index in its own csv file, e.g. `index-markdown.csv`.
+
+    An index backend opens readers and writers by index path,
+    and updates sync statuses in place.
+    Status updates rewrite the whole csv file through a `.new` file.
+
+    `download_results` of `mark_is_downloaded` maps an image URL to its download result,
+    whose HTTP validators and sizes are stored in the image index.
+    `md_filenames` of `mark_is_synced` limits the marked records, e.g. to existing files,
+    so the record of a deleted file stays unsynced.
+    """
+
+    def md_index_reader(self, md_index_path) -> MdIndexReader:
+        return MdIndexReader(md_index_path)
+
+    def md_index_writer(self, md_index_path) -> MdIndexWriter:
+        return MdIndexWriter(md_index_path)
+
+    def img_index_reader(self, img_index_path) -> ImgIndexReader:
+        return ImgIndexReader(img_index_path)
+
+    def img_index_writer(self, img_index_path) -> ImgIndexWriter:
+        return ImgIndexWriter(img_index_path)
+
+    def mark_is_downloaded(self, img_index_path, download_ok: dict, download_results: dict = None):
+        new_img_index_path = f"{img_index_path}.new"
+        with self.img_index_reader(img_index_path) as img_index, \
+                ImgIndexWriter(new_img_index_path) as new_img_index:
+            records = img_index.list_record()
+            EMPTY_SET = set()
+            for record in records:
+                if record.img_url in download_ok.get(record.md_filename, EMPTY_SET):
+                    record = copy.copy(record)
+                    record.is_downloaded = True
+                    update_img_index_record_by_download_result(record, (download_results or {}).get(record.img_url))
+
+                new_img_index.create(record)
+
+        os.remove(img_index_path)
+        os.rename(new_img_index_path, img_index_path)
+
+    def mark_is_synced(self, md_index_path, img_index: ImgIndexReader, md_filenames=None):
+        new_md_index_path = f"{md_index_path}.new"
+        with MdIndexReader(md_index_path) as md_index, \
+                MdIndexWriter(new_md_index_path) as new_md_index:
+            records = md_index.list_record()
+            for record in records:
+                if md_filenames is not None and record.filename not in md_filenames:
+                    new_md_index.create(record)
+                    continue
+
+                img_records = img_index.get_records_by_md_filename(record.filename)
+
+                is_all_downloaded = True
+                for img_record in img_records:
+                    if not img_record.is_downloaded:
+                        is_all_downloaded = False
+                        break
+                record.is_synced = MdIndexIsSynced.Y if is_all_downloaded else record.is_synced
+
+                new_md_index.create(record)
+
+        os.remove(md_index_path)
+        os.rename(new_md_index_path, md_index_path)
+
+    def close(self):
+        pass
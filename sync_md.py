@@ -1,315 +1,133 @@
 import argparse
-import csv
 import datetime
+import hashlib
+import itertools
 import logging
+import mmap
 import os
 import random
 import re
 import shutil
-import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from enum import IntEnum, unique
-from http.client import HTTPResponse
-from re import Match
-from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
+import posixpath
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager, nullcontext
 
+from async_downloader import AsyncDownloadEngine
+from columnar_index import ColumnarIndexBackend
 from data_base_class import DataPrintable
+from download_journal import DownloadJournal
+from downloader import (CONNECT_TIMEOUT, MAX_RETRIES, PART_META_SUFFIX, PART_SUFFIX, READ_TIMEOUT, DownloadResult,
+                        DownloadTask, RetryPolicy, ThreadDownloadEngine, discard_stale_image, get_error_class,
+                        link_or_copy_image)
+from image_store import ImageStore
+from log_config import LOG_LEVELS, get_worker_log_queue, setup_logging, setup_worker_logging
+from memory_index import MemoryIndexBackend
+from metrics import SyncMetrics
+from profiler import StageProfiler
+from sqlite_index import SqliteIndexBackend
+from sync_index import CsvIndexBackend, ImgIndexReader, ImgIndexRecord, MdIndexIsSynced, MdIndexRecord
 from url_filter import ImageUrlFilter
 
-LOG_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/log"
-if not os.path.isdir(LOG_DIR):
-    os.mkdir(LOG_DIR)
-
-# LOGGING_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
-# LOGGING_FORMAT = "%(message)s"
-LOGGING_FORMAT = "%(asctime)s [%(processName)s] [%(threadName)s] [%(levelname)s] %(message)s"
-logging.basicConfig(level=logging.DEBUG,
-                    handlers=[
-                        logging.StreamHandler(sys.stdout),
-                        logging.FileHandler(f"{LOG_DIR}/{os.path.splitext(os.path.basename(__file__))[0]}.log",
-                                            "w", "utf-8")
-                    ],
-                    format=LOGGING_FORMAT)
-
-IMG_BUF_SIZE = 64 * 1024  # unit: byte
 THREAD_POOL_MAX_WORKERS = 5
-
-MD_INDEX_FIELD_NAMES = ["FileName", "MdUrl", "ModifiedDate", "IsSynced"]
-IMG_INDEX_FIELD_NAMES = ["MdFileName", "IsDownloaded", "ImageUrl", "ImageName"]
-FIELD_MODIFIED_DATE_FORMAT = "%Y/%m/%d %H:%M:%S.%f %z"
-
-
-@unique
-class MdIndexIsSynced(IntEnum):
-    N_FIRST = -1
-    N = 0
-    Y = 1
-
-
-class MdIndexRecord(DataPrintable):
-    def __init__(self, filename, md_url, is_synced: MdIndexIsSynced, modified_date: datetime.datetime):
-        self.filename = filename
-        self.md_url = md_url
-        self.is_synced = is_synced
-        self.modified_date = modified_date
-
-
-def md_index_raw_record_to_md_index_record(raw) -> MdIndexRecord:
-    record = MdIndexRecord(raw["FileName"],
-                           raw["MdUrl"],
-                           MdIndexIsSynced(int(raw["IsSynced"])),
-                           datetime.datetime.strptime(raw["ModifiedDate"], FIELD_MODIFIED_DATE_FORMAT))
-    return record
-
-
-class ImgIndexRecord(DataPrintable):
-    def __init__(self, md_filename, is_downloaded: bool, img_url, img_name):
-        self.md_filename = md_filename
-        self.is_downloaded = is_downloaded
-        self.img_url = img_url
-        self.img_name = img_name
-
-
-def img_index_raw_record_to_img_index_record(raw) -> ImgIndexRecord:
-    record = ImgIndexRecord(raw["MdFileName"],
-                            bool(int(raw["IsDownloaded"])),
-                            raw["ImageUrl"],
-                            raw["ImageName"])
-    return record
-
-
-class MdIndexWriter:
-
-    def __init__(self, filepath):
-        self.filepath = filepath
-
-    def __enter__(self):
-        logging.debug(f"open: {self.filepath}")
-        self._file = open(self.filepath, mode="w", newline="", encoding="utf-8")
-        self._writer = csv.DictWriter(self._file, fieldnames=MD_INDEX_FIELD_NAMES, quoting=csv.QUOTE_ALL)
-        self._writer.writeheader()
-        return self
-
-    def __exit__(self, e_type, e_value, traceback):
-        if not e_type:
-            logging.debug(f"close: {self.filepath}")
-            self._file.close()
-        else:
-            logging.error(f"\nException type: {e_type}"
-                          f"\nException value: {e_value}"
-                          f"\nTraceback: {traceback}\n")
-
-    def create(self, record: MdIndexRecord):
-        self._writer.writerow(
-            {"FileName": record.filename,
-             "MdUrl": record.md_url,
-             "ModifiedDate": record.modified_date.strftime(FIELD_MODIFIED_DATE_FORMAT),
-             "IsSynced": record.is_synced.value})
-
-    def create_by_raw_record(self, record):
-        filename = record["FileName"]
-        md_url = record["MdUrl"]
-        modified_date = record["ModifiedDate"]
-        is_synced = record["IsSynced"]
-
-        self._writer.writerow(
-            {"FileName": filename, "MdUrl": md_url, "ModifiedDate": modified_date, "IsSynced": is_synced})
-
-
-class MdIndexReader:
-    def __init__(self, filepath):
-        self.filepath = filepath
-        self._filenames = []
-
-    def __enter__(self):
-        logging.debug(f"open: {self.filepath}")
-        self._file = open(self.filepath, newline="", encoding="utf-8")
-        self._reader = csv.DictReader(self._file, quoting=csv.QUOTE_ALL)
-        self._filenames = self._list_filename()
-        return self
-
-    def __exit__(self, e_type, e_value, traceback):
-        if not e_type:
-            logging.debug(f"close: {self.filepath}")
-            self._file.close()
-        else:
-            logging.error(f"\nException type: {e_type}"
-                          f"\nException value: {e_value}"
-                          f"\nTraceback: {traceback}\n")
-
-    def _get_reader(self):
-        # logging.debug(f"before {self._reader.line_num}, {self._reader.reader.line_num}")
-        if self._reader.line_num > 0:
-            self._file.seek(0)
-            next(self._reader)  # skip header
-            # logging.debug(f"after {self._reader.line_num}, {self._reader.reader.line_num}")
-        return self._reader
-
-    def _list_filename(self):
-        filenames = []
-        for row in self._get_reader():
-            filenames.append(row["FileName"])
-
-        return filenames
-
-    def list_filename(self):
-        return self._filenames
-
-    def has_filename(self, filename):
-        is_existed = False
-        filenames = self.list_filename()
-
-        if filename in filenames:
-            is_existed = True
-
-        return is_existed
-
-    def get_raw_record_by_filename(self, filename):
-        filenames = self.list_filename()
-        record_i = filenames.index(filename)
-
-        record = None
-        for idx, row in enumerate(self._get_reader()):
-            if idx == record_i:
-                record = row
-                break
-
-        # logging.debug(f"raw record= {record}")
-        return record
-
-    def get_record_by_filename(self, filename):
-        record = self.get_raw_record_by_filename(filename)
-        record = md_index_raw_record_to_md_index_record(record)
-
-        return record
-
-    def list_record(self):
-        for row in self._get_reader():
-            record = md_index_raw_record_to_md_index_record(row)
-            yield record
-
-
-class ImgIndexWriter:
-
-    def __init__(self, filepath):
-        self.filepath = filepath
-
-    def __enter__(self):
-        logging.debug(f"open: {self.filepath}")
-        self._file = open(self.filepath, mode="w", newline="", encoding="utf-8")
-        self._writer = csv.DictWriter(self._file, fieldnames=IMG_INDEX_FIELD_NAMES, quoting=csv.QUOTE_ALL)
-        self._writer.writeheader()
-        return self
-
-    def __exit__(self, e_type, e_value, traceback):
-        if not e_type:
-            logging.debug(f"close: {self.filepath}")
-            self._file.close()
-        else:
-            logging.error(f"\nException type: {e_type}"
-                          f"\nException value: {e_value}"
-                          f"\nTraceback: {traceback}\n")
-
-    def create(self, record: ImgIndexRecord):
-        self._writer.writerow(
-            {"MdFileName": record.md_filename,
-             "IsDownloaded": int(record.is_downloaded),
-             "ImageUrl": record.img_url,
-             "ImageName": record.img_name})
-
-    def create_by_raw_records(self, raw_records):
-        for r in raw_records:
-            record = {}
-            for field_name in IMG_INDEX_FIELD_NAMES:
-                record[field_name] = r.get(field_name)
-
-            self._writer.writerow(record)
-
-
-class ImgIndexReader:
-
-    def __init__(self, filepath):
-        self.filepath = filepath
-
-    def __enter__(self):
-        logging.debug(f"open: {self.filepath}")
-        self._file = open(self.filepath, newline="", encoding="utf-8")
-        self._reader = csv.DictReader(self._file, quoting=csv.QUOTE_ALL)
-        self._record_index_by_md_filename = self._index_records_by_md_filename()
-        return self
-
-    def __exit__(self, e_type, e_value, traceback):
-        if not e_type:
-            logging.debug(f"close: {self.filepath}")
-            self._file.close()
-        else:
-            logging.error(f"\nException type: {e_type}"
-                          f"\nException value: {e_value}"
-                          f"\nTraceback: {traceback}\n")
-
-    def _get_reader(self):
-        # logging.debug(f"before {self._reader.line_num}, {self._reader.reader.line_num}")
-        if self._reader.line_num > 0:
-            self._file.seek(0)
-            next(self._reader)  # skip header
-            # logging.debug(f"after {self._reader.line_num}, {self._reader.reader.line_num}")
-        return self._reader
-
-    def _index_records_by_md_filename(self):
-        record_index = {}
-        for idx, row in enumerate(self._get_reader()):
-            record = img_index_raw_record_to_img_index_record(row)
-            index_list = record_index.get(record.md_filename)
-            if index_list is None:
-                record_index[record.md_filename] = index_list = []
-
-            index_list.append(idx)
-
-        return record_index
-
-    def get_raw_records_by_md_filename(self, md_filename):
-        records = []
-        index_list = self._record_index_by_md_filename.get(md_filename)
-        if not index_list:
-            return records
-
-        for idx, row in enumerate(self._get_reader()):
-            if idx in index_list:
-                records.append(row)
-
-        return records
-
-    def get_records_by_md_filename(self, md_filename):
-        records = []
-        index_list = self._record_index_by_md_filename.get(md_filename)
-        if not index_list:
-            return records
-
-        for idx, row in enumerate(self._get_reader()):
-            if idx in index_list:
-                record = img_index_raw_record_to_img_index_record(row)
-                records.append(record)
-
-        return records
-
-    def list_md_filename(self):
-        md_filenames = list(self._record_index_by_md_filename.keys())
-        return md_filenames
-
-    def list_record(self):
-        for row in self._get_reader():
-            record = img_index_raw_record_to_img_index_record(row)
-            yield record
-
-
-def merge_md_filenames(md_dir_path, old_md_index_path):
-    filenames = set((fn for fn in os.listdir(md_dir_path) if os.path.isfile(f"{md_dir_path}/{fn}")))
-
-    with MdIndexReader(old_md_index_path) as old_md_index:
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CHUNK_SIZE = 32  # markdown files parsed per task of a worker process
+PARSE_SERIAL_MAX_FILES = 128  # fewer files are parsed in the main process, as starting processes costs more
+WATCH_POLL_INTERVAL = 2.0  # unit: second
+WATCH_DEBOUNCE = 1.0  # unit: second
+WATCH_FLUSH_INTERVAL = 60.0  # unit: second
+
+# markdown img ex: `![Alt text](https://i.imgur.com/bbb.png "Title Text")`
+# https://regexr.com/7f2h2
+# It matches bytes, and a link never spans lines, the same as matching line by line.
+IMG_LINK_PATTERN = re.compile(rb"\!\[(\"([^\n\r\"]*)\"|[^\n\r\]]*)\]"
+                              rb"\((https*:\/\/([^\)\"\n\r]+))(?:[ ]+\"[^\n\r\"]*\")?\)")
+
+MD_HASH_DIGEST_SIZE = 16  # unit: byte
+MD_HASH_BUF_SIZE = 1024 * 1024  # unit: byte
+
+INDEX_BACKENDS = ["csv", "sqlite", "columnar"]
+DOWNLOAD_ENGINES = ["thread", "asyncio"]
+CSV_INDEX_BACKEND = CsvIndexBackend()
+
+
+def open_thread_pool(executor: ThreadPoolExecutor = None, max_workers=THREAD_POOL_MAX_WORKERS):
+    """
+    Return a context manager of `executor` if it is given, which is left open,
+    or of a new thread pool of `max_workers`, which is shut down on exit.
+    """
+    return nullcontext(executor) if executor is not None else ThreadPoolExecutor(max_workers)
+
+
+def scan_md_dir(md_dir_path, recursive=False, max_workers=THREAD_POOL_MAX_WORKERS,
+                executor: ThreadPoolExecutor = None):
+    """
+    Return a dict mapping the name of each file in `md_dir_path` to its `os.stat_result`,
+    taken from the `os.DirEntry` once, so the file is not stat again.
+
+    With `recursive`, files in subdirectories are included and named by their relative paths with `/`,
+    e.g. `notes/a.md`. Subdirectories are scanned in parallel on a thread pool,
+    as each directory costs round-trips on a network filesystem.
+    Hidden directories, e.g. `.git`, and symlinks to directories are skipped.
+    The thread pool is `executor` if it is given.
+    """
+
+    def scan_dir_job(rel_dir_path):
+        files = {}
+        sub_dir_paths = []
+        with os.scandir(f"{md_dir_path}/{rel_dir_path}" if rel_dir_path else md_dir_path) as entries:
+            for entry in entries:
+                rel_path = f"{rel_dir_path}/{entry.name}" if rel_dir_path else entry.name
+                if entry.is_file():
+                    files[rel_path] = entry.stat()
+                elif recursive and entry.is_dir(follow_symlinks=False) and not entry.name.startswith("."):
+                    sub_dir_paths.append(rel_path)
+
+        return files, sub_dir_paths
+
+    md_stats, sub_dir_paths = scan_dir_job("")
+    if not sub_dir_paths:
+        return md_stats
+
+    with open_thread_pool(executor, max_workers) as executor:
+        futures = {executor.submit(scan_dir_job, path): path for path in sub_dir_paths}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                e = future.exception()
+                if e is not None:
+                    logging.error("\nException scan_md_dir `%s`\n", path, exc_info=e)
+                    continue
+
+                files, sub_dir_paths = future.result()
+                md_stats.update(files)
+                for sub_dir_path in sub_dir_paths:
+                    futures[executor.submit(scan_dir_job, sub_dir_path)] = sub_dir_path
+
+    return md_stats
+
+
+def list_filenames(dir_path):
+    """
+    Return the names of files in `dir_path`, where `os.DirEntry` tells files apart without stat them one by one.
+    """
+    with os.scandir(dir_path) as entries:
+        return [entry.name for entry in entries if entry.is_file()]
+
+
+def merge_md_filenames(md_dir_path, old_md_index_path, index_backend=CSV_INDEX_BACKEND, md_stats: dict = None):
+    """
+    Return the sorted names of files in `md_dir_path`, or in `md_stats` if it is given, and in the old index.
+    """
+    if md_stats is None:
+        md_stats = scan_md_dir(md_dir_path)
+    filenames = set(md_stats)
+
+    with index_backend.md_index_reader(old_md_index_path) as old_md_index:
         existed_filenames = old_md_index.list_filename()
 
-    logging.debug(f"existed_filenames= {existed_filenames}")
+    logging.debug("existed_filenames= %s", existed_filenames)
     filenames.update(existed_filenames)
     filenames = list(filenames)
     filenames.sort()
@@ -345,29 +163,95 @@ def get_md_url_mapping(md_url_index_path):
     return md_url_mapping
 
 
-def generate_md_index(md_dir_path, md_url_index_path, old_md_index_path, md_index_path, tmp_md_index_path):
-    md_filenames = merge_md_filenames(md_dir_path, old_md_index_path)
+def hash_md_file(md_path):
+    h = hashlib.blake2b(digest_size=MD_HASH_DIGEST_SIZE)
+    with open(md_path, "rb") as md:
+        while True:
+            buf = md.read(MD_HASH_BUF_SIZE)
+            if len(buf) == 0:
+                break
+            h.update(buf)
+
+    return h.hexdigest()
+
+
+def hash_md_files(md_paths, max_workers=THREAD_POOL_MAX_WORKERS, executor: ThreadPoolExecutor = None):
+    """
+    Hash markdown files on a thread pool, `executor` if it is given,
+    as `hashlib` releases the GIL while hashing large buffers.
+    Return a dict mapping each path to its hash, or to None if it fails to be read.
+    """
+
+    def hash_md_file_job(md_path):
+        try:
+            return hash_md_file(md_path)
+        except OSError as e:
+            logging.error("\nException hash_md_file `%s`\n", md_path, exc_info=e)
+            return None
+
+    if len(md_paths) <= 1:
+        return {md_path: hash_md_file_job(md_path) for md_path in md_paths}
+
+    with open_thread_pool(executor, max_workers) as executor:
+        return dict(zip(md_paths, executor.map(hash_md_file_job, md_paths)))
+
+
+def generate_md_index(md_dir_path, md_url_index_path, old_md_index_path, md_index_path, tmp_md_index_path,
+                      index_backend=CSV_INDEX_BACKEND, recursive=False, executor: ThreadPoolExecutor = None):
+    """
+    Return the sorted names of files existed in `md_dir_path`, which are relative paths with `recursive`.
+    Directories are scanned and files are hashed on `executor` if it is given.
+    """
+    md_stats = scan_md_dir(md_dir_path, recursive, executor=executor)
+    md_filenames = merge_md_filenames(md_dir_path, old_md_index_path, index_backend, md_stats)
     md_url_mapping = get_md_url_mapping(md_url_index_path)
 
-    with MdIndexReader(old_md_index_path) as old_md_index, \
-            MdIndexWriter(md_index_path) as md_index, \
-            MdIndexWriter(tmp_md_index_path) as tmp_md_index:
+    with index_backend.md_index_reader(old_md_index_path) as old_md_index, \
+            index_backend.md_index_writer(md_index_path) as md_index, \
+            index_backend.md_index_writer(tmp_md_index_path) as tmp_md_index:
+
+        # only new files and files whose mtime is newer than in the old index are hashed
+        modified_dates = {}
+        hashed_md_paths = []
+        for md_filename in md_filenames:
+            md_path = f"{md_dir_path}/{md_filename}"
+            md_stat = md_stats.get(md_filename)
+            if md_stat is None:
+                continue
+
+            modified_date = datetime.datetime.fromtimestamp(md_stat.st_mtime).astimezone()
+            modified_dates[md_filename] = modified_date
+            record = old_md_index.get_record_by_filename(md_filename)
+            if record is None or modified_date > record.modified_date:
+                hashed_md_paths.append(md_path)
+
+        content_hashes = hash_md_files(hashed_md_paths, executor=executor)
+        touched_amount = 0
 
         for md_filename in md_filenames:
             md_path = f"{md_dir_path}/{md_filename}"  # !!! md_path may not be existed.
-            md_url = md_url_mapping.get(md_filename)
+            # `index-mdurl.md` names files without their directories
+            md_url = md_url_mapping.get(md_filename, md_url_mapping.get(posixpath.basename(md_filename)))
 
-            if os.path.exists(md_path):
-                modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(md_path)).astimezone()
+            if md_filename in md_stats:
+                modified_date = modified_dates[md_filename]
 
                 if old_md_index.has_filename(md_filename):
                     record = old_md_index.get_record_by_filename(md_filename)
                     # logging.debug(f"old record= {record}")
                     record.md_url = md_url if md_url is not None else record.md_url
 
+                    content_hash = content_hashes.get(md_path)
+                    if modified_date > record.modified_date \
+                            and record.content_hash is not None and content_hash == record.content_hash:
+                        # only the mtime is changed, e.g. by `git checkout`, so the synced status is kept
+                        touched_amount += 1
+                        record.modified_date = modified_date
+
                     if modified_date > record.modified_date:
                         record.is_synced = MdIndexIsSynced.N
                         record.modified_date = modified_date
+                        record.content_hash = content_hash
 
                         md_index.create(record)
                         tmp_md_index.create(record)
@@ -383,20 +267,30 @@ def generate_md_index(md_dir_path, md_url_index_path, old_md_index_path, md_inde
                             md_index.create(record)
 
                 else:
-                    record = MdIndexRecord(md_filename, md_url, MdIndexIsSynced.N_FIRST, modified_date)
+                    record = MdIndexRecord(md_filename, md_url, MdIndexIsSynced.N_FIRST, modified_date,
+                                           content_hashes.get(md_path))
 
                     md_index.create(record)
                     tmp_md_index.create(record)
 
             else:
+                # a deleted file, whose copy and images are removed, so it is synced again if it comes back,
+                # even with the same mtime, e.g. moved out of the directory and back
                 record = old_md_index.get_record_by_filename(md_filename)
                 record.md_url = md_url if md_url is not None else record.md_url
+                record.is_synced = MdIndexIsSynced.N_FIRST
+                record.content_hash = None
 
                 md_index.create(record)
 
+    logging.info(f"generate_md_index hashed {len(hashed_md_paths)} markdown files, "
+                 f"{touched_amount} of them with unchanged content")
 
-def mock_old_index():
-    tmp_dir = f"{os.getcwd()}/tmp"
+    return sorted(md_stats)
+
+
+def mock_old_index(index_backend=CSV_INDEX_BACKEND, tmp_dir=None):
+    tmp_dir = tmp_dir if tmp_dir is not None else f"{os.getcwd()}/tmp"
     if not os.path.isdir(tmp_dir):
         os.mkdir(tmp_dir)
 
@@ -405,46 +299,211 @@ def mock_old_index():
     logging.debug(f"mock old_md_index= {old_md_index_path}"
                   f"\nmock old_img_index= {old_img_index_path}")
 
-    with MdIndexWriter(old_md_index_path) as old_md_index, \
-            ImgIndexWriter(old_img_index_path) as old_img_index:
+    with index_backend.md_index_writer(old_md_index_path) as old_md_index, \
+            index_backend.img_index_writer(old_img_index_path) as old_img_index:
         pass
 
     return [old_md_index_path, old_img_index_path]
 
 
-def copy_md_files(md_input_dir_path, md_output_dir_path):
+def copy_md_files(md_input_dir_path, md_output_dir_path, keep_images=False):
+    """
+    Copy the markdown directory to `md_output_dir_path`,
+    replacing its contents, or only the copied files with `keep_images`.
+    """
     logging.debug(f"\n=== copy_md_files ====================================\n"
                   f"from {md_input_dir_path}\n"
                   f"to {md_output_dir_path}\n"
                   f"=======================================================\n")
-    if os.path.isdir(md_output_dir_path):
+    if os.path.isdir(md_output_dir_path) and not keep_images:
         shutil.rmtree(md_output_dir_path)
     shutil.copytree(md_input_dir_path, md_output_dir_path, dirs_exist_ok=True)
 
 
-def parse_img_urls_in_md(md_path, img_url_filter: ImageUrlFilter):
-    img_urls = set()
+def copy_modified_md_files(md_input_dir_path, md_output_dir_path, tmp_md_index_path,
+                           index_backend=CSV_INDEX_BACKEND):
+    """
+    Copy only new or modified markdown files, i.e. the ones in `tmp_md_index_path`,
+    and keep the other files and the downloaded images in `md_output_dir_path`.
+    Return the copied markdown file names.
+    """
+    os.makedirs(md_output_dir_path, exist_ok=True)
+
+    copied_md_filenames = []
+    with index_backend.md_index_reader(tmp_md_index_path) as tmp_md_index:
+        for md_record in tmp_md_index.list_record():
+            md_path = f"{md_input_dir_path}/{md_record.filename}"
+            if os.path.isfile(md_path):
+                md_output_path = f"{md_output_dir_path}/{md_record.filename}"
+                os.makedirs(os.path.dirname(md_output_path), exist_ok=True)
+                shutil.copy2(md_path, md_output_path)
+                copied_md_filenames.append(md_record.filename)
+
+    logging.debug(f"\n=== copy_modified_md_files ==========================\n"
+                  f"from {md_input_dir_path}\n"
+                  f"to {md_output_dir_path}\n"
+                  f"copied {len(copied_md_filenames)} markdown files\n"
+                  f"=======================================================\n")
+
+    return copied_md_filenames
+
+
+def remove_deleted_md_files(md_input_dir_path, md_output_dir_path, md_index_path, index_backend=CSV_INDEX_BACKEND):
+    """
+    Remove copies of markdown files which no longer exist in `md_input_dir_path`.
+    Their images are listed in `deleteImgList.txt` by `generate_img_index` and removed by `remove_deleted_images`.
+    """
+    with index_backend.md_index_reader(md_index_path) as md_index:
+        for md_filename in md_index.list_filename():
+            md_output_path = f"{md_output_dir_path}/{md_filename}"
+            if not os.path.exists(f"{md_input_dir_path}/{md_filename}") and os.path.isfile(md_output_path):
+                logging.info("remove deleted markdown file `%s`", md_output_path)
+                os.remove(md_output_path)
+
+
+def remove_deleted_images(md_output_dir_path, delete_img_list_path):
+    """
+    Remove images listed in `deleteImgList.txt`, i.e. images not used anymore, with their partial downloads,
+    then the image directories left empty, e.g. of a deleted markdown file.
+    """
+    img_dir_paths = set()
+    with open(delete_img_list_path, newline="", encoding="utf-8") as delete_img_list:
+        for row in delete_img_list:
+            img_path = f"{md_output_dir_path}/{row.strip()}"
+            img_dir_paths.add(os.path.dirname(img_path))
+            for path in (img_path, f"{img_path}{PART_SUFFIX}", f"{img_path}{PART_META_SUFFIX}"):
+                if os.path.isfile(path):
+                    logging.info("remove deleted image `%s`", path)
+                    os.remove(path)
+
+    for img_dir_path in img_dir_paths:
+        if os.path.isdir(img_dir_path) and not os.listdir(img_dir_path):
+            logging.info("remove empty image directory `%s`", img_dir_path)
+            os.rmdir(img_dir_path)
+
+
+class ImgLink(DataPrintable):
+    """
+    An image link in a markdown file, where the bytes `content[start:end]` are `img_url` encoded in UTF-8.
+    """
+    __slots__ = ("start", "end", "img_url")
+
+    def __init__(self, start, end, img_url):
+        self.start = start
+        self.end = end
+        self.img_url = img_url
+
+
+def decode_img_url(content, start, end):
+    return content[start:end].decode("utf-8", errors="replace")
+
+
+@contextmanager
+def map_md_file(md_path):
+    """
+    Memory-map a markdown file read-only, so only the pages scanned are loaded, no matter how large the file is.
+    Yield `b""` for an empty file, which cannot be mapped.
+    """
+    with open(md_path, "rb") as md:
+        if os.fstat(md.fileno()).st_size == 0:
+            yield b""
+            return
+
+        with mmap.mmap(md.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            yield content
+
+
+def scan_img_links(content):
+    """
+    Yield the spans of image links in `content`, bytes or a `mmap`.
+    The pattern starts with the literal `![`, so the regex engine jumps from one `![` to the next
+    instead of building a string per line.
+    """
+    for result in IMG_LINK_PATTERN.finditer(content):
+        # logging.debug(f"img_url match groups= {result.groups()}")
+        yield result.span(3)
+
+
+def iter_img_links(content, img_url_filter: ImageUrlFilter = None):
+    """
+    Yield the image links in `content` in order, one at a time,
+    excluding links which `img_url_filter` does not allow if it is given.
+    """
+    for start, end in scan_img_links(content):
+        link = decode_img_url(content, start, end)
+        if img_url_filter is None or img_url_filter.is_ok(link):
+            yield ImgLink(start, end, link)
+        else:
+            logging.info("excluding img_url\n  %s", link)
+
 
+def parse_img_links_in_md(md_path, img_url_filter: ImageUrlFilter = None):
+    """
+    Return the image links in a markdown file in order,
+    excluding links which `img_url_filter` does not allow if it is given.
+    """
     if not os.path.exists(md_path) or os.path.isdir(md_path):
-        return img_urls
+        return []
 
-    # markdown img ex: `![Alt text](https://i.imgur.com/bbb.png "Title Text")`
-    # https://regexr.com/7f2h2
-    pattern = r"\!\[(\"([^\n\r\"]*)\"|[^\n\r\]]*)\]\((https*:\/\/([^\)\"]+))(?:[ ]+\"[^\n\r\"]*\")?\)"
+    with map_md_file(md_path) as content:
+        return list(iter_img_links(content, img_url_filter))
 
-    with open(md_path, newline="", encoding="utf-8") as md:
-        for line in md:
-            results = re.finditer(pattern, line)
-            for result in results:
-                groups = result.groups()
-                # logging.debug(f"img_url match groups= {groups}")
-                alt, alt_without_quotes, link, link_without_protocol = groups
-                if img_url_filter.is_ok(link):
-                    img_urls.add(link)
-                else:
-                    logging.info(f"excluding img_url\n  {link}")
 
-    return img_urls
+def parse_img_urls_in_md(md_path, img_url_filter: ImageUrlFilter = None):
+    """
+    Return the distinct image URLs in a markdown file in the order of their first links.
+    Links are deduplicated as they are scanned, so memory grows with the distinct URLs, not with the links.
+    """
+    if not os.path.exists(md_path) or os.path.isdir(md_path):
+        return []
+
+    with map_md_file(md_path) as content:
+        return list(dict.fromkeys(img_link.img_url for img_link in iter_img_links(content, img_url_filter)))
+
+
+_parse_worker_img_url_filter: ImageUrlFilter = None
+
+
+def init_parse_worker(img_url_filter_rules, log_queue=None, log_level=logging.NOTSET):
+    """
+    Initialize a worker process parsing markdown files, which logs to `log_queue` of `get_worker_log_queue`.
+    """
+    global _parse_worker_img_url_filter
+    setup_worker_logging(log_queue, log_level)
+    _parse_worker_img_url_filter = ImageUrlFilter(img_url_filter_rules)
+
+
+def parse_img_urls_in_md_files_job(args):
+    md_dir_path, md_filenames = args
+    return [parse_img_urls_in_md(f"{md_dir_path}/{md_filename}", _parse_worker_img_url_filter)
+            for md_filename in md_filenames]
+
+
+def parse_img_urls_in_md_files(md_dir_path, md_filenames, img_url_filter_rules, parse_workers=PARSE_WORKERS,
+                               img_url_filter: ImageUrlFilter = None, executor: ProcessPoolExecutor = None):
+    """
+    Return a dict mapping each markdown file name to its distinct image URLs, in the order of `md_filenames`.
+
+    Files are parsed in chunks of `PARSE_CHUNK_SIZE` on `executor`, as scanning them is CPU-bound,
+    which is the process pool of a `SyncEngine`, whose workers are initialized by `init_parse_worker`
+    with the same rules.
+    Without `executor`, with at most `PARSE_SERIAL_MAX_FILES` files or with `parse_workers` of 1,
+    files are parsed in this process, filtered by `img_url_filter` if it is given.
+    """
+    if executor is None or parse_workers <= 1 or len(md_filenames) <= PARSE_SERIAL_MAX_FILES:
+        if img_url_filter is None:
+            img_url_filter = ImageUrlFilter(img_url_filter_rules)
+        return {md_filename: parse_img_urls_in_md(f"{md_dir_path}/{md_filename}", img_url_filter)
+                for md_filename in md_filenames}
+
+    chunks = [(md_dir_path, md_filenames[i:i + PARSE_CHUNK_SIZE])
+              for i in range(0, len(md_filenames), PARSE_CHUNK_SIZE)]
+    md_img_urls = {}
+    # `map` yields the results in the order of the chunks, so the merge does not depend on the scheduling
+    for (_, chunk), chunk_img_urls in zip(chunks, executor.map(parse_img_urls_in_md_files_job, chunks)):
+        md_img_urls.update(zip(chunk, chunk_img_urls))
+
+    return md_img_urls
 
 
 def generate_img_name(img_url):
@@ -472,26 +531,52 @@ def generate_img_dir_name(md_filename):
 
 def generate_img_index(md_dir_path, md_index_path,
                        old_img_index_path, img_index_path, tmp_img_index_path, delete_img_list_path,
-                       img_url_filter_path):
-    with open(img_url_filter_path, newline="", encoding="utf-8") as img_url_filter_f:
-        img_url_filter = ImageUrlFilter(img_url_filter_f.readlines())
-
-    with MdIndexReader(md_index_path) as md_index, \
-            ImgIndexReader(old_img_index_path) as old_img_index, \
-            ImgIndexWriter(img_index_path) as img_index, \
-            ImgIndexWriter(tmp_img_index_path) as tmp_img_index, \
+                       img_url_filter_path, index_backend=CSV_INDEX_BACKEND, parse_workers=PARSE_WORKERS,
+                       img_url_filter_rules=None, img_url_filter: ImageUrlFilter = None,
+                       parse_executor: ProcessPoolExecutor = None, md_filenames=None):
+    """
+    Return a dict mapping each parsed markdown file name, i.e. of a new or modified file, to its distinct image URLs.
+    The rules are read from `img_url_filter_path` unless `img_url_filter_rules` is given.
+
+    `md_filenames` are the names of the existing markdown files, which are looked up in `md_dir_path` by default.
+    The images of markdown files in the index which no longer exist are listed in `deleteImgList.txt`,
+    like images not used anymore, and dropped from the image index.
+    """
+    if img_url_filter_rules is None:
+        with open(img_url_filter_path, newline="", encoding="utf-8") as img_url_filter_f:
+            img_url_filter_rules = img_url_filter_f.readlines()
+
+    with index_backend.md_index_reader(md_index_path) as md_index:
+        md_records = list(md_index.list_record())
+
+    if md_filenames is None:
+        md_filenames = [md_record.filename for md_record in md_records
+                        if os.path.exists(f"{md_dir_path}/{md_record.filename}")]
+    md_filenames = set(md_filenames)
+
+    parsed_md_filenames = [md_record.filename for md_record in md_records
+                           if md_record.is_synced in (MdIndexIsSynced.N_FIRST, MdIndexIsSynced.N)
+                           and md_record.filename in md_filenames]
+    md_img_urls = parse_img_urls_in_md_files(md_dir_path, parsed_md_filenames, img_url_filter_rules,
+                                             parse_workers, img_url_filter, parse_executor)
+
+    with index_backend.img_index_reader(old_img_index_path) as old_img_index, \
+            index_backend.img_index_writer(img_index_path) as img_index, \
+            index_backend.img_index_writer(tmp_img_index_path) as tmp_img_index, \
             open(delete_img_list_path, mode="w", newline="", encoding="utf-8") as delete_img_list:
-        md_records = md_index.list_record()
         for md_record in md_records:
-            md_path = f"{md_dir_path}/{md_record.filename}"  # !!! md_path may not be existed.
+            if md_record.filename not in md_filenames:
+                # the images of a deleted file are not used anymore
+                for record in old_img_index.get_records_by_md_filename(md_record.filename):
+                    delete_img_list.write(f"{generate_img_dir_name(record.md_filename)}/{record.img_name}\n")
 
-            if not os.path.exists(md_path) \
-                    or md_record.is_synced == MdIndexIsSynced.Y:
+            # a synced file is not parsed
+            elif md_record.filename not in md_img_urls:
                 old_records = old_img_index.get_raw_records_by_md_filename(md_record.filename)
                 img_index.create_by_raw_records(old_records)
 
             elif md_record.is_synced == MdIndexIsSynced.N_FIRST:
-                img_urls = parse_img_urls_in_md(md_path, img_url_filter)
+                img_urls = dict.fromkeys(md_img_urls[md_record.filename])
                 # if img_urls:
                 #     logging.debug(f"image urls in `{md_record.filename}`\n  {img_urls}")
 
@@ -503,21 +588,20 @@ def generate_img_index(md_dir_path, md_index_path,
                     tmp_img_index.create(record)
 
             elif md_record.is_synced == MdIndexIsSynced.N:
-                img_urls = parse_img_urls_in_md(md_path, img_url_filter)
+                img_urls = dict.fromkeys(md_img_urls[md_record.filename])
                 # if img_urls:
                 #     logging.debug(f"image urls in `{md_record.filename}`\n  {img_urls}")
 
                 old_records = old_img_index.get_records_by_md_filename(md_record.filename)
 
-                old_img_urls = set()
                 old_record_index = {}
                 for r in old_records:
-                    old_img_urls.add(r.img_url)
                     old_record_index[r.img_url] = r
 
-                duplicate_img_urls = img_urls & old_img_urls
-                new_img_urls = img_urls - old_img_urls
-                deleted_img_urls = old_img_urls - img_urls
+                # lists in the order of the links, so the image index is the same for the same files
+                duplicate_img_urls = [img_url for img_url in img_urls if img_url in old_record_index]
+                new_img_urls = [img_url for img_url in img_urls if img_url not in old_record_index]
+                deleted_img_urls = [img_url for img_url in old_record_index if img_url not in img_urls]
 
                 for img_url in duplicate_img_urls:
                     record = old_record_index[img_url]
@@ -541,197 +625,335 @@ def generate_img_index(md_dir_path, md_index_path,
 
                     delete_img_list.write(f"{img_path}\n")
 
-
-def download_image_job(args):
-    md_filename, md_output_dir_path, tmp_img_index_path = args
-    logging.debug(f"download_image_job start `{md_filename}`")
-
-    download_ok_urls = []
-
-    img_dir_name = generate_img_dir_name(md_filename)
-    img_output_dir_path = f"{md_output_dir_path}/{img_dir_name}"
-    if not os.path.isdir(img_output_dir_path):
-        os.mkdir(img_output_dir_path)
-
-    with ImgIndexReader(tmp_img_index_path) as tmp_img_index:
-        records = tmp_img_index.get_records_by_md_filename(md_filename)
-
-    for record in records:
-        img_path = f"{img_output_dir_path}/{record.img_name}"
-
-        headers = {"User-Agent": ""}
-        req = Request(record.img_url, None, headers)
-
-        try:
-            response: HTTPResponse = urlopen(req)
-            with response, \
-                    open(img_path, "wb") as img:
-                while True:
-                    buf = response.read(IMG_BUF_SIZE)
-                    if len(buf) == 0:
-                        break
-                    img.write(buf)
-
-        except HTTPError as e:
-            logging.info(f"HTTP Error: {e.code}  `{record.img_url}`")
-        except URLError as e:
-            logging.info(f"We failed to reach a server: `{record.img_url}`\n    Reason: {e.reason}")
-        except Exception as e:
-            logging.error(f"\nException download image: `{record.img_url}`\n", exc_info=e)
+    return md_img_urls
+
+
+def open_download_engine(download_engine_name, download_workers=THREAD_POOL_MAX_WORKERS, host_limits: dict = None,
+                         connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                         executor: ThreadPoolExecutor = None):
+    """
+    Return the download engine named `download_engine_name`.
+    The thread engine downloads on `executor` if it is given, which should have `download_workers` threads.
+    """
+    retry_policy = RetryPolicy(max_retries)
+    if download_engine_name == "asyncio":
+        return AsyncDownloadEngine(download_workers, host_limits, connect_timeout, read_timeout, retry_policy)
+
+    return ThreadDownloadEngine(download_workers, host_limits, connect_timeout, read_timeout, retry_policy, executor)
+
+
+def list_downloaded_images(md_output_dir_path, img_index: ImgIndexReader):
+    """
+    Map image URLs to images already downloaded locally with HTTP validators,
+    which can be re-fetched conditionally.
+    """
+    downloaded_images = {}
+    for record in img_index.list_record():
+        if not record.is_downloaded or not (record.etag or record.last_modified) \
+                or record.img_url in downloaded_images:
+            continue
+
+        img_dir_name = generate_img_dir_name(record.md_filename)
+        img_path = f"{md_output_dir_path}/{img_dir_name}/{record.img_name}"
+        if os.path.isfile(img_path):
+            downloaded_images[record.img_url] = (img_path, DownloadResult(True, None,
+                                                                          record.etag,
+                                                                          record.last_modified,
+                                                                          record.content_length,
+                                                                          record.local_size))
+
+    return downloaded_images
+
+
+def download_images(md_output_dir_path, tmp_img_index: ImgIndexReader, download_engine=None,
+                    image_store: ImageStore = None, img_index: ImgIndexReader = None,
+                    journal: DownloadJournal = None):
+    """
+    Download images in `tmp_img_index`.
+
+    If `img_index` is given, an image already downloaded locally for any markdown file
+    is re-fetched conditionally with its HTTP validators, and reused if it is not modified.
+    If `journal` is given, each downloaded image is appended to it,
+    and an image completed in the journal of an interrupted sync is reused without any request.
+
+    Return `download_ok`, mapping each markdown file name to the set of its downloaded image URLs,
+    and `download_results`, mapping each image URL tried to download to its `DownloadResult`.
+    """
+    if download_engine is None:
+        download_engine = open_download_engine("thread")
+
+    md_filenames = tmp_img_index.list_md_filename()
+
+    tasks = []
+    for md_filename in md_filenames:
+        img_dir_name = generate_img_dir_name(md_filename)
+        img_output_dir_path = f"{md_output_dir_path}/{img_dir_name}"
+        os.makedirs(img_output_dir_path, exist_ok=True)
+
+        for record in tmp_img_index.get_records_by_md_filename(md_filename):
+            tasks.append(DownloadTask(md_filename, record.img_url, f"{img_output_dir_path}/{record.img_name}"))
+
+    # the same image URL can be used by many markdown files, so each URL is downloaded once
+    # and then materialized for the other markdown files
+    tasks_by_url = {}
+    for task in tasks:
+        consumers = tasks_by_url.get(task.img_url)
+        if consumers is None:
+            tasks_by_url[task.img_url] = consumers = []
+        consumers.append(task)
+
+    logging.info(f"\n=== All download_images Jobs {len(tasks_by_url)} URLs of {len(tasks)} images "
+                 f"in {len(md_filenames)} markdown files =============================\n")
+
+    downloaded_images = list_downloaded_images(md_output_dir_path, img_index) if img_index is not None else {}
+
+    resumed_results = []
+    download_tasks = []
+    for consumers in tasks_by_url.values():
+        task = consumers[0]
+        if journal is not None and resume_journaled_image(md_output_dir_path, task, journal):
+            resumed_results.append((task, journal.completed[task.img_url][1]))
+            continue
+
+        downloaded_image = downloaded_images.get(task.img_url)
+        if downloaded_image is not None:
+            downloaded_img_path, task.cached = downloaded_image
+            if os.path.abspath(downloaded_img_path) != os.path.abspath(task.img_path):
+                link_or_copy_image(downloaded_img_path, task.img_path)
+
+        download_tasks.append(task)
+
+    total_url_amount = dict.fromkeys(md_filenames, 0)
+    download_ok = {md_filename: set() for md_filename in md_filenames}
+    download_results = {}
+    not_modified_amount = 0
+
+    if resumed_results:
+        logging.info(f"download_images resumed {len(resumed_results)}/{len(tasks_by_url)} URLs from the journal")
+
+    # closed at once on an exception, so the engine stops the downloads still running
+    with closing(download_engine.run(download_tasks)) as engine_results:
+        for task, result in itertools.chain(resumed_results, engine_results):
+            if isinstance(result, Exception):
+                logging.error("\nException download_image `%s` in `%s`\n", task.img_url, task.md_filename,
+                              exc_info=result)
+                discard_stale_image(task.img_path, task.cached)
+                result = DownloadResult(False, error=get_error_class(result))
+
+            if journal is not None and result.ok and task.img_url not in journal.completed:
+                journal.append(task.img_url, get_relative_img_path(md_output_dir_path, task.img_path), result)
+
+            download_results[task.img_url] = result
+            not_modified_amount += int(result.is_not_modified)
+
+            for consumer in tasks_by_url[task.img_url]:
+                total_url_amount[consumer.md_filename] += 1
+                if not result.ok:
+                    continue
+
+                if consumer is task and image_store is not None:
+                    try:
+                        image_store.add(task.img_path)
+                    except OSError as e:
+                        logging.error("\nException add image `%s` to the image store\n", task.img_path, exc_info=e)
+
+                if consumer is not task:
+                    try:
+                        link_or_copy_image(task.img_path, consumer.img_path)
+                    except OSError as e:
+                        logging.error("\nException materialize image `%s` as `%s`\n", task.img_path, consumer.img_path,
+                                      exc_info=e)
+                        continue
+
+                download_ok[consumer.md_filename].add(consumer.img_url)
+
+    for md_filename in md_filenames:
+        download_ok_urls = download_ok[md_filename]
+        download_fail_amount = total_url_amount[md_filename] - len(download_ok_urls)
+        if download_fail_amount > 0:
+            logging.info("FailedRate download_images %d/%d `%s`\n  ok_urls= %s",
+                         download_fail_amount, total_url_amount[md_filename], md_filename, download_ok_urls)
         else:
-            download_ok_urls.append(record.img_url)
-
-    logging.debug(f"download_image_job end `{md_filename}`")
+            logging.debug("Result download_images `%s`\n  %d, %s",
+                          md_filename, total_url_amount[md_filename], download_ok_urls)
 
-    total_url_amount = len(records)
-    return md_filename, total_url_amount, download_ok_urls
+    logging.info(f"download_images not modified {not_modified_amount}/{len(download_tasks)} URLs")
 
+    return download_ok, download_results
 
-def download_images(md_output_dir_path, tmp_img_index_path):
-    with ImgIndexReader(tmp_img_index_path) as tmp_img_index:
-        md_filenames = tmp_img_index.list_md_filename()
 
-    logging.info(f"\n=== All download_images Jobs {len(md_filenames)} =============================\n")
+def get_relative_img_path(md_output_dir_path, img_path):
+    return os.path.relpath(img_path, md_output_dir_path).replace(os.sep, "/")
 
-    with ThreadPoolExecutor(THREAD_POOL_MAX_WORKERS) as executor:
-        futures = {}
-        for md_filename in md_filenames:
-            future = executor.submit(download_image_job,
-                                     (md_filename, md_output_dir_path, tmp_img_index_path))
-            futures[future] = md_filename
 
-    download_ok = {}
-    for future in as_completed(futures):
-        md_filename = futures[future]
-        try:
-            result = future.result()
-        except Exception as e:
-            logging.error(f"\nException download_image_job `{md_filename}`\n", exc_info=e)
-        else:
-            md_filename, total_url_amount, download_ok_urls = result
+def resume_journaled_image(md_output_dir_path, task: DownloadTask, journal: DownloadJournal):
+    """
+    Move the image of `task` completed in `journal` to the image path of `task`,
+    as the interrupted sync may have named it differently.
+    Return whether the image is resumed, i.e. it is complete and does not need to be downloaded.
+    """
+    completed = journal.completed.get(task.img_url)
+    if completed is None:
+        return False
 
-            download_fail_amount = total_url_amount - len(download_ok_urls)
-            if download_fail_amount > 0:
-                logging.info(
-                    f"FailedRate download_image_job {download_fail_amount}/{total_url_amount} `{md_filename}`\n"
-                    f"  ok_urls= {download_ok_urls}")
-            else:
-                logging.debug(f"Result download_image_job `{md_filename}`\n  {total_url_amount}, {download_ok_urls}")
+    journaled_img_path = f"{md_output_dir_path}/{completed[0]}"
+    if not os.path.isfile(journaled_img_path):
+        return False
 
-            download_ok[md_filename] = set(download_ok_urls)
+    if os.path.abspath(journaled_img_path) != os.path.abspath(task.img_path):
+        try:
+            os.replace(journaled_img_path, task.img_path)
+        except OSError as e:
+            logging.error("\nException resume image `%s` as `%s`\n", journaled_img_path, task.img_path, exc_info=e)
+            return False
 
-    return download_ok
+        # journal the new path, in case this sync is interrupted as well
+        journal.append(task.img_url, get_relative_img_path(md_output_dir_path, task.img_path), completed[1])
 
+    return True
 
-def mark_is_downloaded_in_img_index(img_index_path, download_ok: dict):
-    new_img_index_path = f"{img_index_path}.new"
-    with ImgIndexReader(img_index_path) as img_index, \
-            ImgIndexWriter(new_img_index_path) as new_img_index:
-        records = img_index.list_record()
-        EMPTY_SET = set()
-        for record in records:
-            if record.img_url in download_ok.get(record.md_filename, EMPTY_SET):
-                record.is_downloaded = True
 
-            new_img_index.create(record)
+def mark_is_downloaded_in_img_index(img_index_path, download_ok: dict, download_results: dict = None,
+                                    index_backend=CSV_INDEX_BACKEND):
+    index_backend.mark_is_downloaded(img_index_path, download_ok, download_results)
 
-    os.remove(img_index_path)
-    os.rename(new_img_index_path, img_index_path)
 
+def replace_img_urls_in_md(md_path, img_output_dir_path, images, img_links: list = None):
+    """
+    Splice the local paths of downloaded images into their links in a markdown file.
 
-def replace_img_urls_in_md(md_path, img_output_dir_path, images):
+    Links are scanned and spliced in one pass over the mapped file, and unchanged byte ranges are written
+    straight from it without copying them, so memory does not grow with the file.
+    `img_links` are the image links parsed before, which are spliced instead of scanning the file again,
+    unless the file is changed after it is parsed.
+    A file without any link to a downloaded image is not touched.
+    Return whether the file is rewritten.
+    """
     if not os.path.exists(md_path) or os.path.isdir(md_path):
-        return
-
-    # markdown img ex: `![Alt text](https://i.imgur.com/bbb.png "Title Text")`
-    # https://regexr.com/7f2h2
-    pattern = r"\!\[(\"([^\n\r\"]*)\"|[^\n\r\]]*)\]\((https*:\/\/([^\)\"]+))(?:[ ]+\"[^\n\r\"]*\")?\)"
-
-    def replace_img_url(match: Match):
-        ret = match.group()
-
-        groups = match.groups()
-        alt, alt_without_quotes, link, link_without_protocol = groups
-
-        record = images.get(link, None)
-        if record is not None and record.is_downloaded:
-            img_path = f"{img_output_dir_path}/{record.img_name}"
-            ret = ret.replace(link, img_path)
-
-        return ret
+        return False
 
     new_md_path = f"{md_path}.new"
-    with open(md_path, newline="", encoding="utf-8") as md, \
-            open(new_md_path, mode="w", newline="", encoding="utf-8") as new_md:
-        for line in md:
-            modified_line = re.sub(pattern, replace_img_url, line)
-            new_md.write(modified_line)
-
-    os.remove(md_path)
-    os.rename(new_md_path, md_path)
+    new_md = None
+    with map_md_file(md_path) as content:
+        is_scanned = img_links is None or any(decode_img_url(content, img_link.start, img_link.end) != img_link.img_url
+                                              for img_link in img_links)
+        # a scan stopped halfway is closed, so it releases the mapped file before it is unmapped
+        with closing(iter_img_links(content)) if is_scanned else nullcontext(img_links) as img_links, \
+                memoryview(content) as view:
+            try:
+                pos = 0
+                for img_link in img_links:
+                    record = images.get(img_link.img_url, None)
+                    if record is None or not record.is_downloaded:
+                        continue
+
+                    # the new file is created at the first link to a downloaded image
+                    if new_md is None:
+                        new_md = open(new_md_path, mode="wb")
+                    new_md.write(view[pos:img_link.start])
+                    new_md.write(f"{img_output_dir_path}/{record.img_name}".encode("utf-8"))
+                    pos = img_link.end
+
+                if new_md is not None:
+                    new_md.write(view[pos:])
+            finally:
+                if new_md is not None:
+                    new_md.close()
+
+    if new_md is None:
+        return False
+
+    os.replace(new_md_path, md_path)
+    return True
 
 
 def replace_img_url_with_downloaded_img_in_md_job(args):
-    md_filename, md_output_dir_path, img_index_path = args
-    logging.debug(f"replace_img_url_with_downloaded_img_in_md_job start `{md_filename}`")
-
-    with ImgIndexReader(img_index_path) as img_index:
-        records = img_index.get_records_by_md_filename(md_filename)
+    md_filename, md_output_dir_path, records = args
+    logging.debug("replace_img_url_with_downloaded_img_in_md_job start `%s`", md_filename)
 
+    is_replaced = False
     if len(records) > 0:
         md_path = f"{md_output_dir_path}/{md_filename}"
         img_dir_name = generate_img_dir_name(md_filename)
-        img_output_dir_path = f"./{img_dir_name}"
+        # the image directory is next to the markdown file, which can be in a subdirectory
+        img_output_dir_path = f"./{posixpath.basename(img_dir_name)}"
 
         images = {}
         for record in records:
             images[record.img_url] = record
 
-        replace_img_urls_in_md(md_path, img_output_dir_path, images)
+        is_replaced = replace_img_urls_in_md(md_path, img_output_dir_path, images)
+
+    logging.debug("replace_img_url_with_downloaded_img_in_md_job end `%s`", md_filename)
+    return is_replaced
 
-    logging.debug(f"replace_img_url_with_downloaded_img_in_md_job end `{md_filename}`")
 
+def replace_img_url_with_downloaded_img_in_md(md_output_dir_path, img_index: ImgIndexReader, md_filenames=None,
+                                              executor: ThreadPoolExecutor = None):
+    """
+    Replace image URLs with downloaded images in `md_filenames`, i.e. markdown files copied this time,
+    which are all files in `md_output_dir_path` by default.
 
-def replace_img_url_with_downloaded_img_in_md(md_output_dir_path, img_index_path):
-    md_filenames = set((fn for fn in os.listdir(md_output_dir_path) if os.path.isfile(f"{md_output_dir_path}/{fn}")))
+    Each file is scanned again while it is rewritten, instead of keeping the links of every file
+    parsed by `generate_img_index` in memory until the images are downloaded.
+    Files are rewritten on `executor` if it is given.
+    Return the number of rewritten markdown files.
+    """
+    if md_filenames is None:
+        md_filenames = list_filenames(md_output_dir_path)
 
     logging.info(f"\n=== All replace_img_url_with_downloaded_img_in_md Jobs {len(md_filenames)} ===================\n")
 
-    with ThreadPoolExecutor(THREAD_POOL_MAX_WORKERS) as executor:
+    with open_thread_pool(executor) as executor:
+        futures = []
         for md_filename in md_filenames:
-            executor.submit(replace_img_url_with_downloaded_img_in_md_job,
-                            (md_filename, md_output_dir_path, img_index_path))
+            futures.append(executor.submit(replace_img_url_with_downloaded_img_in_md_job,
+                                           (md_filename, md_output_dir_path,
+                                            img_index.get_records_by_md_filename(md_filename))))
 
+    replaced_amount = 0
+    for future in futures:
+        e = future.exception()
+        if e is not None:
+            logging.error("\nException replace_img_url_with_downloaded_img_in_md_job\n", exc_info=e)
+        elif future.result():
+            replaced_amount += 1
 
-def mark_is_synced_in_md_index(md_index_path, img_index_path):
-    new_md_index_path = f"{md_index_path}.new"
-    with MdIndexReader(md_index_path) as md_index, \
-            MdIndexWriter(new_md_index_path) as new_md_index, \
-            ImgIndexReader(img_index_path) as img_index:
-        records = md_index.list_record()
-        for record in records:
-            img_records = img_index.get_records_by_md_filename(record.filename)
+    logging.info(f"replace_img_url_with_downloaded_img_in_md rewrote {replaced_amount}/{len(md_filenames)} "
+                 f"markdown files")
+    return replaced_amount
+
+
+def mark_is_synced_in_md_index(md_index_path, img_index: ImgIndexReader, index_backend=CSV_INDEX_BACKEND,
+                               md_filenames=None):
+    """
+    Mark records of `md_filenames`, which are all records by default, as synced if all their images are downloaded.
+    """
+    index_backend.mark_is_synced(md_index_path, img_index, md_filenames)
 
-            is_all_downloaded = True
-            for img_record in img_records:
-                if not img_record.is_downloaded:
-                    is_all_downloaded = False
-                    break
-            record.is_synced = MdIndexIsSynced.Y if is_all_downloaded else record.is_synced
 
-            new_md_index.create(record)
+def collect_image_store_garbage(image_store: ImageStore, md_output_dir_path, img_index: ImgIndexReader):
+    img_paths = []
+    for record in img_index.list_record():
+        img_dir_name = generate_img_dir_name(record.md_filename)
+        img_paths.append(f"{md_output_dir_path}/{img_dir_name}/{record.img_name}")
 
-    os.remove(md_index_path)
-    os.rename(new_md_index_path, md_index_path)
+    return image_store.collect_garbage(img_paths)
 
 
 def make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_index_path, md_index_path,
-                   delete_img_list_path):
-    md_filenames = (fn for fn in os.listdir(md_output_dir_path) if os.path.isfile(f"{md_output_dir_path}/{fn}"))
+                   delete_img_list_path, download_results: dict = None, index_backend=CSV_INDEX_BACKEND,
+                   md_filenames=None, is_incremental=False):
+    """
+    Summarize `md_filenames`, which are all files in `md_output_dir_path` by default.
+    With `is_incremental`, the images in `deleteImgList.txt` have been removed, so they are not left to the user.
+    """
+    if md_filenames is None:
+        md_filenames = list_filenames(md_output_dir_path)
 
     with open(summary_path, mode="w", newline="", encoding="utf-8") as summary, \
-            ImgIndexReader(tmp_img_index_path) as tmp_img_index, \
-            MdIndexReader(md_index_path) as md_index:
+            index_backend.img_index_reader(tmp_img_index_path) as tmp_img_index, \
+            index_backend.md_index_reader(md_index_path) as md_index:
         img_amount = sum(1 for _ in tmp_img_index.list_record())
 
         md_amount = 0
@@ -758,8 +980,9 @@ def make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_ind
             f"total {md_amount} markdown files and {img_amount} images this time\n"
             f"see `index-markdown-tmp.csv` and `index-image-tmp.csv` for more detail about changes this time\n"
             f"see `index-markdown.csv` and `index-image.csv` for more detail about whole history\n"
-            f"If it's in update mode, you need to manually delete unused images listed in `deleteImgList.txt`.\n"
-            f"\n")
+            + (f"Unused images listed in `deleteImgList.txt` have been removed.\n" if is_incremental else
+               f"If it's in update mode, you need to manually delete unused images listed in `deleteImgList.txt`.\n")
+            + f"\n")
 
         summary.write(
             f"## Incomplete Sync\n"
@@ -773,7 +996,34 @@ def make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_ind
             for img_url in img_urls:
                 summary.write(f"    {img_url}\n")
 
-        if is_update_mode:
+        # images which took more than one attempt or failed in the end
+        retried_results = sorted(((img_url, result) for img_url, result in (download_results or {}).items()
+                                  if result.attempts > 1 or not result.ok),
+                                 key=lambda item: item[0])
+        summary.write(
+            f"\n"
+            f"## Download Attempts\n"
+            f"retried or failed image: {len(retried_results)}\n"
+            f"see the following:\n")
+
+        for img_url, result in retried_results:
+            if result.ok:
+                outcome = "ok"
+            elif result.status is not None:
+                outcome = f"{result.error} {result.status}"
+            else:
+                outcome = result.error
+            summary.write(f"{img_url}\n"
+                          f"    attempts: {result.attempts}, result: {outcome}\n")
+
+        if is_update_mode and is_incremental:
+            summary.write(f"\n")
+            summary.write("## Removed Images\n")
+            summary.write(f"`deleteImgList.txt` lists these unused images, which have been removed:\n")
+            with open(delete_img_list_path, newline="", encoding="utf-8") as delete_img_list:
+                summary.write(delete_img_list.read())
+
+        elif is_update_mode:
             summary.write(f"\n")
             summary.write("## Delete Manually by Yourself\n")
             summary.write("You can probably execute the following command to delete those images.\n")
@@ -785,12 +1035,246 @@ def make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_ind
         summary.write(f"\n\n\n")
 
 
-def sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path):
+def open_index_backend(index_backend_name, output_dir):
+    if index_backend_name == "sqlite":
+        return SqliteIndexBackend(f"{output_dir}/index.sqlite3")
+    if index_backend_name == "columnar":
+        return ColumnarIndexBackend()
+
+    return CsvIndexBackend()
+
+
+def get_previous_index(output_dir):
+    """
+    Return the indexes kept by `keep_previous_index`, or `[None, None]` if there are none.
+    """
+    old_md_index_path = f"{output_dir}/index-markdown-previous.csv"
+    old_img_index_path = f"{output_dir}/index-image-previous.csv"
+    if not os.path.isfile(old_md_index_path) or not os.path.isfile(old_img_index_path):
+        return [None, None]
+
+    return [old_md_index_path, old_img_index_path]
+
+
+def keep_previous_index(output_dir, index_backend=CSV_INDEX_BACKEND):
+    """
+    Keep the indexes of the previous run in `output_dir` as the old indexes of this run, i.e. sync in update mode.
+    Return `[None, None]` if there are no previous indexes, i.e. sync in create mode.
+    The indexes are moved in `index_backend` as well if it keeps them in memory or in a database.
+    """
+    md_index_path = f"{output_dir}/index-markdown.csv"
+    img_index_path = f"{output_dir}/index-image.csv"
+    # the indexes in memory may not be exported to their csv files yet
+    is_in_memory = isinstance(index_backend, MemoryIndexBackend) \
+        and index_backend.has_index(md_index_path) and index_backend.has_index(img_index_path)
+    if not is_in_memory and (not os.path.isfile(md_index_path) or not os.path.isfile(img_index_path)):
+        return [None, None]
+
+    old_md_index_path = f"{output_dir}/index-markdown-previous.csv"
+    old_img_index_path = f"{output_dir}/index-image-previous.csv"
+    for index_path, old_index_path in ((md_index_path, old_md_index_path), (img_index_path, old_img_index_path)):
+        if os.path.isfile(index_path):
+            os.replace(index_path, old_index_path)
+    if isinstance(index_backend, (MemoryIndexBackend, SqliteIndexBackend)):
+        index_backend.move_index(md_index_path, old_md_index_path)
+        index_backend.move_index(img_index_path, old_img_index_path)
+    logging.debug(f"keep previous md_index= {old_md_index_path}"
+                  f"\nkeep previous img_index= {old_img_index_path}")
+
+    return [old_md_index_path, old_img_index_path]
+
+
+class SyncEngine:
+    """
+    Sync markdown directories into output directories again and again in one process, such as a resident worker,
+    which calls `sync()` with explicit paths instead of importing this module or running `main()` per sync.
+
+    The engine holds the configuration, the image URL filter, the download engine, and the thread and process pools,
+    which stay warm between syncs until `close()`, so later syncs do not start threads and processes again,
+    and the decisions cached by the filter are reused.
+    With `keep_indexes` and the csv index backend, the indexes of each output directory stay in memory
+    in a `MemoryIndexBackend` between syncs, and are exported to their csv files at the end of every sync,
+    or by `flush_indexes()` for syncs without `flush_indexes`,
+    so an output directory must not be synced by another process in the meantime.
+    Logging is left as the caller has configured it.
+    """
+
+    def __init__(self, img_url_filter_path, index_backend_name="csv", download_workers=THREAD_POOL_MAX_WORKERS,
+                 host_limits: dict = None, download_engine_name="thread", use_image_store=False,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 parse_workers=PARSE_WORKERS, recursive=False, metrics_textfile_path=None,
+                 profile=False, profile_memory=False, keep_indexes=False):
+        with open(img_url_filter_path, newline="", encoding="utf-8") as img_url_filter_f:
+            self.img_url_filter_rules = img_url_filter_f.readlines()
+        self.img_url_filter_path = img_url_filter_path
+        self.img_url_filter = ImageUrlFilter(self.img_url_filter_rules)
+        self.index_backend_name = index_backend_name
+        self.use_image_store = use_image_store
+        self.parse_workers = parse_workers
+        self.recursive = recursive
+        self.metrics_textfile_path = metrics_textfile_path
+        self.profile = profile or profile_memory
+        self.profile_memory = profile_memory
+        self.keep_indexes = keep_indexes and index_backend_name == "csv"
+
+        # pools start their threads and processes on demand, so an unused pool costs nothing
+        self.thread_executor = ThreadPoolExecutor(THREAD_POOL_MAX_WORKERS)
+        self.download_executor = ThreadPoolExecutor(download_workers) if download_engine_name == "thread" else None
+        # workers log through the queue of the logging set up before the engine
+        self.parse_executor = ProcessPoolExecutor(parse_workers, initializer=init_parse_worker,
+                                                  initargs=(self.img_url_filter_rules, get_worker_log_queue(),
+                                                            logging.getLogger().level)) \
+            if parse_workers > 1 else None
+        self.download_engine = open_download_engine(download_engine_name, download_workers, host_limits,
+                                                    connect_timeout, read_timeout, max_retries,
+                                                    self.download_executor)
+        self._memory_index_backends = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e_type, e_value, traceback):
+        self.close()
+
+    def _open_index_backend(self, output_dir, is_output_kept):
+        if not self.keep_indexes:
+            return open_index_backend(self.index_backend_name, output_dir)
+
+        # the indexes in memory are only valid as long as their csv files are kept
+        index_backend = self._memory_index_backends.get(output_dir) if is_output_kept else None
+        if index_backend is None:
+            self._memory_index_backends[output_dir] = index_backend = MemoryIndexBackend()
+        return index_backend
+
+    def sync(self, md_dir_path, output_dir, md_url_index_path=None, old_md_index_path=None, old_img_index_path=None,
+             incremental=False, resume=False, tmp_dir=None, flush_indexes=True) -> SyncMetrics:
+        """
+        Sync markdown files in `md_dir_path` into `output_dir` and return the metrics of the sync.
+
+        The downloaded images are appended to `download-journal.jsonl` in `output_dir`,
+        which is removed once the sync is complete.
+        With `resume`, `output_dir` of an interrupted sync is kept and its journal is replayed,
+        so only the images which are still missing are downloaded.
+        The empty old indexes of create mode are written in `tmp_dir`, by default `tmp` in `output_dir`.
+        Without `flush_indexes`, the indexes kept in memory by `keep_indexes` are not exported at the end
+        of a successful sync, but by a later one, `flush_indexes()` or `close()`.
+        """
+        output_dir = os.path.abspath(output_dir)
+        tmp_dir = tmp_dir if tmp_dir is not None else f"{output_dir}/tmp"
+        journal_path = f"{output_dir}/download-journal.jsonl"
+        if resume:
+            # the journal is removed at the end of a complete sync, so it is only left by an interrupted one
+            resume = os.path.isfile(journal_path)
+            logging.info(f"sync_md resuming the interrupted sync of `{output_dir}`" if resume
+                         else f"sync_md has no interrupted sync to resume in `{output_dir}`")
+
+        if incremental or resume:
+            # the SQLite index is kept, and imports again only the csv indexes modified since its last run
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            if os.path.isdir(output_dir):
+                shutil.rmtree(output_dir)
+            os.mkdir(output_dir)
+
+        # the backend is opened in the prepared `output_dir`, as the SQLite backend connects to its file at once,
+        # and an interrupted sync may not have exported its indexes, so the indexes in memory are loaded from
+        # the csv files again
+        index_backend = self._open_index_backend(output_dir, incremental and not resume)
+        if incremental and (old_md_index_path is None or old_img_index_path is None):
+            # the interrupted sync has already kept the indexes of the run before it
+            [old_md_index_path, old_img_index_path] = get_previous_index(output_dir) if resume \
+                else keep_previous_index(output_dir, index_backend)
+
+        metrics = SyncMetrics(StageProfiler(f"{output_dir}/profile", self.profile_memory) if self.profile else None)
+        journal = DownloadJournal(journal_path, resume)
+        is_complete = False
+        try:
+            _sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, self.img_url_filter_path,
+                     output_dir, index_backend, self.download_engine,
+                     ImageStore(f"{output_dir}/ImageStore") if self.use_image_store else None, incremental,
+                     self.parse_workers, self.recursive, metrics, journal, tmp_dir, self.img_url_filter_rules,
+                     self.img_url_filter, self.thread_executor, self.parse_executor)
+            is_complete = True
+        finally:
+            # the indexes of a failed sync are exported before they are dropped from memory
+            if flush_indexes or not is_complete or not isinstance(index_backend, MemoryIndexBackend):
+                index_backend.close()
+            journal.close()
+            if isinstance(index_backend, MemoryIndexBackend):
+                if is_complete:
+                    # only the indexes kept as the old indexes of the next sync stay in memory
+                    index_backend.retain([f"{output_dir}/index-markdown.csv", f"{output_dir}/index-image.csv"])
+                else:
+                    del self._memory_index_backends[output_dir]
+
+        journal.remove()
+        write_metrics(metrics, output_dir, self.metrics_textfile_path)
+        return metrics
+
+    def flush_indexes(self):
+        """
+        Export the indexes in memory changed since they were exported last.
+        """
+        for index_backend in self._memory_index_backends.values():
+            index_backend.flush()
+
+    def close(self):
+        """
+        Export the indexes in memory, then shut down the pools.
+        """
+        for index_backend in self._memory_index_backends.values():
+            index_backend.close()
+        self._memory_index_backends.clear()
+
+        for executor in (self.thread_executor, self.download_executor, self.parse_executor):
+            if executor is not None:
+                executor.shutdown()
+
+
+def sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path,
+            index_backend_name="csv", download_workers=THREAD_POOL_MAX_WORKERS, host_limits: dict = None,
+            download_engine_name="thread", use_image_store=False,
+            connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+            incremental=False, parse_workers=PARSE_WORKERS, recursive=False, metrics_textfile_path=None,
+            profile=False, profile_memory=False, resume=False):
+    """
+    Sync markdown files into `output` once, with a `SyncEngine`. See `SyncEngine.sync`.
+    """
+    with SyncEngine(img_url_filter_path, index_backend_name, download_workers, host_limits, download_engine_name,
+                    use_image_store, connect_timeout, read_timeout, max_retries, parse_workers, recursive,
+                    metrics_textfile_path, profile, profile_memory) as engine:
+        engine.sync(md_dir_path, f"{os.getcwd()}/output", md_url_index_path, old_md_index_path, old_img_index_path,
+                    incremental, resume, f"{os.getcwd()}/tmp")
+
+
+def write_metrics(metrics: SyncMetrics, output_dir, metrics_textfile_path=None):
+    """
+    Write `metrics` to `metrics.json` in `output_dir`,
+    and to `metrics_textfile_path` in the Prometheus text format if it is given.
+    """
+    metrics.write_json(f"{output_dir}/metrics.json")
+    if metrics_textfile_path:
+        metrics.write_prometheus(metrics_textfile_path)
+
+
+def _sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path,
+             output_dir, index_backend, download_engine, image_store, incremental=False,
+             parse_workers=PARSE_WORKERS, recursive=False, metrics: SyncMetrics = None,
+             journal: DownloadJournal = None, tmp_dir=None, img_url_filter_rules=None,
+             img_url_filter: ImageUrlFilter = None, thread_executor: ThreadPoolExecutor = None,
+             parse_executor: ProcessPoolExecutor = None):
+    """
+    Sync markdown files into `output_dir`, recording the time of each stage and counters in `metrics` if it is given.
+    Downloaded images are appended to `journal` if it is given, and the images it has resumed are kept.
+    The empty old indexes of create mode are written in `tmp_dir` if it is given.
+    The filter and the pools are created per stage unless they are given, e.g. by a `SyncEngine`.
+    """
+    metrics = metrics if metrics is not None else SyncMetrics()
     is_update_mode = False
     if old_md_index_path is None or old_img_index_path is None:
         # in create mode
         logging.debug("sync_md_in_create_mode")
-        [old_md_index_path, old_img_index_path] = mock_old_index()
+        [old_md_index_path, old_img_index_path] = mock_old_index(index_backend, tmp_dir)
     else:
         # in update mode
         logging.debug("sync_md_in_update_mode")
@@ -802,38 +1286,198 @@ def sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_pat
                   f"old_md_index= {old_md_index_path}\n"
                   f"old_img_index= {old_img_index_path}\n"
                   f"img_url_filter= {img_url_filter_path}\n"
+                  f"index_backend= {index_backend.__class__.__name__}\n"
+                  f"download_engine= {download_engine.__class__.__name__}\n"
+                  f"image_store= {image_store.store_dir_path if image_store else None}\n"
+                  f"incremental= {incremental}\n"
+                  f"parse_workers= {parse_workers}\n"
+                  f"recursive= {recursive}\n"
+                  f"journal= {journal.journal_path if journal else None}\n"
                   f"==========================================================\n")
 
-    output_dir = f"{os.getcwd()}/output"
-    if os.path.isdir(output_dir):
-        shutil.rmtree(output_dir)
-    os.mkdir(output_dir)
-
     md_index_path = f"{output_dir}/index-markdown.csv"
     tmp_md_index_path = f"{output_dir}/index-markdown-tmp.csv"
-    generate_md_index(md_dir_path, md_url_index_path, old_md_index_path, md_index_path, tmp_md_index_path)
+    with metrics.stage("generate_md_index"):
+        md_filenames = generate_md_index(md_dir_path, md_url_index_path, old_md_index_path, md_index_path,
+                                         tmp_md_index_path, index_backend, recursive, thread_executor)
+    metrics.count("markdown_files", len(md_filenames))
+    existing_md_filenames = set(md_filenames)
+    if not recursive:
+        md_filenames = None  # all files in `SyncedMd`, which are the same as in `md_dir_path`
 
     md_output_dir_path = f"{output_dir}/SyncedMd"
-    copy_md_files(md_dir_path, md_output_dir_path)
+    copied_md_filenames = md_filenames  # all markdown files are copied
+    with metrics.stage("copy_md_files"):
+        if incremental:
+            copied_md_filenames = copy_modified_md_files(md_dir_path, md_output_dir_path, tmp_md_index_path,
+                                                         index_backend)
+            remove_deleted_md_files(md_dir_path, md_output_dir_path, md_index_path, index_backend)
+        else:
+            copy_md_files(md_dir_path, md_output_dir_path, keep_images=journal is not None and journal.is_resumed)
+    metrics.count("copied_markdown_files",
+                  len(copied_md_filenames) if copied_md_filenames is not None else metrics.counts["markdown_files"])
 
     img_index_path = f"{output_dir}/index-image.csv"
     tmp_img_index_path = f"{output_dir}/index-image-tmp.csv"
     delete_img_list_path = f"{output_dir}/deleteImgList.txt"
-    generate_img_index(md_output_dir_path, md_index_path,
-                       old_img_index_path, img_index_path, tmp_img_index_path, delete_img_list_path,
-                       img_url_filter_path)
-
-    download_ok = download_images(md_output_dir_path, tmp_img_index_path)
-    mark_is_downloaded_in_img_index(tmp_img_index_path, download_ok)
-    mark_is_downloaded_in_img_index(img_index_path, download_ok)
-
-    replace_img_url_with_downloaded_img_in_md(md_output_dir_path, img_index_path)
-    mark_is_synced_in_md_index(tmp_md_index_path, img_index_path)
-    mark_is_synced_in_md_index(md_index_path, img_index_path)
+    with metrics.stage("generate_img_index"):
+        md_img_urls = generate_img_index(md_output_dir_path, md_index_path,
+                                         old_img_index_path, img_index_path, tmp_img_index_path,
+                                         delete_img_list_path, img_url_filter_path, index_backend, parse_workers,
+                                         img_url_filter_rules, img_url_filter, parse_executor,
+                                         existing_md_filenames)
+        if incremental:
+            remove_deleted_images(md_output_dir_path, delete_img_list_path)
+    metrics.count("parsed_markdown_files", len(md_img_urls))
+
+    # each image index is parsed once here and shared read-only by the following stages and their workers
+    with index_backend.img_index_reader(tmp_img_index_path) as tmp_img_index, \
+            index_backend.img_index_reader(img_index_path) as img_index:
+        metrics.count("images", sum(1 for _ in tmp_img_index.list_record()))
+        with metrics.stage("download_images"):
+            download_ok, download_results = download_images(md_output_dir_path, tmp_img_index, download_engine,
+                                                            image_store, img_index, journal)
+    metrics.count("image_urls", len(download_results))
+    metrics.add_download_results(download_results)
+
+    with metrics.stage("mark_is_downloaded"):
+        mark_is_downloaded_in_img_index(tmp_img_index_path, download_ok, download_results, index_backend)
+        mark_is_downloaded_in_img_index(img_index_path, download_ok, download_results, index_backend)
+
+    with index_backend.img_index_reader(img_index_path) as img_index:
+        with metrics.stage("replace_img_urls"):
+            rewritten_amount = replace_img_url_with_downloaded_img_in_md(md_output_dir_path, img_index,
+                                                                         copied_md_filenames, thread_executor)
+        metrics.count("rewritten_markdown_files", rewritten_amount)
+
+        with metrics.stage("mark_is_synced"):
+            mark_is_synced_in_md_index(tmp_md_index_path, img_index, index_backend)
+            # deleted files stay unsynced
+            mark_is_synced_in_md_index(md_index_path, img_index, index_backend, existing_md_filenames)
+
+        if image_store is not None:
+            with metrics.stage("collect_image_store_garbage"):
+                collect_image_store_garbage(image_store, md_output_dir_path, img_index)
 
     summary_path = f"{output_dir}/summary.md"
-    make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_index_path, md_index_path,
-                   delete_img_list_path)
+    with metrics.stage("make_a_summary"):
+        make_a_summary(summary_path, is_update_mode, md_output_dir_path, tmp_img_index_path, md_index_path,
+                       delete_img_list_path, download_results, index_backend, md_filenames, incremental)
+
+
+def snapshot_md_dir(md_dir_path, recursive=False):
+    """
+    Return a dict mapping the name of each file in `md_dir_path` to its `(st_mtime_ns, st_size)`,
+    taken by one `scan_md_dir`, i.e. a batch of `os.scandir` calls instead of a stat call per known file.
+    """
+    return {md_filename: (md_stat.st_mtime_ns, md_stat.st_size)
+            for md_filename, md_stat in scan_md_dir(md_dir_path, recursive).items()}
+
+
+def diff_md_snapshots(old_snapshot: dict, new_snapshot: dict):
+    """
+    Return the names of files added, modified or deleted between two snapshots of `snapshot_md_dir`.
+    """
+    return set(md_filename for md_filename in old_snapshot.keys() | new_snapshot.keys()
+               if old_snapshot.get(md_filename) != new_snapshot.get(md_filename))
+
+
+def wait_for_md_changes(md_dir_path, snapshot: dict, recursive=False,
+                        poll_interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE, timeout=None):
+    """
+    Poll `md_dir_path` every `poll_interval` seconds until some files change,
+    then until no more files change for `debounce` seconds, so a burst of edits is returned at once.
+    Return the names of the touched files and the latest snapshot,
+    or an empty set and `snapshot` if nothing changes within `timeout` seconds.
+    """
+    started_at = time.monotonic()
+    touched_md_filenames = set()
+    changed_at = None
+    while True:
+        now = time.monotonic()
+        if changed_at is None:
+            if timeout is not None and now - started_at >= timeout:
+                return touched_md_filenames, snapshot
+            delay = poll_interval if timeout is None else min(poll_interval, started_at + timeout - now)
+        else:
+            if now - changed_at >= debounce:
+                return touched_md_filenames, snapshot
+            delay = min(poll_interval, changed_at + debounce - now)
+
+        time.sleep(max(delay, 0))
+        new_snapshot = snapshot_md_dir(md_dir_path, recursive)
+        changed_md_filenames = diff_md_snapshots(snapshot, new_snapshot)
+        if changed_md_filenames:
+            touched_md_filenames.update(changed_md_filenames)
+            changed_at = time.monotonic()
+        snapshot = new_snapshot
+
+
+def watch_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path,
+             download_workers=THREAD_POOL_MAX_WORKERS, host_limits: dict = None,
+             download_engine_name="thread", use_image_store=False,
+             connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+             parse_workers=PARSE_WORKERS, recursive=False,
+             poll_interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE, flush_interval=WATCH_FLUSH_INTERVAL,
+             metrics_textfile_path=None, profile=False, profile_memory=False):
+    """
+    Sync once in incremental mode, then sync again whenever files in `md_dir_path` change, until interrupted.
+
+    Each sync is a `SyncEngine.sync()` in incremental mode on one engine with `keep_indexes`,
+    so the image URL filter is read once, the pools stay warm, and the indexes stay in memory between syncs.
+    The indexes of each sync are the old indexes of the next one, like `index-*-previous.csv` of `--incremental`,
+    so a sync only hashes, copies and parses the touched files, and the files which are still not synced.
+    The indexes are flushed to their csv files every `flush_interval` seconds and on exit.
+    The metrics of each successful sync replace those of the previous one.
+    """
+    output_dir = f"{os.getcwd()}/output"
+    engine = SyncEngine(img_url_filter_path, "csv", download_workers, host_limits, download_engine_name,
+                        use_image_store, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                        max_retries=max_retries, parse_workers=parse_workers, recursive=recursive,
+                        metrics_textfile_path=metrics_textfile_path, profile=profile, profile_memory=profile_memory,
+                        keep_indexes=True)
+    try:
+        snapshot = snapshot_md_dir(md_dir_path, recursive)
+        touched_md_filenames = set(snapshot)
+        flushed_at = None  # the first sync is flushed at once, as the csv indexes are moved to `*-previous.csv`
+        while True:
+            if touched_md_filenames:
+                logging.info(f"watch_md syncing {len(touched_md_filenames)} touched files")
+                try:
+                    engine.sync(md_dir_path, output_dir, md_url_index_path, old_md_index_path, old_img_index_path,
+                                incremental=True, flush_indexes=False)
+                    # the indexes of this sync are kept as the old indexes of the next one
+                    [old_md_index_path, old_img_index_path] = [None, None]
+                except Exception as e:
+                    logging.error(f"\nException watch_md sync\n", exc_info=e)
+                    # the next sync starts again from the old indexes of the failed one
+                    if old_md_index_path is None or old_img_index_path is None:
+                        [old_md_index_path, old_img_index_path] = get_previous_index(output_dir)
+
+            if flushed_at is None or time.monotonic() - flushed_at >= flush_interval:
+                engine.flush_indexes()
+                flushed_at = time.monotonic()
+
+            touched_md_filenames, snapshot = wait_for_md_changes(
+                md_dir_path, snapshot, recursive, poll_interval, debounce,
+                max(flushed_at + flush_interval - time.monotonic(), 0))
+
+    except KeyboardInterrupt:
+        logging.info("watch_md stopped")
+    finally:
+        engine.close()
+
+
+def parse_host_limits(ap: argparse.ArgumentParser, host_limit_args):
+    host_limits = {}
+    for arg in host_limit_args:
+        host, sep, limit = arg.rpartition("=")
+        if not sep or not host or not limit.isdigit() or int(limit) < 1:
+            ap.error(f"argument --host-limit: invalid value `{arg}`, expected HOST=N with N >= 1")
+
+        host_limits[host.lower()] = int(limit)
+
+    return host_limits
 
 
 def main():
@@ -862,13 +1506,138 @@ def main():
                     help="input path of `imageUrlFilter.txt`\n"
                          "\n"
                          "User defines rules to limit which images can be downloaded.\n")
+    ap.add_argument("--index-backend", required=False, choices=INDEX_BACKENDS, default="csv",
+                    help="storage of the markdown index and the image index, default: csv\n"
+                         "\n"
+                         "`csv` rewrites the whole csv files on every status change.\n"
+                         "`sqlite` keeps the indexes in `index.sqlite3` and updates only changed rows,\n"
+                         "then exports the changed ones to the same csv files at the end.\n"
+                         "`index.sqlite3` is kept between `--incremental` runs.\n"
+                         "`columnar` stores the same csv files as `csv`, but keeps an image index in memory\n"
+                         "as columns of ints and strings instead of objects, for millions of images.\n")
+    ap.add_argument("--download-workers", required=False, type=int, metavar="N",
+                    default=THREAD_POOL_MAX_WORKERS,
+                    help=f"maximum number of images downloaded at the same time, default: {THREAD_POOL_MAX_WORKERS}\n"
+                         f"It is the number of threads with `--download-engine thread`.\n")
+    ap.add_argument("--host-limit", required=False, action="append", metavar="HOST=N", default=[],
+                    help="maximum number of images downloaded at the same time from HOST,\n"
+                         "e.g. `--host-limit i.imgur.com=4 --host-limit i.stack.imgur.com=2`\n")
+    ap.add_argument("--download-engine", required=False, choices=DOWNLOAD_ENGINES, default="thread",
+                    help="how images are downloaded, default: thread\n"
+                         "\n"
+                         "`thread` downloads each image with a new connection on a thread pool.\n"
+                         "`asyncio` downloads images on one event loop and reuses keep-alive connections per host,\n"
+                         "so `--download-workers` can be hundreds.\n")
+    ap.add_argument("--image-store", required=False, action="store_true",
+                    help="store each distinct image content once in `output/ImageStore`,\n"
+                         "and make the images of markdown files hardlinks to it\n")
+    ap.add_argument("--incremental", required=False, action="store_true",
+                    help="keep `output` of the previous run instead of recreating it\n"
+                         "\n"
+                         "Only new or modified markdown files are copied and downloaded images are kept.\n"
+                         "Copies of deleted markdown files and images listed in `deleteImgList.txt` are removed.\n"
+                         "Without `--old-index`, the indexes of the previous run are the old indexes.\n"
+                         "Downloaded images are re-fetched with `If-None-Match` / `If-Modified-Since`\n"
+                         "only in this mode, as create and update modes recreate `output`\n"
+                         "and download every image again.\n")
+    ap.add_argument("--resume", required=False, action="store_true",
+                    help="resume the sync interrupted in `output` with the same arguments\n"
+                         "\n"
+                         "Downloaded images are appended to `output/download-journal.jsonl` during a sync,\n"
+                         "which is removed once the sync is complete. `output` of an interrupted sync is kept,\n"
+                         "its journal is replayed and only the images which are still missing are downloaded.\n"
+                         "Without an interrupted sync, it syncs as usual.\n")
+    ap.add_argument("--connect-timeout", required=False, type=float, metavar="SEC", default=CONNECT_TIMEOUT,
+                    help=f"seconds to wait for connecting to a server, default: {CONNECT_TIMEOUT}\n")
+    ap.add_argument("--read-timeout", required=False, type=float, metavar="SEC", default=READ_TIMEOUT,
+                    help=f"seconds to wait for a server to send any data, default: {READ_TIMEOUT}\n")
+    ap.add_argument("--max-retries", required=False, type=int, metavar="N", default=MAX_RETRIES,
+                    help=f"maximum number of retries of an image after a timeout, a dropped connection\n"
+                         f"or a 408, 425, 429 or 5xx response, default: {MAX_RETRIES}\n"
+                         f"Retries wait for an exponential backoff with jitter, or `Retry-After` of the response.\n")
+    ap.add_argument("--recursive", required=False, action="store_true",
+                    help="include markdown files in subdirectories of the markdown directory, except hidden ones\n"
+                         "\n"
+                         "Files are named by their relative paths, e.g. `notes/a.md` in the indexes,\n"
+                         "and the image directory of each file is next to it, e.g. `SyncedMd/notes/a/`.\n")
+    ap.add_argument("--watch", required=False, action="store_true",
+                    help="keep running and sync in `--incremental` mode whenever markdown files change\n"
+                         "\n"
+                         "The indexes are kept in memory and flushed to the csv files periodically and on exit,\n"
+                         "so `--index-backend` must be `csv`. Stop it with Ctrl+C.\n")
+    ap.add_argument("--poll-interval", required=False, type=float, metavar="SEC", default=WATCH_POLL_INTERVAL,
+                    help=f"seconds between polls of the markdown directory with `--watch`, "
+                         f"default: {WATCH_POLL_INTERVAL}\n")
+    ap.add_argument("--debounce", required=False, type=float, metavar="SEC", default=WATCH_DEBOUNCE,
+                    help=f"seconds without any change before a sync with `--watch`, default: {WATCH_DEBOUNCE}\n")
+    ap.add_argument("--flush-interval", required=False, type=float, metavar="SEC", default=WATCH_FLUSH_INTERVAL,
+                    help=f"seconds between flushes of the indexes with `--watch`, default: {WATCH_FLUSH_INTERVAL}\n")
+    ap.add_argument("--parse-workers", required=False, type=int, metavar="N", default=PARSE_WORKERS,
+                    help=f"number of processes parsing image links in markdown files, default: the number of CPUs\n"
+                         f"At most {PARSE_SERIAL_MAX_FILES} markdown files, or N = 1, "
+                         f"are parsed in the main process.\n")
+    ap.add_argument("--metrics-textfile", required=False, metavar="sync_md.prom", default=None,
+                    help="also write the metrics of `output/metrics.json` to this path\n"
+                         "in the Prometheus text format, e.g. for the textfile collector of node_exporter\n")
+    ap.add_argument("--profile", required=False, action="store_true",
+                    help="profile each stage with cProfile and write `<stage>.prof`\n"
+                         "and a report of the top functions `<stage>.txt` into `output/profile`\n")
+    ap.add_argument("--profile-memory", required=False, action="store_true",
+                    help="also trace the memory allocated in each stage with tracemalloc in `--profile`,\n"
+                         "which slows the stages down considerably\n")
+    ap.add_argument("--log-level", required=False, choices=LOG_LEVELS, default="DEBUG",
+                    help="minimum level of messages logged to stdout and `log/sync_md.log`, default: DEBUG\n"
+                         "`INFO` skips the messages of every markdown file and image,\n"
+                         "which is faster with many markdown files and images.\n")
 
     args = vars(ap.parse_args())
+    if args["download_workers"] < 1:
+        ap.error("argument --download-workers: N must be >= 1")
+    if args["connect_timeout"] <= 0:
+        ap.error("argument --connect-timeout: SEC must be > 0")
+    if args["read_timeout"] <= 0:
+        ap.error("argument --read-timeout: SEC must be > 0")
+    if args["max_retries"] < 0:
+        ap.error("argument --max-retries: N must be >= 0")
+    if args["parse_workers"] < 1:
+        ap.error("argument --parse-workers: N must be >= 1")
+    if args["watch"] and args["resume"]:
+        ap.error("argument --resume: not allowed with --watch")
+    if args["watch"] and args["index_backend"] != "csv":
+        ap.error(f"argument --watch: not allowed with --index-backend {args['index_backend']}")
+    if args["poll_interval"] <= 0:
+        ap.error("argument --poll-interval: SEC must be > 0")
+    if args["debounce"] < 0:
+        ap.error("argument --debounce: SEC must be >= 0")
+    if args["flush_interval"] <= 0:
+        ap.error("argument --flush-interval: SEC must be > 0")
     md_dir_path = args["md_dir"]
     md_url_index_path = args["md_url_index"]
     old_md_index_path = args["old_index"][0]
     old_img_index_path = args["old_index"][1]
     img_url_filter_path = args["img_url_filter"]
+    index_backend_name = args["index_backend"]
+    download_workers = args["download_workers"]
+    host_limits = parse_host_limits(ap, args["host_limit"])
+    download_engine_name = args["download_engine"]
+    use_image_store = args["image_store"]
+    connect_timeout = args["connect_timeout"]
+    read_timeout = args["read_timeout"]
+    max_retries = args["max_retries"]
+    incremental = args["incremental"]
+    resume = args["resume"]
+    parse_workers = args["parse_workers"]
+    recursive = args["recursive"]
+    watch = args["watch"]
+    poll_interval = args["poll_interval"]
+    debounce = args["debounce"]
+    flush_interval = args["flush_interval"]
+    metrics_textfile_path = args["metrics_textfile"]
+    profile = args["profile"] or args["profile_memory"]
+    profile_memory = args["profile_memory"]
+    log_level = args["log_level"]
+
+    setup_logging(os.path.splitext(os.path.basename(__file__))[0], log_level, force=True)
 
     logging.debug(f"\n=== console params ====================================\n"
                   f"md_dir= {md_dir_path}\n"
@@ -876,6 +1645,26 @@ def main():
                   f"old_md_index= {old_md_index_path}\n"
                   f"old_img_index= {old_img_index_path}\n"
                   f"img_url_filter= {img_url_filter_path}\n"
+                  f"index_backend= {index_backend_name}\n"
+                  f"download_workers= {download_workers}\n"
+                  f"host_limits= {host_limits}\n"
+                  f"download_engine= {download_engine_name}\n"
+                  f"image_store= {use_image_store}\n"
+                  f"connect_timeout= {connect_timeout}\n"
+                  f"read_timeout= {read_timeout}\n"
+                  f"max_retries= {max_retries}\n"
+                  f"incremental= {incremental}\n"
+                  f"resume= {resume}\n"
+                  f"parse_workers= {parse_workers}\n"
+                  f"recursive= {recursive}\n"
+                  f"watch= {watch}\n"
+                  f"poll_interval= {poll_interval}\n"
+                  f"debounce= {debounce}\n"
+                  f"flush_interval= {flush_interval}\n"
+                  f"metrics_textfile= {metrics_textfile_path}\n"
+                  f"profile= {profile}\n"
+                  f"profile_memory= {profile_memory}\n"
+                  f"log_level= {log_level}\n"
                   f"=======================================================\n")
 
     md_dir_path = os.path.expanduser(md_dir_path)
@@ -883,8 +1672,20 @@ def main():
     old_md_index_path = os.path.expanduser(old_md_index_path) if old_md_index_path else old_md_index_path
     old_img_index_path = os.path.expanduser(old_img_index_path) if old_img_index_path else old_img_index_path
     img_url_filter_path = os.path.expanduser(img_url_filter_path) if img_url_filter_path else img_url_filter_path
+    metrics_textfile_path = os.path.expanduser(metrics_textfile_path) if metrics_textfile_path \
+        else metrics_textfile_path
+
+    if watch:
+        watch_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path,
+                 download_workers, host_limits, download_engine_name, use_image_store,
+                 connect_timeout, read_timeout, max_retries, parse_workers, recursive,
+                 poll_interval, debounce, flush_interval, metrics_textfile_path, profile, profile_memory)
+        return
 
-    sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path)
+    sync_md(md_dir_path, md_url_index_path, old_md_index_path, old_img_index_path, img_url_filter_path,
+            index_backend_name, download_workers, host_limits, download_engine_name, use_image_store,
+            connect_timeout, read_timeout, max_retries, incremental, parse_workers, recursive, metrics_textfile_path,
+            profile, profile_memory, resume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from download_journal import DownloadJournal, read_download_journal
+from downloader import DownloadResult
+from sync_index import ImgIndexReader, ImgIndexRecord, ImgIndexWriter
+from sync_md import download_images
+
+
+class RecordingDownloadEngine:
+    """
+    Download engine writing every image without any request, and recording the image URLs it is given.
+    """
+
+    def __init__(self):
+        self.img_urls = []
+
+    def run(self, tasks):
+        for task in tasks:
+            self.img_urls.append(task.img_url)
+            with open(task.img_path, mode="wb") as img:
+                img.write(b"img")
+            yield task, DownloadResult(True, 200, local_size=3)
+
+
+class TestDownloadJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_path = f"{self._tmp_dir.name}/download-journal.jsonl"
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_resume(self):
+        with DownloadJournal(self.journal_path, batch_size=1) as journal:
+            journal.append("https://i.imgur.com/a.png", "a/1-a.png", DownloadResult(True, 200, etag="\"a\"",
+                                                                                     local_size=10))
+        # a line torn by a killed process
+        with open(self.journal_path, mode="a", encoding="utf-8") as f:
+            f.write("{\"img_url\": \"https://i.imgur.com/b.p")
+
+        with DownloadJournal(self.journal_path, resume=True) as journal:
+            self.assertTrue(journal.is_resumed)
+            self.assertListEqual(list(journal.completed), ["https://i.imgur.com/a.png"])
+            img_path, result = journal.completed["https://i.imgur.com/a.png"]
+            self.assertEqual(img_path, "a/1-a.png")
+            self.assertEqual(result.etag, "\"a\"")
+            self.assertEqual(result.local_size, 10)
+
+        with DownloadJournal(self.journal_path) as journal:
+            self.assertDictEqual(journal.completed, {})
+        self.assertDictEqual(read_download_journal(self.journal_path), {})
+
+        journal.remove()
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_download_images_with_resumed_journal(self):
+        md_output_dir_path = f"{self._tmp_dir.name}/SyncedMd"
+        os.makedirs(f"{md_output_dir_path}/a")
+        # the interrupted sync downloaded `1.png` under another name, and the image of `2.png` is gone
+        with open(f"{md_output_dir_path}/a/9-1.png", mode="wb") as img:
+            img.write(b"img")
+        with DownloadJournal(self.journal_path) as journal:
+            journal.append("https://i.imgur.com/1.png", "a/9-1.png", DownloadResult(True, 200, local_size=3))
+            journal.append("https://i.imgur.com/2.png", "a/9-2.png", DownloadResult(True, 200, local_size=3))
+
+        tmp_img_index_path = f"{self._tmp_dir.name}/index-image-tmp.csv"
+        with ImgIndexWriter(tmp_img_index_path) as tmp_img_index:
+            for i in range(1, 4):
+                tmp_img_index.create(ImgIndexRecord("a.md", False, f"https://i.imgur.com/{i}.png", f"1-{i}.png"))
+            tmp_img_index.create(ImgIndexRecord("b.md", False, "https://i.imgur.com/1.png", "1-1.png"))
+
+        engine = RecordingDownloadEngine()
+        with DownloadJournal(self.journal_path, resume=True) as journal, \
+                ImgIndexReader(tmp_img_index_path) as tmp_img_index:
+            download_ok, download_results = download_images(md_output_dir_path, tmp_img_index, engine,
+                                                            journal=journal)
+
+        self.assertListEqual(engine.img_urls, ["https://i.imgur.com/2.png", "https://i.imgur.com/3.png"])
+        self.assertEqual(len(download_ok["a.md"]), 3)
+        self.assertSetEqual(download_ok["b.md"], {"https://i.imgur.com/1.png"})
+        self.assertFalse(os.path.exists(f"{md_output_dir_path}/a/9-1.png"))
+        self.assertTrue(os.path.isfile(f"{md_output_dir_path}/a/1-1.png"))
+        self.assertTrue(os.path.isfile(f"{md_output_dir_path}/b/1-1.png"))
+
+        completed = read_download_journal(self.journal_path)
+        self.assertListEqual(sorted(completed), [f"https://i.imgur.com/{i}.png" for i in range(1, 4)])
+        self.assertEqual(completed["https://i.imgur.com/1.png"][0], "a/1-1.png")
+
+
+if __name__ == '__main__':
+    unittest.main()
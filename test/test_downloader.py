@@ -0,0 +1,397 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from async_downloader import AsyncDownloadEngine
+from download_journal import DownloadJournal, read_download_journal
+from downloader import (DownloadTask, HostLimitedScheduler, RetryPolicy, ThreadDownloadEngine, get_host,
+                        link_or_copy_image, parse_retry_after)
+from sync_index import ImgIndexReader, ImgIndexRecord, ImgIndexWriter
+from sync_md import download_images
+
+
+class TestHostLimitedScheduler(unittest.TestCase):
+
+    def test_get_host(self):
+        self.assertEqual(get_host("https://i.imgur.com/AbC9.png"), "i.imgur.com")
+        self.assertEqual(get_host("http://LOCALHOST:8080/100.png"), "localhost:8080")
+
+    def test_run_with_host_limits(self):
+        tasks = [DownloadTask("a.md", f"https://i.imgur.com/{i}.png", f"a/{i}.png") for i in range(12)] \
+                + [DownloadTask("b.md", f"https://i.stack.imgur.com/{i}.png", f"b/{i}.png") for i in range(6)]
+
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+
+        def fn(task):
+            host = get_host(task.img_url)
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0), running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+            return True
+
+        scheduler = HostLimitedScheduler(4, {"i.stack.imgur.com": 1})
+        results = list(scheduler.run(tasks, fn))
+
+        self.assertEqual(len(results), len(tasks))
+        self.assertCountEqual([t.img_url for t, _ in results], [t.img_url for t in tasks])
+        self.assertEqual(max_running["i.stack.imgur.com"], 1)
+        self.assertLessEqual(max_running["i.imgur.com"], 4)
+        self.assertGreater(max_running["i.imgur.com"], 1)
+
+    def test_run_with_exception(self):
+        tasks = [DownloadTask("a.md", "https://i.imgur.com/1.png", "a/1.png")]
+
+        def fn(task):
+            raise ValueError(task.img_url)
+
+        results = list(HostLimitedScheduler(2).run(tasks, fn))
+        self.assertIsInstance(results[0][1], ValueError)
+
+
+class TestLinkOrCopyImage(unittest.TestCase):
+
+    def test_link_or_copy_image(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src_path = f"{tmp_dir}/1.png"
+            dst_path = f"{tmp_dir}/2.png"
+            with open(src_path, "wb") as img:
+                img.write(b"png")
+            with open(dst_path, "wb") as img:
+                img.write(b"old")
+
+            link_or_copy_image(src_path, dst_path)
+
+            with open(dst_path, "rb") as img:
+                self.assertEqual(img.read(), b"png")
+            self.assertTrue(os.path.samefile(src_path, dst_path))
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_get_delay(self):
+        retry_policy = RetryPolicy(3, 0.5, 4)
+        for retry in range(1, 10):
+            self.assertGreaterEqual(retry_policy.get_delay(retry), 0)
+            self.assertLessEqual(retry_policy.get_delay(retry), min(4, 0.5 * 2 ** (retry - 1)))
+        self.assertEqual(retry_policy.get_delay(1, 2), 2)
+        self.assertEqual(retry_policy.get_delay(1, 120), 4)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertGreater(parse_retry_after("Fri, 01 Jan 9999 00:00:00 GMT"), 0)
+        self.assertIsNone(parse_retry_after(""))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 64 * 1024
+    connection_amount = 0
+    body = bytes(range(256)) * 1000
+    etag = '"v1"'
+    request_amounts = {}
+    range_headers = []
+
+    def setup(self):
+        super().setup()
+        ImageRequestHandler.connection_amount += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        request_amount = ImageRequestHandler.request_amounts.get(self.path, 0) + 1
+        ImageRequestHandler.request_amounts[self.path] = request_amount
+
+        if self.path.startswith("/flaky/") and request_amount <= 2:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/flaky/"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+        elif self.path.startswith("/ranged/"):
+            range_header = self.headers.get("Range")
+            ImageRequestHandler.range_headers.append(range_header)
+            if range_header and self.headers.get("If-Range") == self.etag:
+                start = int(range_header[len("bytes="):-len("-")])
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+                self.send_header("Content-Length", str(len(self.body) - start))
+            else:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(self.body)))
+                start = 0
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            if request_amount == 1:
+                # the connection drops halfway
+                self.wfile.write(self.body[:len(self.body) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(self.body[start:])
+        elif self.path.startswith("/slow/"):
+            time.sleep(0.1)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+        elif self.path.startswith("/stalled/"):
+            time.sleep(0.5)
+            self.send_error(404)
+        elif self.path.startswith("/img/"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(self.body), 50_000):
+                chunk = self.body[i:i + 50_000]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == self.etag:
+                self.send_response(304)
+                self.send_header("ETag", self.etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", self.etag)
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+        elif self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/img/redirected.png")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+
+class SyncInterrupted(Exception):
+    pass
+
+
+class InterruptedDownloadJournal(DownloadJournal):
+    """
+    Journal interrupting the sync once an image is appended, like a sync killed halfway.
+    """
+
+    def append(self, img_url, img_path, result):
+        super().append(img_url, img_path, result)
+        raise SyncInterrupted(img_url)
+
+
+class TestDownloadEngine(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageRequestHandler)
+        cls.server.daemon_threads = True
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        ImageRequestHandler.connection_amount = 0
+        ImageRequestHandler.request_amounts = {}
+        ImageRequestHandler.range_headers = []
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _tasks(self, paths):
+        return [DownloadTask("a.md", f"{self.base_url}{path}", f"{self._tmp_dir.name}/{i}.png")
+                for i, path in enumerate(paths)]
+
+    def _assert_results(self, engine):
+        paths = [f"/img/{i}.png" for i in range(20)] + ["/chunked", "/redirect", "/missing.png"]
+        results = {t.img_url: (t, r) for t, r in engine.run(self._tasks(paths))}
+
+        self.assertEqual(len(results), len(paths))
+        for path in paths:
+            task, result = results[f"{self.base_url}{path}"]
+            if path == "/missing.png":
+                self.assertFalse(result.ok)
+            else:
+                self.assertTrue(result.ok)
+                self.assertEqual(result.local_size, len(ImageRequestHandler.body))
+                with open(task.img_path, "rb") as img:
+                    self.assertEqual(img.read(), ImageRequestHandler.body)
+
+    def _assert_conditional_results(self, engine):
+        task = self._tasks(["/etag"])[0]
+        _, result = next(engine.run([task]))
+        self.assertTrue(result.ok)
+        self.assertEqual(result.etag, ImageRequestHandler.etag)
+        self.assertFalse(result.is_not_modified)
+
+        # the local image is still valid, so nothing is written
+        task.cached = result
+        _, result = next(engine.run([task]))
+        self.assertTrue(result.is_not_modified)
+        self.assertEqual(result.local_size, len(ImageRequestHandler.body))
+
+        # the local image is truncated, so it is downloaded again
+        with open(task.img_path, "wb") as img:
+            img.write(b"png")
+        _, result = next(engine.run([task]))
+        self.assertFalse(result.is_not_modified)
+        with open(task.img_path, "rb") as img:
+            self.assertEqual(img.read(), ImageRequestHandler.body)
+
+        # the image linked for another markdown file fails to be re-fetched, so only the stale link is removed
+        linked_task = DownloadTask("b.md", f"{self.base_url}/missing.png", f"{self._tmp_dir.name}/linked.png",
+                                   result)
+        link_or_copy_image(task.img_path, linked_task.img_path)
+        _, linked_result = next(engine.run([linked_task]))
+        self.assertFalse(linked_result.ok)
+        self.assertFalse(os.path.exists(linked_task.img_path))
+        self.assertTrue(os.path.isfile(task.img_path))
+
+    def test_thread_download_engine(self):
+        self._assert_results(ThreadDownloadEngine(4))
+
+    def test_async_download_engine(self):
+        self._assert_results(AsyncDownloadEngine(4))
+
+        # keep-alive connections are reused instead of one connection per image
+        self.assertLessEqual(ImageRequestHandler.connection_amount, 4)
+
+    def test_conditional_download(self):
+        self._assert_conditional_results(ThreadDownloadEngine(1))
+        self._assert_conditional_results(AsyncDownloadEngine(1))
+
+    def _assert_other_host_not_blocked(self, engine_class):
+        # 127.0.0.1 is limited to one download at a time, and its images are slow
+        slow_host = f"127.0.0.1:{self.server.server_address[1]}"
+        tasks = [DownloadTask("a.md", f"http://{slow_host}/slow/{i}.png", f"{self._tmp_dir.name}/slow-{i}.png")
+                 for i in range(8)]
+        tasks += [DownloadTask("b.md", f"http://localhost:{self.server.server_address[1]}/img/{i}.png",
+                               f"{self._tmp_dir.name}/{i}.png") for i in range(6)]
+
+        started_at = time.monotonic()
+        elapsed_by_md_filename = {}
+        for task, result in engine_class(4, {slow_host: 1}).run(tasks):
+            self.assertTrue(result.ok)
+            elapsed_by_md_filename.setdefault(task.md_filename, time.monotonic() - started_at)
+        # images of the other host do not wait for the slow host to free the slots of all downloads
+        self.assertLess(elapsed_by_md_filename["b.md"], 0.3)
+
+    def test_other_host_not_blocked_by_host_limit(self):
+        self._assert_other_host_not_blocked(ThreadDownloadEngine)
+        self._assert_other_host_not_blocked(AsyncDownloadEngine)
+
+    def _assert_retried_results(self, engine):
+        paths = ["/flaky/1.png", "/stalled/1.png", "/missing.png"]
+        results = {t.img_url: r for t, r in engine.run(self._tasks(paths))}
+
+        # 503 twice with `Retry-After: 0`, then ok
+        result = results[f"{self.base_url}/flaky/1.png"]
+        self.assertTrue(result.ok)
+        self.assertEqual(result.attempts, 3)
+
+        # timed out on every attempt
+        result = results[f"{self.base_url}/stalled/1.png"]
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 4)
+        self.assertIn("timeout", result.error.lower())
+
+        # 404 is not retried
+        result = results[f"{self.base_url}/missing.png"]
+        self.assertFalse(result.ok)
+        self.assertEqual(result.attempts, 1)
+        self.assertEqual(result.status, 404)
+
+    def test_retried_download(self):
+        retry_policy = RetryPolicy(3, 0.01, 0.05)
+        self._assert_retried_results(ThreadDownloadEngine(4, connect_timeout=1, read_timeout=0.1,
+                                                          retry_policy=retry_policy))
+        ImageRequestHandler.request_amounts = {}
+        self._assert_retried_results(AsyncDownloadEngine(4, connect_timeout=1, read_timeout=0.1,
+                                                         retry_policy=retry_policy))
+
+    def _assert_resumed_results(self, engine_class):
+        task = self._tasks(["/ranged/1.png"])[0]
+
+        # the part file of a failed download is kept
+        _, result = next(engine_class(1, retry_policy=RetryPolicy(0)).run([task]))
+        self.assertFalse(result.ok)
+        self.assertFalse(os.path.exists(task.img_path))
+        self.assertEqual(os.path.getsize(f"{task.img_path}.part"), len(ImageRequestHandler.body) // 2)
+
+        # and resumed by the next download
+        _, result = next(engine_class(1).run([task]))
+        self.assertTrue(result.ok)
+        self.assertEqual(result.status, 206)
+        self.assertEqual(result.local_size, len(ImageRequestHandler.body))
+        self.assertEqual(result.content_length, len(ImageRequestHandler.body))
+        self.assertEqual(ImageRequestHandler.range_headers, [None, f"bytes={len(ImageRequestHandler.body) // 2}-"])
+        with open(task.img_path, "rb") as img:
+            self.assertEqual(img.read(), ImageRequestHandler.body)
+        self.assertEqual(os.listdir(self._tmp_dir.name), [os.path.basename(task.img_path)])
+
+    def test_resumed_download(self):
+        self._assert_resumed_results(ThreadDownloadEngine)
+        os.remove(self._tasks(["/ranged/1.png"])[0].img_path)
+        ImageRequestHandler.request_amounts = {}
+        ImageRequestHandler.range_headers = []
+        self._assert_resumed_results(AsyncDownloadEngine)
+
+    def test_async_download_engine_streams_results(self):
+        start = time.monotonic()
+        run = AsyncDownloadEngine(4).run(self._tasks(["/stalled/1.png"] + [f"/img/{i}.png" for i in range(3)]))
+        results = [next(run) for _ in range(3)]
+        # the images are yielded while the stalled request is still waiting
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertTrue(all(result.ok for _, result in results))
+        run.close()
+
+    def test_resume_interrupted_async_download(self):
+        md_output_dir_path = f"{self._tmp_dir.name}/SyncedMd"
+        journal_path = f"{self._tmp_dir.name}/download-journal.jsonl"
+        tmp_img_index_path = f"{self._tmp_dir.name}/index-image-tmp.csv"
+        paths = ["/stalled/1.png"] + [f"/img/{i}.png" for i in range(5)]
+        with ImgIndexWriter(tmp_img_index_path) as tmp_img_index:
+            for i, path in enumerate(paths):
+                tmp_img_index.create(ImgIndexRecord("a.md", False, f"{self.base_url}{path}", f"{i}.png"))
+
+        start = time.monotonic()
+        with InterruptedDownloadJournal(journal_path) as journal, \
+                ImgIndexReader(tmp_img_index_path) as tmp_img_index:
+            with self.assertRaises(SyncInterrupted) as cm:
+                download_images(md_output_dir_path, tmp_img_index, AsyncDownloadEngine(2), journal=journal)
+        # the first image is journaled as soon as it is downloaded, and the stalled request is cancelled
+        self.assertLess(time.monotonic() - start, 0.5)
+        journaled_img_url = str(cm.exception)
+        self.assertListEqual(list(read_download_journal(journal_path)), [journaled_img_url])
+
+        with DownloadJournal(journal_path, resume=True) as journal, \
+                ImgIndexReader(tmp_img_index_path) as tmp_img_index:
+            download_ok, _ = download_images(md_output_dir_path, tmp_img_index, AsyncDownloadEngine(2),
+                                             journal=journal)
+        self.assertEqual(len(download_ok["a.md"]), 5)
+        # the journaled image is not requested again
+        self.assertEqual(ImageRequestHandler.request_amounts[journaled_img_url[len(self.base_url):]], 1)
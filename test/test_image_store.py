@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+from image_store import ImageStore
+
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.store = ImageStore(f"{self._tmp_dir.name}/ImageStore")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write(self, name, content):
+        path = f"{self._tmp_dir.name}/{name}"
+        with open(path, "wb") as img:
+            img.write(content)
+        return path
+
+    def test_add(self):
+        img_path_1 = self._write("1.png", b"same")
+        img_path_2 = self._write("2.png", b"same")
+        img_path_3 = self._write("3.png", b"other")
+
+        blob_path_1 = self.store.add(img_path_1)
+        blob_path_2 = self.store.add(img_path_2)
+        blob_path_3 = self.store.add(img_path_3)
+
+        self.assertEqual(blob_path_1, blob_path_2)
+        self.assertNotEqual(blob_path_1, blob_path_3)
+        self.assertTrue(os.path.samefile(img_path_1, img_path_2))
+        self.assertTrue(os.path.samefile(img_path_3, blob_path_3))
+        self.assertEqual(sum(1 for _ in self.store.list_blob_path()), 2)
+
+    def test_collect_garbage(self):
+        img_path_1 = self._write("1.png", b"used")
+        img_path_2 = self._write("2.png", b"unused")
+        self.store.add(img_path_1)
+        blob_path_2 = self.store.add(img_path_2)
+        os.remove(img_path_2)
+
+        removed_blob_paths = self.store.collect_garbage([img_path_1, img_path_2])
+
+        self.assertListEqual(removed_blob_paths, [blob_path_2])
+        self.assertTrue(os.path.exists(img_path_1))
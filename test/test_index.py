@@ -0,0 +1,330 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from columnar_index import ColumnarImgIndexReader, ColumnarIndexBackend
+from memory_index import MemoryIndexBackend
+from sqlite_index import SqliteIndexBackend
+from sync_index import CsvIndexBackend, ImgIndexReader, ImgIndexRecord, ImgIndexWriter, MdIndexIsSynced, \
+    MdIndexReader, MdIndexRecord, MdIndexWriter
+
+
+class TestMdIndexReader(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_index_path = f"{self._tmp_dir.name}/index-markdown.csv"
+        self.modified_date = datetime.datetime(2018, 1, 1, 1, 1, 1, 123456).astimezone()
+
+        with MdIndexWriter(self.md_index_path) as md_index:
+            md_index.create(MdIndexRecord("b.md", "https://hackmd.io/bbb", MdIndexIsSynced.Y, self.modified_date,
+                                          "3b1f"))
+            md_index.create(MdIndexRecord("a.md", None, MdIndexIsSynced.N_FIRST, self.modified_date))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_list_filename(self):
+        with MdIndexReader(self.md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["b.md", "a.md"])
+            self.assertTrue(md_index.has_filename("a.md"))
+            self.assertFalse(md_index.has_filename("c.md"))
+
+    def test_get_record_by_filename(self):
+        with MdIndexReader(self.md_index_path) as md_index:
+            record = md_index.get_record_by_filename("b.md")
+            self.assertEqual(record.md_url, "https://hackmd.io/bbb")
+            self.assertEqual(record.is_synced, MdIndexIsSynced.Y)
+            self.assertEqual(record.modified_date, self.modified_date)
+            self.assertEqual(record.content_hash, "3b1f")
+
+            raw = md_index.get_raw_record_by_filename("a.md")
+            self.assertDictEqual(raw, {"FileName": "a.md",
+                                       "MdUrl": "",
+                                       "ModifiedDate": self.modified_date.strftime("%Y/%m/%d %H:%M:%S.%f %z"),
+                                       "IsSynced": "-1",
+                                       "ContentHash": ""})
+
+            self.assertIsNone(md_index.get_record_by_filename("c.md"))
+
+    def test_read_md_index_without_optional_fields(self):
+        old_md_index_path = f"{self._tmp_dir.name}/old-index-markdown.csv"
+        with open(old_md_index_path, mode="w", newline="", encoding="utf-8") as old_md_index:
+            old_md_index.write('"FileName","MdUrl","ModifiedDate","IsSynced"\n'
+                               '"a.md","","2018/01/01 01:01:01.123456 +0000","1"\n')
+
+        with MdIndexReader(old_md_index_path) as md_index:
+            record = md_index.get_record_by_filename("a.md")
+            self.assertEqual(record.is_synced, MdIndexIsSynced.Y)
+            self.assertIsNone(record.content_hash)
+
+    def test_read_md_index_with_duplicate_filename(self):
+        with MdIndexWriter(self.md_index_path) as md_index:
+            md_index.create(MdIndexRecord("a.md", "https://hackmd.io/first", MdIndexIsSynced.Y, self.modified_date))
+            md_index.create(MdIndexRecord("b.md", None, MdIndexIsSynced.N, self.modified_date))
+            md_index.create(MdIndexRecord("a.md", "https://hackmd.io/last", MdIndexIsSynced.N, self.modified_date))
+
+        with self.assertLogs(level="WARNING") as logs, MdIndexReader(self.md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["a.md", "b.md"])
+            self.assertEqual(md_index.get_record_by_filename("a.md").md_url, "https://hackmd.io/first")
+            self.assertListEqual([r.md_url for r in md_index.list_record()], ["https://hackmd.io/first", ""])
+        self.assertIn("duplicate file name `a.md`", logs.output[0])
+
+    def test_get_record_by_filename_returns_copy(self):
+        with MdIndexReader(self.md_index_path) as md_index:
+            record = md_index.get_record_by_filename("b.md")
+            record.is_synced = MdIndexIsSynced.N
+
+            self.assertEqual(md_index.get_record_by_filename("b.md").is_synced, MdIndexIsSynced.Y)
+            self.assertListEqual([r.filename for r in md_index.list_record()], ["b.md", "a.md"])
+
+
+class TestImgIndexReader(unittest.TestCase):
+    reader_class = ImgIndexReader
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.img_index_path = f"{self._tmp_dir.name}/index-image.csv"
+
+        with ImgIndexWriter(self.img_index_path) as img_index:
+            img_index.create(ImgIndexRecord("a.md", True, "https://i.imgur.com/1.png", "1-1.png"))
+            img_index.create(ImgIndexRecord("b.md", False, "https://i.imgur.com/2.png", "2-2.png"))
+            img_index.create(ImgIndexRecord("a.md", False, "https://i.imgur.com/3.png", "3-3.png"))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_get_records_by_md_filename(self):
+        with self.reader_class(self.img_index_path) as img_index:
+            self.assertListEqual(img_index.list_md_filename(), ["a.md", "b.md"])
+
+            records = img_index.get_records_by_md_filename("a.md")
+            self.assertListEqual([(r.img_url, r.is_downloaded) for r in records],
+                                 [("https://i.imgur.com/1.png", True), ("https://i.imgur.com/3.png", False)])
+
+            self.assertListEqual(img_index.get_records_by_md_filename("c.md"), [])
+
+    def test_get_raw_records_by_md_filename(self):
+        with self.reader_class(self.img_index_path) as img_index:
+            raw_records = img_index.get_raw_records_by_md_filename("b.md")
+            self.assertListEqual(raw_records, [{"MdFileName": "b.md",
+                                                "IsDownloaded": "0",
+                                                "ImageUrl": "https://i.imgur.com/2.png",
+                                                "ImageName": "2-2.png",
+                                                "ETag": "",
+                                                "LastModified": "",
+                                                "ContentLength": "",
+                                                "LocalSize": ""}])
+
+    def test_read_img_index_without_optional_fields(self):
+        old_img_index_path = f"{self._tmp_dir.name}/old-index-image.csv"
+        with open(old_img_index_path, mode="w", newline="", encoding="utf-8") as old_img_index:
+            old_img_index.write('"MdFileName","IsDownloaded","ImageUrl","ImageName"\n'
+                                '"a.md","1","https://i.imgur.com/1.png","1-1.png"\n')
+
+        with self.reader_class(old_img_index_path) as img_index:
+            record = img_index.get_records_by_md_filename("a.md")[0]
+            self.assertTrue(record.is_downloaded)
+            self.assertIsNone(record.etag)
+            self.assertIsNone(record.local_size)
+
+    def test_read_img_index_with_optional_fields(self):
+        with ImgIndexWriter(self.img_index_path) as img_index:
+            img_index.create(ImgIndexRecord("a.md", True, "https://i.imgur.com/1.png", "1-1.png",
+                                            "\"abc\"", "Mon, 01 Jan 2018 01:01:01 GMT", 0, 1024))
+
+        with self.reader_class(self.img_index_path) as img_index:
+            record = img_index.get_records_by_md_filename("a.md")[0]
+            self.assertEqual(record.etag, "\"abc\"")
+            self.assertEqual(record.last_modified, "Mon, 01 Jan 2018 01:01:01 GMT")
+            self.assertEqual(record.content_length, 0)
+            self.assertEqual(record.local_size, 1024)
+            self.assertIn("'local_size': 1024", str(record))
+
+    def test_list_record(self):
+        with self.reader_class(self.img_index_path) as img_index:
+            self.assertListEqual([r.img_url for r in img_index.list_record()],
+                                 ["https://i.imgur.com/1.png", "https://i.imgur.com/3.png",
+                                  "https://i.imgur.com/2.png"])
+            self.assertFalse(hasattr(next(img_index.list_record()), "__dict__"))
+
+
+class TestColumnarImgIndexReader(TestImgIndexReader):
+    reader_class = ColumnarImgIndexReader
+
+    def test_read_same_records_as_csv_reader(self):
+        with ImgIndexWriter(self.img_index_path) as img_index:
+            img_index.create(ImgIndexRecord("a.md", True, "https://i.imgur.com/1.png", "1-1.png",
+                                            "\"abc\"", "Mon, 01 Jan 2018 01:01:01 GMT", 0, 1024))
+            img_index.create(ImgIndexRecord("b.md", False, "https://i.imgur.com/2.png", ""))
+            img_index.create(ImgIndexRecord("b.md", True, "", None, "", ""))
+
+        with ImgIndexReader(self.img_index_path) as csv_img_index, \
+                ColumnarImgIndexReader(self.img_index_path) as columnar_img_index:
+            self.assertListEqual([str(r) for r in columnar_img_index.list_record()],
+                                 [str(r) for r in csv_img_index.list_record()])
+            for md_filename in ("a.md", "b.md"):
+                self.assertListEqual(columnar_img_index.get_raw_records_by_md_filename(md_filename),
+                                     csv_img_index.get_raw_records_by_md_filename(md_filename))
+
+        # records read by the columnar reader are written back unchanged
+        with ColumnarImgIndexReader(self.img_index_path) as columnar_img_index:
+            records = list(columnar_img_index.list_record())
+        round_trip_img_index_path = f"{self._tmp_dir.name}/round-trip-index-image.csv"
+        with ImgIndexWriter(round_trip_img_index_path) as img_index:
+            for record in records:
+                img_index.create(record)
+        with open(self.img_index_path, encoding="utf-8") as img_index, \
+                open(round_trip_img_index_path, encoding="utf-8") as round_trip_img_index:
+            self.assertEqual(round_trip_img_index.read(), img_index.read())
+
+
+class TestIndexBackend(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_index_path = f"{self._tmp_dir.name}/index-markdown.csv"
+        self.img_index_path = f"{self._tmp_dir.name}/index-image.csv"
+        modified_date = datetime.datetime(2018, 1, 1, 1, 1, 1, 123456).astimezone()
+
+        with MdIndexWriter(self.md_index_path) as md_index:
+            md_index.create(MdIndexRecord("a.md", None, MdIndexIsSynced.N_FIRST, modified_date))
+            md_index.create(MdIndexRecord("b.md", None, MdIndexIsSynced.N, modified_date))
+            md_index.create(MdIndexRecord("c.md", None, MdIndexIsSynced.N, modified_date))
+
+        with ImgIndexWriter(self.img_index_path) as img_index:
+            img_index.create(ImgIndexRecord("a.md", False, "https://i.imgur.com/1.png", "1-1.png"))
+            img_index.create(ImgIndexRecord("b.md", False, "https://i.imgur.com/2.png", "2-2.png"))
+            img_index.create(ImgIndexRecord("b.md", False, "https://i.imgur.com/3.png", "3-3.png"))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _mark(self, index_backend):
+        download_ok = {"a.md": {"https://i.imgur.com/1.png"}, "b.md": {"https://i.imgur.com/2.png"}}
+        index_backend.mark_is_downloaded(self.img_index_path, download_ok)
+
+        with index_backend.img_index_reader(self.img_index_path) as img_index:
+            index_backend.mark_is_synced(self.md_index_path, img_index)
+
+        index_backend.close()
+
+    def _assert_marked(self):
+        with ImgIndexReader(self.img_index_path) as img_index:
+            self.assertListEqual([r.is_downloaded for r in img_index.list_record()], [True, True, False])
+
+        with MdIndexReader(self.md_index_path) as md_index:
+            self.assertListEqual([r.is_synced for r in md_index.list_record()],
+                                 [MdIndexIsSynced.Y, MdIndexIsSynced.N, MdIndexIsSynced.Y])
+
+    def test_csv_index_backend(self):
+        self._mark(CsvIndexBackend())
+        self._assert_marked()
+
+    def test_sqlite_index_backend(self):
+        self._mark(SqliteIndexBackend(f"{self._tmp_dir.name}/index.sqlite3"))
+        self._assert_marked()
+
+    def test_columnar_index_backend(self):
+        self._mark(ColumnarIndexBackend())
+        self._assert_marked()
+
+    def test_memory_index_backend(self):
+        self._mark(MemoryIndexBackend())
+        self._assert_marked()
+
+    def test_mark_is_synced_of_md_filenames(self):
+        index_backends = [CsvIndexBackend(), SqliteIndexBackend(f"{self._tmp_dir.name}/index.sqlite3"),
+                          ColumnarIndexBackend(), MemoryIndexBackend()]
+        for index_backend in index_backends:
+            name = index_backend.__class__.__name__
+            with self.subTest(index_backend=name):
+                md_index_path = f"{self._tmp_dir.name}/{name}-index-markdown.csv"
+                shutil.copyfile(self.md_index_path, md_index_path)
+                # c.md, e.g. a deleted file, has no images but is not marked
+                with index_backend.img_index_reader(self.img_index_path) as img_index:
+                    index_backend.mark_is_synced(md_index_path, img_index, {"a.md", "b.md"})
+                index_backend.close()
+
+                with MdIndexReader(md_index_path) as md_index:
+                    self.assertListEqual([r.is_synced for r in md_index.list_record()],
+                                         [MdIndexIsSynced.N_FIRST, MdIndexIsSynced.N, MdIndexIsSynced.N])
+
+    def test_memory_index_backend_reader_and_writer(self):
+        index_backend = MemoryIndexBackend()
+        new_img_index_path = f"{self._tmp_dir.name}/index-image-new.csv"
+        previous_md_index_path = f"{self._tmp_dir.name}/index-markdown-previous.csv"
+
+        with index_backend.img_index_reader(self.img_index_path) as img_index, \
+                index_backend.img_index_writer(new_img_index_path) as new_img_index:
+            self.assertListEqual(img_index.list_md_filename(), ["a.md", "b.md"])
+            new_img_index.create_by_raw_records(img_index.get_raw_records_by_md_filename("b.md"))
+
+        with index_backend.md_index_reader(self.md_index_path) as md_index:
+            record = md_index.get_record_by_filename("a.md")
+            record.is_synced = MdIndexIsSynced.Y
+        with index_backend.md_index_reader(self.md_index_path) as md_index:
+            self.assertEqual(md_index.get_record_by_filename("a.md").is_synced, MdIndexIsSynced.N_FIRST)
+
+        index_backend.move_index(self.md_index_path, previous_md_index_path)
+        self.assertFalse(os.path.exists(new_img_index_path))
+        index_backend.flush()
+
+        with ImgIndexReader(new_img_index_path) as new_img_index:
+            self.assertListEqual([r.img_url for r in new_img_index.list_record()],
+                                 ["https://i.imgur.com/2.png", "https://i.imgur.com/3.png"])
+        with MdIndexReader(previous_md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["a.md", "b.md", "c.md"])
+
+    def test_sqlite_index_backend_reader_and_writer(self):
+        index_backend = SqliteIndexBackend(f"{self._tmp_dir.name}/index.sqlite3")
+        new_img_index_path = f"{self._tmp_dir.name}/index-image-new.csv"
+
+        with index_backend.img_index_reader(self.img_index_path) as img_index, \
+                index_backend.img_index_writer(new_img_index_path) as new_img_index:
+            self.assertListEqual(img_index.list_md_filename(), ["a.md", "b.md"])
+            new_img_index.create_by_raw_records(img_index.get_raw_records_by_md_filename("b.md"))
+
+        with index_backend.md_index_reader(self.md_index_path) as md_index:
+            self.assertTrue(md_index.has_filename("b.md"))
+            self.assertFalse(md_index.has_filename("d.md"))
+            self.assertEqual(md_index.get_record_by_filename("a.md").is_synced, MdIndexIsSynced.N_FIRST)
+
+        index_backend.close()
+
+        with ImgIndexReader(new_img_index_path) as new_img_index:
+            self.assertListEqual([r.img_url for r in new_img_index.list_record()],
+                                 ["https://i.imgur.com/2.png", "https://i.imgur.com/3.png"])
+
+    def test_sqlite_index_backend_kept_between_runs(self):
+        db_path = f"{self._tmp_dir.name}/index.sqlite3"
+        previous_md_index_path = f"{self._tmp_dir.name}/index-markdown-previous.csv"
+        index_backend = SqliteIndexBackend(db_path)
+        with index_backend.md_index_reader(self.md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["a.md", "b.md", "c.md"])
+        index_backend.close()
+
+        # a csv file modified with the same mtime is not imported again
+        mtime_ns = os.stat(self.md_index_path).st_mtime_ns
+        with MdIndexWriter(self.md_index_path) as md_index:
+            md_index.create(MdIndexRecord("d.md", None, MdIndexIsSynced.N_FIRST, datetime.datetime.now().astimezone()))
+        os.utime(self.md_index_path, ns=(mtime_ns, mtime_ns))
+        index_backend = SqliteIndexBackend(db_path)
+        with index_backend.md_index_reader(self.md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["a.md", "b.md", "c.md"])
+
+        # the index is moved with its csv file
+        os.replace(self.md_index_path, previous_md_index_path)
+        index_backend.move_index(self.md_index_path, previous_md_index_path)
+        with index_backend.md_index_reader(previous_md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["a.md", "b.md", "c.md"])
+        index_backend.close()
+
+        # a csv file modified after the last run is imported again
+        os.utime(previous_md_index_path, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+        index_backend = SqliteIndexBackend(db_path)
+        with index_backend.md_index_reader(previous_md_index_path) as md_index:
+            self.assertListEqual(md_index.list_filename(), ["d.md"])
+        index_backend.close()
@@ -0,0 +1,71 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import log_config
+from log_config import setup_logging, stop_logging
+from sync_md import PARSE_SERIAL_MAX_FILES, SyncEngine, parse_img_urls_in_md_files
+
+
+class TestSetupLogging(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self._root_level = logging.getLogger().level
+
+    def tearDown(self):
+        stop_logging()
+        logging.getLogger().setLevel(self._root_level)
+        self._tmp_dir.cleanup()
+
+    def test_setup_logging(self):
+        with mock.patch.object(log_config, "LOG_DIR", self._tmp_dir.name):
+            setup_logging("test", logging.INFO, force=True)
+            # without `force`, logging is set up only once
+            setup_logging("other", logging.DEBUG)
+
+            logging.debug("skipped %s", "debug")
+            thread = threading.Thread(target=logging.info, args=("logged `%s`", "a.png"), name="Downloader")
+            thread.start()
+            thread.join()
+            stop_logging()
+
+        with open(f"{self._tmp_dir.name}/test.log", encoding="utf-8") as log:
+            lines = log.read().splitlines()
+
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("[MainProcess] [Downloader] [INFO] logged `a.png`"))
+        self.assertEqual(logging.getLogger().level, logging.INFO)
+        self.assertEqual(logging.getLogger().handlers, [])
+
+    def test_log_from_parse_workers(self):
+        md_dir_path = f"{self._tmp_dir.name}/vault"
+        os.mkdir(md_dir_path)
+        md_filenames = [f"{i}.md" for i in range(PARSE_SERIAL_MAX_FILES + 1)]
+        for md_filename in md_filenames:
+            with open(f"{md_dir_path}/{md_filename}", mode="w", encoding="utf-8") as md:
+                md.write("![skipped](https://example.com/1.png)\n")
+        img_url_filter_path = f"{self._tmp_dir.name}/imageUrlFilter.txt"
+        with open(img_url_filter_path, mode="w", encoding="utf-8") as img_url_filter:
+            img_url_filter.write("!https://example.com/\n")
+
+        with mock.patch.object(log_config, "LOG_DIR", self._tmp_dir.name):
+            setup_logging("test", logging.INFO, force=True)
+            with SyncEngine(img_url_filter_path, parse_workers=2) as engine:
+                md_img_urls = parse_img_urls_in_md_files(md_dir_path, md_filenames, engine.img_url_filter_rules,
+                                                          2, executor=engine.parse_executor)
+            stop_logging()
+
+        self.assertTrue(all(img_urls == [] for img_urls in md_img_urls.values()))
+        with open(f"{self._tmp_dir.name}/test.log", encoding="utf-8") as log:
+            lines = [line for line in log.read().splitlines() if line.endswith("[INFO] excluding img_url")]
+        # every worker process logs to the log file of the main process
+        self.assertEqual(len(lines), len(md_filenames))
+        self.assertNotIn("[MainProcess]", lines[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+
+from downloader import DownloadResult
+from metrics import SyncMetrics, get_percentile
+
+
+class TestSyncMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.metrics = SyncMetrics()
+        self.metrics.add_download_results({
+            "https://i.imgur.com/a.png": DownloadResult(True, 200, local_size=100, elapsed=0.2),
+            "https://i.imgur.com/b.png": DownloadResult(True, 304, local_size=50, attempts=2, elapsed=0.1),
+            "https://i.imgur.com/c.png": DownloadResult(False, 503, attempts=3, error="HTTPError", elapsed=0.3),
+            "https://i.stack.imgur.com/d.png": DownloadResult(True, 200, local_size=300, elapsed=0.5),
+        })
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_get_percentile(self):
+        values = [float(i) for i in range(1, 11)]
+        self.assertEqual(get_percentile(values, 0.5), 5.0)
+        self.assertEqual(get_percentile(values, 0.9), 9.0)
+        self.assertEqual(get_percentile(values, 0.99), 10.0)
+        self.assertEqual(get_percentile(values, 0.0), 1.0)
+        self.assertIsNone(get_percentile([], 0.5))
+
+    def test_add_download_results(self):
+        self.assertEqual(self.metrics.counts["requests"], 7)
+        self.assertEqual(self.metrics.counts["retries"], 3)
+        self.assertEqual(self.metrics.counts["downloaded_images"], 2)
+        self.assertEqual(self.metrics.counts["not_modified_images"], 1)
+        self.assertEqual(self.metrics.counts["failed_images"], 1)
+        self.assertEqual(self.metrics.counts["downloaded_bytes"], 400)
+
+        hosts = self.metrics.to_dict()["hosts"]
+        self.assertListEqual(list(hosts), ["i.imgur.com", "i.stack.imgur.com"])
+        self.assertEqual(hosts["i.imgur.com"]["downloaded_bytes"], 100)
+        self.assertEqual(hosts["i.imgur.com"]["latency_seconds"], {"0.5": 0.2, "0.9": 0.3, "0.99": 0.3})
+
+    def test_write_json(self):
+        with self.metrics.stage("download_images"):
+            pass
+        self.metrics.count("markdown_files", 2)
+
+        metrics_path = f"{self._tmp_dir.name}/metrics.json"
+        self.metrics.write_json(metrics_path)
+        with open(metrics_path, encoding="utf-8") as f:
+            metrics = json.load(f)
+
+        self.assertListEqual(list(metrics["stage_seconds"]), ["download_images"])
+        self.assertEqual(metrics["counts"]["markdown_files"], 2)
+        self.assertGreaterEqual(metrics["total_seconds"], metrics["stage_seconds"]["download_images"])
+
+    def test_write_prometheus(self):
+        with self.metrics.stage("download_images"):
+            pass
+
+        textfile_path = f"{self._tmp_dir.name}/sync_md.prom"
+        self.metrics.write_prometheus(textfile_path)
+        with open(textfile_path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+
+        self.assertFalse(os.path.exists(f"{textfile_path}.new"))
+        self.assertIn("# TYPE sync_md_host_latency_seconds summary", lines)
+        self.assertIn('sync_md_host_requests{host="i.imgur.com"} 6', lines)
+        self.assertIn('sync_md_host_latency_seconds{host="i.stack.imgur.com",quantile="0.5"} 0.5', lines)
+        self.assertIn('sync_md_host_latency_seconds_count{host="i.imgur.com"} 3', lines)
+        self.assertTrue(any(line.startswith('sync_md_stage_seconds{stage="download_images"} ') for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
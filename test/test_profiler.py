@@ -0,0 +1,40 @@
+import os
+import pstats
+import tempfile
+import unittest
+
+from metrics import SyncMetrics
+from profiler import StageProfiler
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.profile_dir_path = f"{self._tmp_dir.name}/profile"
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_stage(self):
+        metrics = SyncMetrics(StageProfiler(self.profile_dir_path, trace_memory=True))
+        for _ in range(2):
+            with metrics.stage("parse"):
+                sorted(str(i) for i in range(1000))
+
+        self.assertSetEqual(set(os.listdir(self.profile_dir_path)), {"parse.prof", "parse.txt"})
+        self.assertIn("parse", metrics.stage_times)
+
+        stats = pstats.Stats(f"{self.profile_dir_path}/parse.prof")
+        sorted_calls = [calls for (_, _, name), (calls, *_) in stats.stats.items()
+                        if name == "<built-in method builtins.sorted>"]
+        self.assertListEqual(sorted_calls, [2])
+
+        with open(f"{self.profile_dir_path}/parse.txt", encoding="utf-8") as report:
+            report = report.read()
+        self.assertIn("=== parse: top 25 functions by cumulative time ===", report)
+        self.assertIn("=== parse: memory ===", report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,435 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from downloader import DownloadResult
+from sync_index import ImgIndexReader, ImgIndexRecord, MdIndexIsSynced, MdIndexReader, MdIndexWriter
+from sync_md import PARSE_SERIAL_MAX_FILES, SyncEngine, diff_md_snapshots, generate_img_index, generate_md_index, \
+    init_parse_worker, mock_old_index, parse_img_links_in_md, parse_img_urls_in_md_files, replace_img_urls_in_md, \
+    scan_md_dir, snapshot_md_dir, wait_for_md_changes
+from url_filter import ImageUrlFilter
+
+
+class TestReplaceImgUrlsInMd(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_path = f"{self._tmp_dir.name}/a.md"
+        with open(self.md_path, mode="w", newline="", encoding="utf-8") as md:
+            md.write("# A\r\n"
+                     "![one](https://i.imgur.com/1.png) ![two](https://i.imgur.com/2.png \"title\")\r\n"
+                     "![\"three\"](https://i.stack.imgur.com/3.png)\n"
+                     "![one again](https://i.imgur.com/1.png)")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _read_md(self):
+        with open(self.md_path, newline="", encoding="utf-8") as md:
+            return md.read()
+
+    def test_parse_img_links_in_md(self):
+        img_links = parse_img_links_in_md(self.md_path, ImageUrlFilter(["https://i.imgur.com/"]))
+        self.assertListEqual([img_link.img_url for img_link in img_links],
+                             ["https://i.imgur.com/1.png", "https://i.imgur.com/2.png", "https://i.imgur.com/1.png"])
+
+        with open(self.md_path, mode="rb") as md:
+            content = md.read()
+        for img_link in img_links:
+            self.assertEqual(content[img_link.start:img_link.end], img_link.img_url.encode("utf-8"))
+
+    def test_parse_img_links_in_md_with_multibyte_text(self):
+        with open(self.md_path, mode="w", newline="", encoding="utf-8") as md:
+            md.write("# 圖片\r![一](https://i.imgur.com/圖.png)\r"
+                     "![broken](https://i.imgur.com/\r4.png) ![二](https://i.imgur.com/5.png)")
+
+        img_links = parse_img_links_in_md(self.md_path)
+        self.assertListEqual([img_link.img_url for img_link in img_links],
+                             ["https://i.imgur.com/圖.png", "https://i.imgur.com/5.png"])
+
+        images = {"https://i.imgur.com/5.png": ImgIndexRecord("a.md", True, "https://i.imgur.com/5.png", "5-5.png")}
+        self.assertTrue(replace_img_urls_in_md(self.md_path, "./圖", images, img_links))
+        self.assertEqual(self._read_md(),
+                         "# 圖片\r![一](https://i.imgur.com/圖.png)\r"
+                         "![broken](https://i.imgur.com/\r4.png) ![二](./圖/5-5.png)")
+
+    def test_parse_img_links_in_empty_md(self):
+        open(self.md_path, mode="w").close()
+        self.assertListEqual(parse_img_links_in_md(self.md_path), [])
+
+    def test_replace_img_urls_in_md(self):
+        img_links = parse_img_links_in_md(self.md_path)
+        images = {"https://i.imgur.com/1.png": ImgIndexRecord("a.md", True, "https://i.imgur.com/1.png", "1-1.png"),
+                  "https://i.imgur.com/2.png": ImgIndexRecord("a.md", False, "https://i.imgur.com/2.png", "2-2.png")}
+
+        self.assertTrue(replace_img_urls_in_md(self.md_path, "./a", images, img_links))
+        self.assertEqual(self._read_md(),
+                         "# A\r\n"
+                         "![one](./a/1-1.png) ![two](https://i.imgur.com/2.png \"title\")\r\n"
+                         "![\"three\"](https://i.stack.imgur.com/3.png)\n"
+                         "![one again](./a/1-1.png)")
+
+    def test_replace_img_urls_in_md_by_scanning(self):
+        stale_img_links = parse_img_links_in_md(self.md_path)
+        changed = "# A changed\n![one](https://i.imgur.com/1.png) ![three](https://i.stack.imgur.com/3.png)"
+        images = {"https://i.imgur.com/1.png": ImgIndexRecord("a.md", True, "https://i.imgur.com/1.png", "1-1.png"),
+                  "https://i.stack.imgur.com/3.png": ImgIndexRecord("a.md", True, "https://i.stack.imgur.com/3.png",
+                                                                    "3-3.png")}
+        expected = "# A changed\n![one](./a/1-1.png) ![three](./a/3-3.png)"
+
+        # the links are scanned again if none are given or the given ones are stale
+        for img_links in [None, stale_img_links]:
+            with self.subTest(is_stale=img_links is not None):
+                with open(self.md_path, mode="w", newline="", encoding="utf-8") as md:
+                    md.write(changed)
+                self.assertTrue(replace_img_urls_in_md(self.md_path, "./a", images, img_links))
+                self.assertEqual(self._read_md(), expected)
+
+    def test_replace_img_urls_in_md_without_downloaded_images(self):
+        images = {"https://i.imgur.com/2.png": ImgIndexRecord("a.md", False, "https://i.imgur.com/2.png", "2-2.png")}
+        mtime = os.path.getmtime(self.md_path)
+
+        self.assertFalse(replace_img_urls_in_md(self.md_path, "./a", images))
+        self.assertEqual(os.path.getmtime(self.md_path), mtime)
+
+
+class TestParseImgUrlsInMdFiles(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_filenames = []
+        for i in range(PARSE_SERIAL_MAX_FILES + 10):
+            md_filename = f"{i}.md"
+            with open(f"{self._tmp_dir.name}/{md_filename}", mode="w", encoding="utf-8") as md:
+                md.write(f"![a](https://i.imgur.com/{i}.png)\n"
+                         f"![b](https://example.com/{i}.png) ![c](https://i.imgur.com/{i}-{i}.png)\n")
+            self.md_filenames.append(md_filename)
+        self.md_filenames.reverse()
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_parse_img_urls_in_md_files(self):
+        rules = ["https://i.imgur.com/"]
+        serial = parse_img_urls_in_md_files(self._tmp_dir.name, self.md_filenames, rules, 1)
+        with ProcessPoolExecutor(3, initializer=init_parse_worker, initargs=(rules,)) as executor:
+            parallel = parse_img_urls_in_md_files(self._tmp_dir.name, self.md_filenames, rules, 3,
+                                                  executor=executor)
+
+        self.assertListEqual(list(parallel), self.md_filenames)
+        self.assertListEqual(list(parallel.items()), list(serial.items()))
+        self.assertListEqual(parallel["7.md"], ["https://i.imgur.com/7.png", "https://i.imgur.com/7-7.png"])
+
+    def test_parse_img_urls_in_md_files_on_executor(self):
+        rules = ["https://i.imgur.com/"]
+        serial = parse_img_urls_in_md_files(self._tmp_dir.name, self.md_filenames, rules, 1)
+        with ProcessPoolExecutor(2, initializer=init_parse_worker, initargs=(rules,)) as executor:
+            # the workers of the executor are reused
+            for _ in range(2):
+                parallel = parse_img_urls_in_md_files(self._tmp_dir.name, self.md_filenames, rules, 2,
+                                                      executor=executor)
+                self.assertListEqual(list(parallel.items()), list(serial.items()))
+
+
+class TestScanMdDir(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        for path in ("a.md", "notes/b.md", "notes/deep/c.md", "notes/deep/er/d.md", ".git/e.md"):
+            os.makedirs(os.path.dirname(f"{self._tmp_dir.name}/{path}"), exist_ok=True)
+            with open(f"{self._tmp_dir.name}/{path}", mode="w", encoding="utf-8") as md:
+                md.write(path)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_scan_md_dir(self):
+        self.assertListEqual(sorted(scan_md_dir(self._tmp_dir.name)), ["a.md"])
+
+    def test_scan_md_dir_recursively(self):
+        md_stats = scan_md_dir(self._tmp_dir.name, recursive=True)
+        self.assertListEqual(sorted(md_stats), ["a.md", "notes/b.md", "notes/deep/c.md", "notes/deep/er/d.md"])
+        self.assertEqual(md_stats["notes/deep/c.md"].st_size, len("notes/deep/c.md"))
+
+    def test_diff_md_snapshots(self):
+        snapshot = snapshot_md_dir(self._tmp_dir.name, recursive=True)
+        os.remove(f"{self._tmp_dir.name}/a.md")
+        with open(f"{self._tmp_dir.name}/notes/b.md", mode="a", encoding="utf-8") as md:
+            md.write("changed")
+        with open(f"{self._tmp_dir.name}/notes/f.md", mode="w", encoding="utf-8") as md:
+            md.write("new")
+
+        self.assertSetEqual(diff_md_snapshots(snapshot, snapshot_md_dir(self._tmp_dir.name, recursive=True)),
+                            {"a.md", "notes/b.md", "notes/f.md"})
+
+    def test_wait_for_md_changes_timeout(self):
+        snapshot = snapshot_md_dir(self._tmp_dir.name)
+        touched_md_filenames, new_snapshot = wait_for_md_changes(self._tmp_dir.name, snapshot,
+                                                                 poll_interval=0.05, timeout=0.1)
+        self.assertSetEqual(touched_md_filenames, set())
+        self.assertDictEqual(new_snapshot, snapshot)
+
+
+class TestGenerateMdIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_dir_path = f"{self._tmp_dir.name}/vault"
+        os.mkdir(self.md_dir_path)
+        for md_filename in ("a.md", "b.md"):
+            self._write_md(md_filename, "![one](https://i.imgur.com/1.png)\n")
+        self.img_url_filter_path = f"{self._tmp_dir.name}/imageUrlFilter.txt"
+        with open(self.img_url_filter_path, mode="w", encoding="utf-8") as img_url_filter:
+            img_url_filter.write("https://i.imgur.com/\n")
+
+        # the first sync, in which every file has been synced
+        [self.old_md_index_path, self.old_img_index_path] = mock_old_index(tmp_dir=f"{self._tmp_dir.name}/mock")
+        self.synced_md_index_path = f"{self._tmp_dir.name}/index-markdown-synced.csv"
+        generate_md_index(self.md_dir_path, None, self.old_md_index_path, self.synced_md_index_path,
+                          f"{self._tmp_dir.name}/index-markdown-synced-tmp.csv")
+        with MdIndexReader(self.synced_md_index_path) as md_index:
+            records = list(md_index.list_record())
+        with MdIndexWriter(self.synced_md_index_path) as md_index:
+            for record in records:
+                record.is_synced = MdIndexIsSynced.Y
+                md_index.create(record)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write_md(self, md_filename, content):
+        with open(f"{self.md_dir_path}/{md_filename}", mode="w", encoding="utf-8") as md:
+            md.write(content)
+
+    def _move_mtime(self, md_filename, seconds):
+        md_path = f"{self.md_dir_path}/{md_filename}"
+        mtime = os.stat(md_path).st_mtime + seconds
+        os.utime(md_path, (mtime, mtime))
+
+    def test_touched_file_is_not_parsed(self):
+        # a.md is touched, e.g. by `git checkout`, while b.md is edited
+        self._move_mtime("a.md", 10)
+        self._write_md("b.md", "![two](https://i.imgur.com/2.png)\n")
+        self._move_mtime("b.md", 10)
+
+        md_index_path = f"{self._tmp_dir.name}/index-markdown.csv"
+        tmp_md_index_path = f"{self._tmp_dir.name}/index-markdown-tmp.csv"
+        md_filenames = generate_md_index(self.md_dir_path, None, self.synced_md_index_path, md_index_path,
+                                         tmp_md_index_path)
+        self.assertListEqual(md_filenames, ["a.md", "b.md"])
+
+        with MdIndexReader(self.synced_md_index_path) as old_md_index, MdIndexReader(md_index_path) as md_index:
+            a_record = md_index.get_record_by_filename("a.md")
+            self.assertEqual(a_record.is_synced, MdIndexIsSynced.Y)
+            self.assertGreater(a_record.modified_date, old_md_index.get_record_by_filename("a.md").modified_date)
+            self.assertEqual(md_index.get_record_by_filename("b.md").is_synced, MdIndexIsSynced.N)
+        with MdIndexReader(tmp_md_index_path) as tmp_md_index:
+            self.assertListEqual([r.filename for r in tmp_md_index.list_record()], ["b.md"])
+
+        md_img_urls = generate_img_index(self.md_dir_path, md_index_path, self.old_img_index_path,
+                                         f"{self._tmp_dir.name}/index-image.csv",
+                                         f"{self._tmp_dir.name}/index-image-tmp.csv",
+                                         f"{self._tmp_dir.name}/deleteImgList.txt", self.img_url_filter_path,
+                                         parse_workers=1)
+        self.assertListEqual(list(md_img_urls), ["b.md"])
+
+
+class RecordingDownloadEngine:
+    """
+    Download engine writing every image without any request, and recording the image URLs it is given.
+    """
+
+    def __init__(self):
+        self.img_urls = []
+
+    def run(self, tasks):
+        for task in tasks:
+            self.img_urls.append(task.img_url)
+            with open(task.img_path, mode="wb") as img:
+                img.write(b"img")
+            yield task, DownloadResult(True, 200, local_size=3)
+
+
+class TestSyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.md_dir_path = f"{self._tmp_dir.name}/vault"
+        self.output_dir = f"{self._tmp_dir.name}/output"
+        self.img_url_filter_path = f"{self._tmp_dir.name}/imageUrlFilter.txt"
+        os.mkdir(self.md_dir_path)
+        self._write_md("a.md", "![one](https://i.imgur.com/1.png)\n")
+        with open(self.img_url_filter_path, mode="w", encoding="utf-8") as img_url_filter:
+            img_url_filter.write("https://i.imgur.com/\n")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write_md(self, md_filename, content):
+        with open(f"{self.md_dir_path}/{md_filename}", mode="w", encoding="utf-8") as md:
+            md.write(content)
+
+    def test_sync_twice(self):
+        with SyncEngine(self.img_url_filter_path, parse_workers=1, keep_indexes=True) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            metrics = engine.sync(self.md_dir_path, self.output_dir)
+            self.assertEqual(metrics.counts["images"], 1)
+
+            self._write_md("b.md", "![two](https://i.imgur.com/2.png) ![skipped](https://example.com/3.png)\n")
+            metrics = engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+            self.assertEqual(metrics.counts["parsed_markdown_files"], 1)
+            self.assertListEqual(engine.download_engine.img_urls,
+                                 ["https://i.imgur.com/1.png", "https://i.imgur.com/2.png"])
+
+        with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+            records = list(img_index.list_record())
+        self.assertListEqual([(r.md_filename, r.img_url, r.is_downloaded) for r in records],
+                             [("a.md", "https://i.imgur.com/1.png", True),
+                              ("b.md", "https://i.imgur.com/2.png", True)])
+        with open(f"{self.output_dir}/SyncedMd/b.md", encoding="utf-8") as md:
+            self.assertEqual(md.read(), f"![two](./b/{records[1].img_name}) ![skipped](https://example.com/3.png)\n")
+        self.assertFalse(os.path.exists(f"{self.output_dir}/download-journal.jsonl"))
+
+    def test_sync_twice_without_flushing_indexes(self):
+        md_index_path = f"{self.output_dir}/index-markdown.csv"
+        with SyncEngine(self.img_url_filter_path, parse_workers=1, keep_indexes=True) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            engine.sync(self.md_dir_path, self.output_dir, incremental=True, flush_indexes=False)
+            self.assertFalse(os.path.exists(md_index_path))
+
+            # the indexes in memory are kept as the old indexes of the next sync, like those in csv files
+            self._write_md("b.md", "![two](https://i.imgur.com/2.png)\n")
+            metrics = engine.sync(self.md_dir_path, self.output_dir, incremental=True, flush_indexes=False)
+            self.assertEqual(metrics.counts["parsed_markdown_files"], 1)
+            self.assertListEqual(engine.download_engine.img_urls,
+                                 ["https://i.imgur.com/1.png", "https://i.imgur.com/2.png"])
+
+            engine.flush_indexes()
+            with MdIndexReader(md_index_path) as md_index:
+                self.assertListEqual([(r.filename, r.is_synced) for r in md_index.list_record()],
+                                     [("a.md", MdIndexIsSynced.Y), ("b.md", MdIndexIsSynced.Y)])
+            with MdIndexReader(f"{self.output_dir}/index-markdown-previous.csv") as md_index:
+                self.assertListEqual(md_index.list_filename(), ["a.md"])
+
+    def test_sync_twice_with_sqlite_index(self):
+        with SyncEngine(self.img_url_filter_path, "sqlite", parse_workers=1) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            engine.sync(self.md_dir_path, self.output_dir)
+
+            self._write_md("b.md", "![two](https://i.imgur.com/2.png)\n")
+            metrics = engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+            self.assertEqual(metrics.counts["parsed_markdown_files"], 1)
+            self.assertListEqual(engine.download_engine.img_urls,
+                                 ["https://i.imgur.com/1.png", "https://i.imgur.com/2.png"])
+            db_stat = os.stat(f"{self.output_dir}/index.sqlite3")
+
+            # the database is kept between incremental runs
+            metrics = engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+            self.assertEqual(metrics.counts["parsed_markdown_files"], 0)
+            self.assertEqual(len(engine.download_engine.img_urls), 2)
+
+        self.assertEqual(os.stat(f"{self.output_dir}/index.sqlite3").st_ino, db_stat.st_ino)
+        with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+            self.assertListEqual([(r.md_filename, r.is_downloaded) for r in img_index.list_record()],
+                                 [("a.md", True), ("b.md", True)])
+
+    def test_incremental_sync_removes_deleted_files(self):
+        self._write_md("b.md", "![two](https://i.imgur.com/2.png) ![three](https://i.imgur.com/3.png)\n")
+        self._write_md("c.md", "![four](https://i.imgur.com/4.png)\n")
+        with SyncEngine(self.img_url_filter_path, parse_workers=1) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            engine.sync(self.md_dir_path, self.output_dir)
+
+            with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+                img_names = {r.img_url: r.img_name for r in img_index.list_record()}
+            synced_md_dir_path = f"{self.output_dir}/SyncedMd"
+            unlinked_img_path = f"{synced_md_dir_path}/b/{img_names['https://i.imgur.com/3.png']}"
+            for suffix in (".part", ".part.meta"):
+                with open(f"{unlinked_img_path}{suffix}", mode="wb") as part:
+                    part.write(b"part")
+
+            # the link to image 3 is removed from b.md, and c.md is deleted
+            os.remove(f"{self.md_dir_path}/c.md")
+            self._write_md("b.md", "![two](https://i.imgur.com/2.png)\n")
+            mtime = os.stat(f"{self.md_dir_path}/b.md").st_mtime + 10
+            os.utime(f"{self.md_dir_path}/b.md", (mtime, mtime))
+            engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+
+        self.assertFalse(os.path.exists(f"{synced_md_dir_path}/c.md"))
+        self.assertFalse(os.path.exists(f"{synced_md_dir_path}/c"))
+        for path in (unlinked_img_path, f"{unlinked_img_path}.part", f"{unlinked_img_path}.part.meta"):
+            self.assertFalse(os.path.exists(path), path)
+        self.assertTrue(os.path.isfile(f"{synced_md_dir_path}/a/{img_names['https://i.imgur.com/1.png']}"))
+        self.assertTrue(os.path.isfile(f"{synced_md_dir_path}/b/{img_names['https://i.imgur.com/2.png']}"))
+        self.assertListEqual(sorted(os.listdir(synced_md_dir_path)), ["a", "a.md", "b", "b.md"])
+
+        with open(f"{self.output_dir}/deleteImgList.txt", encoding="utf-8") as delete_img_list:
+            self.assertListEqual(sorted(delete_img_list.read().split()),
+                                 sorted([f"b/{img_names['https://i.imgur.com/3.png']}",
+                                         f"c/{img_names['https://i.imgur.com/4.png']}"]))
+        with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+            self.assertListEqual([(r.md_filename, r.img_url) for r in img_index.list_record()],
+                                 [("a.md", "https://i.imgur.com/1.png"), ("b.md", "https://i.imgur.com/2.png")])
+        # the indexes of the first run are kept as the old indexes
+        with ImgIndexReader(f"{self.output_dir}/index-image-previous.csv") as img_index:
+            self.assertEqual(len(list(img_index.list_record())), 4)
+        self.assertTrue(os.path.isfile(f"{self.output_dir}/index-markdown-previous.csv"))
+        with open(f"{self.output_dir}/summary.md", encoding="utf-8") as summary:
+            content = summary.read()
+        self.assertIn("## Removed Images\n", content)
+        self.assertNotIn("## Delete Manually by Yourself\n", content)
+
+    def test_incremental_sync_of_file_moved_out_and_back(self):
+        with SyncEngine(self.img_url_filter_path, parse_workers=1) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            engine.sync(self.md_dir_path, self.output_dir)
+
+            # a.md keeps its mtime while it is out of the directory
+            moved_md_path = f"{self._tmp_dir.name}/a.md"
+            os.rename(f"{self.md_dir_path}/a.md", moved_md_path)
+            engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+            with MdIndexReader(f"{self.output_dir}/index-markdown.csv") as md_index:
+                self.assertEqual(md_index.get_record_by_filename("a.md").is_synced, MdIndexIsSynced.N_FIRST)
+
+            os.rename(moved_md_path, f"{self.md_dir_path}/a.md")
+            metrics = engine.sync(self.md_dir_path, self.output_dir, incremental=True)
+        self.assertEqual(metrics.counts["copied_markdown_files"], 1)
+        self.assertEqual(metrics.counts["parsed_markdown_files"], 1)
+
+        with MdIndexReader(f"{self.output_dir}/index-markdown.csv") as md_index:
+            self.assertListEqual([(r.filename, r.is_synced) for r in md_index.list_record()],
+                                 [("a.md", MdIndexIsSynced.Y)])
+        with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+            records = list(img_index.list_record())
+        self.assertListEqual([(r.md_filename, r.img_url, r.is_downloaded) for r in records],
+                             [("a.md", "https://i.imgur.com/1.png", True)])
+        with open(f"{self.output_dir}/SyncedMd/a.md", encoding="utf-8") as md:
+            self.assertEqual(md.read(), f"![one](./a/{records[0].img_name})\n")
+        self.assertTrue(os.path.isfile(f"{self.output_dir}/SyncedMd/a/{records[0].img_name}"))
+
+    def test_sync_recursively(self):
+        os.mkdir(f"{self.md_dir_path}/sub")
+        self._write_md("sub/x.md", "![two](https://i.imgur.com/2.png)\n")
+        with SyncEngine(self.img_url_filter_path, parse_workers=1, recursive=True) as engine:
+            engine.download_engine = RecordingDownloadEngine()
+            metrics = engine.sync(self.md_dir_path, self.output_dir)
+        self.assertEqual(metrics.counts["markdown_files"], 2)
+
+        with ImgIndexReader(f"{self.output_dir}/index-image.csv") as img_index:
+            records = list(img_index.list_record())
+        self.assertListEqual([(r.md_filename, r.img_url, r.is_downloaded) for r in records],
+                             [("a.md", "https://i.imgur.com/1.png", True),
+                              ("sub/x.md", "https://i.imgur.com/2.png", True)])
+        # the image directory is next to the markdown file in its subdirectory
+        with open(f"{self.output_dir}/SyncedMd/sub/x.md", encoding="utf-8") as md:
+            self.assertEqual(md.read(), f"![two](./x/{records[1].img_name})\n")
+        self.assertTrue(os.path.isfile(f"{self.output_dir}/SyncedMd/sub/x/{records[1].img_name}"))
+
+    def test_import_without_logging(self):
+        code = "import logging, sync_md; print(logging.getLogger().handlers)"
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        self.assertEqual(output.strip(), "[]")
@@ -1,3 +1,5 @@
+import random
+import re
 import unittest
 
 from url_filter import ImageUrlFilter, UrlRule
@@ -220,3 +222,81 @@ class TestImageUrlFilter(unittest.TestCase):
         for r in rounds:
             output = ImageUrlFilter(r["rules"]).filter(r["input"])
             self.assertListEqual(output, r["expected"])
+
+    def test_filter_url_with_regex_rules(self):
+        input = [
+            "https://test1.imgur.com/101.png",
+            "https://test2.imgur.com/102.png",
+            "https://test2.imgur.com/Xxx.png",
+            "https://test2.imgur.com/aa.png",
+        ]
+        rounds = [
+            {
+                "rules": [
+                    r"r=https://(test1|test2)\.imgur\.com/.+",
+                    r"!r=https://test2\.imgur\.com/(10.+|Xxx\.png)",
+                ],
+                "expected": [
+                    "https://test1.imgur.com/101.png",
+                    "https://test2.imgur.com/aa.png",
+                ],
+            },
+            {
+                # rules which cannot be combined into one regex
+                "rules": [
+                    r"r=https://(test1|test2)\.imgur\.com/.+",
+                    r"!r=https://test2\.imgur\.com/(\w)\1\.png",
+                    "!https://test1.imgur.com/",
+                ],
+                "expected": [
+                    "https://test2.imgur.com/102.png",
+                    "https://test2.imgur.com/Xxx.png",
+                ],
+            },
+            {
+                # a conditional group refers to a group number, which changes once combined
+                "rules": [
+                    r"r=https://(test1|test2)\.imgur\.com/.+",
+                    r"!r=https://test2\.imgur\.com/(X)?(?(1)xx|10.)\.png",
+                ],
+                "expected": [
+                    "https://test1.imgur.com/101.png",
+                    "https://test2.imgur.com/aa.png",
+                ],
+            },
+        ]
+
+        for r in rounds:
+            output = ImageUrlFilter(r["rules"]).filter(input)
+            self.assertListEqual(output, r["expected"])
+
+    def test_filter_url_same_as_last_matching_rule(self):
+        random.seed(7)
+        hosts = ["https://a.imgur.com/", "https://b.imgur.com/", "http://localhost/"]
+        urls = [f"{random.choice(hosts)}{random.choice(['', 'x/', 'x/y/'])}{i}.png" for i in range(200)] + hosts
+
+        for _ in range(50):
+            rules = []
+            for _ in range(random.randint(1, 8)):
+                rule = random.choice(hosts) + random.choice(["", "x/", "x/y/", "1"])
+                if random.random() < 0.3:
+                    rule = "r=" + re.escape(rule) + random.choice([".+", r"\d+\.png", ""])
+                if random.random() < 0.5:
+                    rule = "!" + rule
+                rules.append(rule)
+
+            url_filter = ImageUrlFilter(rules)
+            for url in urls:
+                # the last matching rule decides, otherwise the URL is ok only without any positive rule
+                expected = not any(rule.is_positive for rule in url_filter.rules)
+                for rule in url_filter.rules:
+                    if ImageUrlFilter.match(url, rule.pattern, rule.is_regexp):
+                        expected = rule.is_positive
+                self.assertEqual(url_filter.is_ok(url), expected, f"{rules} {url}")
+
+    def test_rules_per_filter(self):
+        url_filter = ImageUrlFilter(["https://i.imgur.com/"])
+        ImageUrlFilter(["!https://i.imgur.com/"])
+
+        self.assertListEqual(url_filter.rules, [UrlRule("https://i.imgur.com/", True, False)])
+        self.assertTrue(url_filter.is_ok("https://i.imgur.com/1.png"))
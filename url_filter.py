@@ -1,24 +1,9 @@
-import logging
-import os
 import re
-import sys
+from functools import lru_cache
 from typing import List
 
 from data_base_class import DataPrintable
 
-LOG_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/log"
-if not os.path.isdir(LOG_DIR):
-    os.mkdir(LOG_DIR)
-
-LOGGING_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
-logging.basicConfig(level=logging.DEBUG,
-                    handlers=[
-                        logging.StreamHandler(sys.stdout),
-                        logging.FileHandler(f"{LOG_DIR}/{os.path.splitext(os.path.basename(__file__))[0]}.log",
-                                            "w", "utf-8")
-                    ],
-                    format=LOGGING_FORMAT)
-
 
 class UrlRule(DataPrintable):
     def __init__(self, pattern, is_positive, is_regexp):
@@ -40,10 +25,44 @@ class UrlRule(DataPrintable):
         return hash(tuple(sorted(self.__dict__.items())))
 
 
+class UrlRuleTrie:
+    """
+    Prefix trie of the patterns of literal rules.
+    `find(url)` returns the index of the last rule whose pattern is a prefix of `url`, or -1,
+    walking `url` once no matter how many rules there are.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, pattern, rule_index):
+        node = self._root
+        for c in pattern:
+            node = node.setdefault(c, {})
+        node[None] = rule_index  # `None` is never a character of a URL
+
+    def find(self, url):
+        found = self._root.get(None, -1)
+        node = self._root
+        for c in url:
+            node = node.get(c)
+            if node is None:
+                break
+            found = max(found, node.get(None, -1))
+
+        return found
+
+
 class ImageUrlFilter:
-    rules: List[UrlRule] = []
+    # `is_ok` decisions cached per filter
+    CACHE_SIZE = 4096
+
+    # patterns which change meaning once combined into one regex,
+    # i.e. with backreferences, named groups, conditional groups or global inline flags
+    UNCOMBINABLE_PATTERN = re.compile(r"\\[1-9]|\\g<|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)")
 
     def __init__(self, rules: List[str]):
+        self.rules: List[UrlRule] = []
         self.set_rules(rules)
 
     def set_rules(self, rules):
@@ -95,6 +114,38 @@ class ImageUrlFilter:
 
         # logging.debug(f"rules= [{','.join([str(r) for r in self.rules])}]")
 
+        self._compile()
+
+    def _compile(self):
+        """
+        Compile the rules for `is_ok`:
+        literal rules into a `UrlRuleTrie`, and regex rules into one regex of alternatives in descending rule order,
+        so the first matching alternative is the last matching regex rule.
+        If the regex rules cannot be combined, they are compiled one by one instead.
+        """
+        self._has_positive_rule = any(rule.is_positive for rule in self.rules)
+
+        self._literal_rules = UrlRuleTrie()
+        regex_rules = []
+        for i, rule in enumerate(self.rules):
+            if rule.is_regexp:
+                regex_rules.append((i, re.compile(rule.pattern)))
+            else:
+                self._literal_rules.add(rule.pattern, i)
+
+        # regex rules in descending rule order
+        self._regex_rules = regex_rules[::-1]
+        self._combined_regex = None
+        if self._regex_rules and not any(self.UNCOMBINABLE_PATTERN.search(regex.pattern)
+                                         for _, regex in self._regex_rules):
+            try:
+                self._combined_regex = re.compile("|".join(f"(?P<r{i}>{regex.pattern})"
+                                                           for i, regex in self._regex_rules))
+            except re.error:
+                self._combined_regex = None
+
+        self._cached_is_ok = lru_cache(maxsize=self.CACHE_SIZE)(self._is_ok)
+
     @staticmethod
     def match(url, pattern, is_regexp=False):
         if is_regexp:
@@ -106,59 +157,37 @@ class ImageUrlFilter:
 
         return False
 
+    def _find_last_regex_rule(self, url, min_rule_index):
+        if self._combined_regex is not None:
+            result = self._combined_regex.match(url)
+            if result is None:
+                return -1
+            rule_index = int(result.lastgroup[1:])
+            return rule_index if rule_index > min_rule_index else -1
+
+        for rule_index, regex in self._regex_rules:
+            if rule_index <= min_rule_index:
+                break
+            if regex.match(url):
+                return rule_index
+
+        return -1
+
+    def _is_ok(self, url):
+        # the later rule takes precedence, i.e. the last matching rule decides
+        rule_index = self._literal_rules.find(url) if not url.endswith("/") else -1
+        rule_index = max(rule_index, self._find_last_regex_rule(url, rule_index))
+        if rule_index >= 0:
+            return self.rules[rule_index].is_positive
+
+        # no rule matches, so the URL is ok only if it does not have to follow any positive rule
+        return not self._has_positive_rule
+
     def is_ok(self, url):
         if not self.rules:
             return True
 
-        isOk = False
-        set_by_positive_rule = None
-        for rule in self.rules[::-1]:
-            is_match = self.match(url, rule.pattern, rule.is_regexp)
-            if is_match:
-                isOk = rule.is_positive
-                set_by_positive_rule = rule.is_positive
-                break
-            else:
-                if rule.is_positive:  # not ok: not follow the positive rule
-                    if isOk:
-                        if set_by_positive_rule is None:
-                            isOk = False
-                            set_by_positive_rule = rule.is_positive
-                        elif set_by_positive_rule:
-                            # This can not happen.
-                            pass
-                        else:
-                            isOk = False
-                            set_by_positive_rule = rule.is_positive
-                    else:
-                        if set_by_positive_rule is None:
-                            set_by_positive_rule = rule.is_positive
-                        elif set_by_positive_rule:
-                            pass
-                        else:
-                            # This can not happen.
-                            pass
-                else:  # ok: follow the negative rule
-                    if isOk:
-                        if set_by_positive_rule is None:
-                            set_by_positive_rule = rule.is_positive
-                        elif set_by_positive_rule:
-                            # This can not happen.
-                            pass
-                        else:
-                            pass
-                    else:
-                        if set_by_positive_rule is None:
-                            isOk = True
-                            set_by_positive_rule = rule.is_positive
-                        elif set_by_positive_rule:
-                            # The previous rule takes precedence.
-                            pass
-                        else:
-                            # This can not happen.
-                            pass
-
-        return isOk
+        return self._cached_is_ok(url)
 
     def filter(self, urls) -> List[str]:
         output = []